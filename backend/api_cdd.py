@@ -2,15 +2,238 @@ import requests
 import time
 import json
 import logging
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from email.utils import parsedate_to_datetime
+from functools import wraps
 
-# Set logging
+import request_context
+from metrics import METRICS
+
+# Set logging, handlers and levels are set by logging_setup.setup_logging()
 filename = 'api_cdd.py'
 logger = logging.getLogger(filename)
-logger.setLevel(level=logging.INFO)  # When debugging put to loggin.DEBUG
-formatter = logging.Formatter("%(levelname)s | %(message)s")
-ch = logging.StreamHandler()
-ch.setFormatter(formatter)
-logger.addHandler(ch)
+
+# Priorities of requests to CDD, interactive requests (operator is waiting) go before background requests
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# Default rate limits of CDD requests per method: [requests per second, burst]
+DEFAULT_RATE_LIMITS = {'GET': [10, 20], 'PUT': [10, 20]}
+
+# Default retry settings of idempotent CDD requests, delays in seconds
+DEFAULT_RETRIES = {'max_retries': 3, 'backoff_base': 0.5,
+                   'backoff_max': 10, 'retry_after_max': 30}
+
+# Default circuit breaker settings, reset_timeout in seconds
+DEFAULT_CIRCUIT_BREAKER = {'failure_threshold': 5, 'reset_timeout': 30}
+
+# Default timeouts of CDD requests in seconds: [connect, read]
+DEFAULT_TIMEOUT = [5, 60]
+
+# Default maximum duration of an asynchronous export in seconds
+DEFAULT_EXPORT_TIMEOUT = 300
+
+# Default hedging settings of GET requests, see ApiCDD conventions
+DEFAULT_HEDGING = {'enabled': False, 'percentile': 95,
+                   'min_samples': 20, 'min_delay': 0.05, 'max_workers': 16}
+
+# Status codes of CDD after which a request is retried
+RETRY_STATUSSES = [429, 500, 502, 503, 504]
+
+# Rate limiters and circuit breakers of this process, shared by all ApiCDD objects of the same vault
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+class TokenBucket():
+    """ Token bucket that limits the number of requests per second, thread-safe
+
+    Arguments:
+            rate {float} -- tokens added per second
+            capacity {int} -- maximum number of tokens, gives the allowed burst
+
+    Conventions:
+        - waiting INTERACTIVE callers are always served before BACKGROUND callers
+    """
+
+    def __init__(self, rate, capacity):
+        """ Initialized is called when class in created
+        """
+
+        self._rate = float(rate)
+        self._capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated_on = time.monotonic()
+        self._waiting_interactive = 0
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens +
+                           (now - self._updated_on) * self._rate)
+        self._updated_on = now
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        """ Takes one token, blocks until a token is available
+
+        Keyword Arguments:
+            priority {string} -- INTERACTIVE or BACKGROUND (default: {INTERACTIVE})
+            timeout {float} -- maximum seconds to wait, None is no maximum (default: {None})
+
+        Returns:
+            float -- seconds waited for the token, None if no token was available within timeout
+        """
+
+        start = time.monotonic()
+        with self._condition:
+            if(priority == INTERACTIVE):
+                self._waiting_interactive += 1
+            try:
+                while True:
+                    self._refill()
+                    if(self._tokens >= 1 and (priority == INTERACTIVE or self._waiting_interactive == 0)):
+                        self._tokens -= 1
+                        return time.monotonic() - start
+
+                    # Sleep until next token, background callers recheck when an interactive caller is served
+                    wait = max((1 - self._tokens) / self._rate, 0.01)
+                    if(timeout is not None):
+                        remaining = timeout - (time.monotonic() - start)
+                        if(remaining <= 0):
+                            return None
+                        wait = min(wait, remaining)
+                    self._condition.wait(wait)
+            finally:
+                if(priority == INTERACTIVE):
+                    self._waiting_interactive -= 1
+                    self._condition.notify_all()
+
+
+class Deadline():
+    """ End-to-end time budget of a (backend) request, passed down to all CDD requests made for it
+
+    Arguments:
+            seconds {float} -- time budget in seconds, None is no budget
+    """
+
+    def __init__(self, seconds=None):
+        """ Initialized is called when class in created
+        """
+
+        self.seconds = seconds
+        self._expires_on = None if seconds is None else time.monotonic() + seconds
+
+    def remaining(self):
+        """ Returns seconds left, None if there is no budget
+        """
+
+        if(self._expires_on is None):
+            return None
+        return max(self._expires_on - time.monotonic(), 0)
+
+    def expired(self):
+        return self._expires_on is not None and time.monotonic() >= self._expires_on
+
+
+class CircuitBreaker():
+    """ Circuit breaker that stops requests to CDD when it is down, thread-safe
+
+    Arguments:
+            failure_threshold {int} -- number of consecutive failures after which the circuit opens
+            reset_timeout {float} -- seconds after which an open circuit lets one trial request through
+
+    Conventions:
+        - 'closed': all requests are allowed
+        - 'open': no requests are allowed, until reset_timeout has passed
+        - 'half-open': one trial request is allowed, its result closes or re-opens the circuit
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        """ Initialized is called when class in created
+        """
+
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._state = 'closed'
+        self._opened_on = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow_request(self):
+        """ Returns True if a request may be made
+        """
+
+        with self._lock:
+            if(self._state == 'closed'):
+                return True
+            if(self._state == 'open' and time.monotonic() - self._opened_on >= self._reset_timeout):
+                # Let one trial request through
+                self._state = 'half-open'
+                return True
+            return False
+
+    def release(self):
+        """ Gives back the trial request of a half-open circuit when it was not sent, e.g. deadline exceeded
+        """
+
+        with self._lock:
+            if(self._state == 'half-open'):
+                # opened_on is unchanged, so the next request is the trial
+                self._state = 'open'
+
+    def record_success(self):
+        with self._lock:
+            if(self._state != 'closed'):
+                logger.info('%s | %s', filename,
+                            'Circuit breaker closed: CDD is available again')
+            self._failures = 0
+            self._state = 'closed'
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if(self._state == 'half-open' or (self._state == 'closed' and self._failures >= self._failure_threshold)):
+                logger.error('%s | Circuit breaker opened: %s failures, CDD requests fail fast for %s seconds',
+                             filename, self._failures, self._reset_timeout)
+                METRICS.inc('cdd_circuit_breaker_opened_total')
+                self._state = 'open'
+                self._opened_on = time.monotonic()
+
+
+def get_shared(base_url, name, factory):
+    """ Returns the process-wide object name (e.g. rate limiter) of vault base_url, created with factory() when needed
+    """
+
+    with _shared_lock:
+        key = (base_url, name)
+        if(key not in _shared):
+            _shared[key] = factory()
+        return _shared[key]
+
+
+def observed(f):
+    """ Decorator that stores duration and status of 'request' method f of ApiCDD in METRICS
+    """
+
+    @wraps(f)
+    def decorated(self, *args, **kwargs):
+        start = time.monotonic()
+        dic = f(self, *args, **kwargs)
+        labels = {'call': f.__name__}
+        METRICS.observe('cdd_call_duration_seconds',
+                        time.monotonic() - start, labels)
+        METRICS.inc('cdd_calls_total', dict(
+            labels, status=str(dic['response']['status'])))
+        return dic
+
+    return decorated
 
 
 class ApiCDD():
@@ -19,6 +242,13 @@ class ApiCDD():
     Arguments:
             base_url {string} -- url of vault: https://app.collaborativedrug.com/api/v1/vaults/<VAULD ID>/
             token {string} -- token of vault
+            export_max_age {int} -- seconds a finished asynchronous export is reused (default: {60})
+            rate_limits {dic} -- per method [requests per second, burst], e.g. {'GET': [10, 20]} (default: {DEFAULT_RATE_LIMITS})
+            retries {dic} -- retry settings of idempotent requests, see DEFAULT_RETRIES (default: {DEFAULT_RETRIES})
+            circuit_breaker {dic} -- circuit breaker settings, see DEFAULT_CIRCUIT_BREAKER (default: {DEFAULT_CIRCUIT_BREAKER})
+            timeout {list} -- [connect, read] timeout in seconds of every request (default: {DEFAULT_TIMEOUT})
+            export_timeout {float} -- maximum seconds an asynchronous export may take (default: {DEFAULT_EXPORT_TIMEOUT})
+            hedging {dic} -- hedging settings of GET requests, see DEFAULT_HEDGING (default: {DEFAULT_HEDGING})
 
     Conventions:
         - all 'request' methods return a dictionary with keys:
@@ -30,6 +260,18 @@ class ApiCDD():
                 > [status]      {int}      -- status code of CDD response, see status codes.
                 > [json]        {dic}      -- Output of CDD repsonse, this contains all the data
                 > [message]     {dic}      -- Discription of response, if error, than this contains the error
+        - all 'request' methods accept a priority, INTERACTIVE (default) or BACKGROUND, that is used by the rate limiter.
+          The rate limiter is shared by all ApiCDD objects of the same vault in this process.
+        - idempotent requests are retried with jittered exponential backoff on connection errors and RETRY_STATUSSES,
+          a 'Retry-After' header of CDD is respected. When CDD keeps failing the (shared) circuit breaker opens,
+          and requests fail fast with status 503 without contacting CDD.
+        - all 'request' methods accept a deadline {Deadline}, the time budget of the backend request. Timeouts, retries
+          and export polling never exceed it, when it runs out the method returns with status 504.
+        - requests carry the correlation id of the backend request as 'X-Correlation-ID' header, and are added to
+          its timings, see request_context
+        - GET requests made with hedge=True (only when hedging is enabled) fire a second, identical request when the
+          first takes longer than the given percentile of recent latencies of that url, the first answer is used.
+          The second request takes a token of the rate limiter, when none is available it is not sent.
 
     Status codes (https://support.collaborativedrug.com/hc/en-us/articles/115005682123-Error-Codes-and-Messages):
         status  --  statusText              -- Description
@@ -40,9 +282,12 @@ class ApiCDD():
         403     --  Not Found               -- Either you're requesting an invalid URI or the resource in question doesn't exist
         500     --  Internal Server Error   -- The request was not completed due to an internal error on the server side.
         503     --  No Server Error         -- Usually occurs when there are too many requests coming into CDD.
+                                               Also given (without response of CDD) if the connection failed or the circuit breaker is open.
+        504     --  Gateway Timeout         -- Given (without response of CDD) if CDD did not respond in time or the deadline is exceeded.
     """
 
-    def __init__(self, base_url, token):
+    def __init__(self, base_url, token, export_max_age=60, rate_limits=None, retries=None, circuit_breaker=None,
+                 timeout=None, export_timeout=DEFAULT_EXPORT_TIMEOUT, hedging=None):
         """ Initialized is called when class in created
         """
 
@@ -50,58 +295,235 @@ class ApiCDD():
         self._headers = {
             'X-CDD-token': token}
 
-    def make_get_request(self, get_url):
-        """ Makes 'GET' request to get_url
+        # Rate limiters per method
+        rate_limits = dict(DEFAULT_RATE_LIMITS, **(rate_limits or {}))
+        self._rate_limiters = {method: get_shared(base_url, 'rate_limiter_' + method, lambda: TokenBucket(rate, capacity))
+                               for method, (rate, capacity) in rate_limits.items()}
+
+        # Retries and circuit breaker
+        self._retries = dict(DEFAULT_RETRIES, **(retries or {}))
+        circuit_breaker = dict(DEFAULT_CIRCUIT_BREAKER,
+                               **(circuit_breaker or {}))
+        self._circuit_breaker = get_shared(
+            base_url, 'circuit_breaker', lambda: CircuitBreaker(**circuit_breaker))
+
+        # Timeouts
+        self._timeout = tuple(timeout or DEFAULT_TIMEOUT)
+        self._export_timeout = export_timeout
+
+        # Hedging, recent latencies of successful GET requests per url (without query and id)
+        self._hedging = dict(DEFAULT_HEDGING, **(hedging or {}))
+        self._latencies = {}
+        self._latencies_lock = threading.Lock()
+        self._hedge_pool = None
+        if(self._hedging['enabled']):
+            self._hedge_pool = ThreadPoolExecutor(
+                max_workers=self._hedging['max_workers'], thread_name_prefix='cdd-hedge')
+
+        # Asynchronous exports by query url, in progress or recently finished (see request_batches_async)
+        self._export_max_age = export_max_age
+        self._exports = {}
+        self._exports_lock = threading.Lock()
+
+    def _wait_for_rate_limit(self, method, priority, deadline):
+        """ Blocks until the rate limiter of method allows a request, waiting time is stored in METRICS
 
-        Args:
-            get_url (string): CDD url, with which the request must be
+        Returns:
+            bool -- False if the deadline was exceeded while waiting
         """
 
-        # Output
-        dic = {'request': {'type': "GET", 'url': self._base_url+get_url, 'json': None},
-               'response': {'status': None, 'json': None, 'message': None}}
+        waited = self._rate_limiters[method].acquire(
+            priority, deadline.remaining())
+        if(waited is None):
+            return False
 
-        # Make request
-        request = requests.request(
-            "GET", dic['request']['url'], headers=self._headers)
+        labels = {'method': method, 'priority': priority}
+        METRICS.observe('cdd_rate_limit_wait_seconds', waited, labels)
+        if(waited > 0.001):
+            METRICS.inc('cdd_rate_limit_waits_total', labels)
+            logger.debug('%s | Rate limit: %s request waited %.3f seconds',
+                         filename, method, waited)
+        return True
 
-        # Get response variables
-        dic['response']['status'] = request.status_code
-        dic['response']['json'] = request.json()
+    def _invalid_json(self, dic, keys):
+        """ Sets status 502 in dic, when the json of a successful response is not a dictionary with keys, e.g. an error
+            page with status 200, so callers never index a response that is not valid
 
-        if(dic['response']['status'] != 200):
-            # Request failed, return
-            dic['response']['message'] = request.text
-            return dic
+        Returns:
+            bool -- True if json is not valid
+        """
 
-        # Request success
-        dic['response']['message'] = 'The cdd-request was successfully completed'
+        json_data = dic['response']['json']
+        if(isinstance(json_data, dict) and all(key in json_data for key in keys)):
+            return False
+
+        dic['response']['status'] = 502
+        dic['response']['message'] = 'CDD Error: response has no valid json with keys {0}'.format(
+            ', '.join(keys))
+        dic['response']['json'] = None
+        logger.error('%s | %s | %s', filename,
+                     dic['request']['url'], dic['response']['message'])
+        return True
+
+    def _deadline_exceeded(self, dic, deadline):
+        """ Sets status 504 in dic, when the deadline of the request is exceeded
+        """
 
+        dic['response']['status'] = 504
+        dic['response']['json'] = None
+        dic['response']['message'] = 'Deadline exceeded: no response of CDD within time budget of {0} seconds'.format(
+            deadline.seconds)
+        logger.error('%s | %s | %s', filename,
+                     dic['request']['url'], dic['response']['message'])
         return dic
 
-    def make_put_request(self, put_url, post_data):
+    def make_get_request(self, get_url, priority=INTERACTIVE, deadline=None, hedge=False):
+        """ Makes 'GET' request to get_url
+
+        Args:
+            get_url (string): CDD url, with which the request must be
+            priority (string): INTERACTIVE or BACKGROUND, see rate limiter
+            deadline (Deadline): time budget of request, None is no budget
+            hedge (bool): hedge request, see conventions
+        """
+
+        return self._make_request("GET", get_url, None, priority, True, deadline, hedge)
+
+    def make_put_request(self, put_url, post_data, priority=INTERACTIVE, idempotent=True, deadline=None):
         """ Makes 'POST' request to get_url, with post_data as body
 
         Args:
             put_url (str): CDD url, with which the reuqest must be made
             post_data (dic): body of reqeust
+            priority (string): INTERACTIVE or BACKGROUND, see rate limiter
+            idempotent (bool): retry request on failure, True because repeating a PUT with the same body gives the same batch
+            deadline (Deadline): time budget of request, None is no budget
+        """
+
+        return self._make_request("PUT", put_url, post_data, priority, idempotent, deadline)
+
+    def _make_request(self, method, url, post_data, priority, idempotent, deadline=None, hedge=False):
+        """ Makes request to CDD, with retries and circuit breaker (see conventions)
+
+        Arguments:
+            method {string} -- "GET" or "PUT"
+            url {string} -- CDD url without the base
+            post_data {dic} -- body of request, None with 'GET' request
+            priority {string} -- INTERACTIVE or BACKGROUND, see rate limiter
+            idempotent {bool} -- retry request on failure
+            deadline {Deadline} -- time budget of request, None is no budget
+            hedge {bool} -- hedge request, see conventions
+
+        Returns:
+            {dic} -- discription above ^
         """
 
+        deadline = deadline or Deadline()
+        hedge = hedge and self._hedge_pool is not None and method == "GET"
+
         # Output
-        dic = {'request': {'type': "PUT", 'url': self._base_url+put_url, 'json': post_data},
+        dic = {'request': {'type': method, 'url': self._base_url+url, 'json': post_data},
                'response': {'status': None, 'json': None, 'message': None}}
 
-        # Make request
-        request = requests.request(
-            "PUT", dic['request']['url'], headers=self._headers, json=dic['request']['json'])
+        max_retries = self._retries['max_retries'] if idempotent else 0
+        attempt = 0
+        while True:
+            if(not self._circuit_breaker.allow_request()):
+                # CDD is down, fail fast
+                dic['response']['status'] = 503
+                dic['response']['json'] = None
+                dic['response']['message'] = 'CDD unavailable: circuit breaker is open, request was not sent'
+                return dic
 
-        # Get response variables
-        dic['response']['status'] = request.status_code
-        dic['response']['json'] = request.json()
+            if(deadline.expired() or not self._wait_for_rate_limit(method, priority, deadline)):
+                # Request is not sent, it can't close or re-open the circuit
+                self._circuit_breaker.release()
+                return self._deadline_exceeded(dic, deadline)
+
+            # Timeouts never exceed the remaining time budget
+            connect_timeout, read_timeout = self._timeout
+            remaining = deadline.remaining()
+            if(remaining is not None):
+                connect_timeout = min(connect_timeout, remaining)
+                read_timeout = min(read_timeout, remaining)
+
+            # Make request
+            request = None
+            retry_after = None
+            METRICS.add('cdd_requests_in_flight', 1)
+            try:
+                start = time.monotonic()
+                if(hedge):
+                    request = self._send_hedged(
+                        url, priority, (connect_timeout, read_timeout))
+                else:
+                    request = requests.request(method, dic['request']['url'], headers=self._request_headers(),
+                                               json=dic['request']['json'], timeout=(connect_timeout, read_timeout))
+                if(method == "GET" and request.status_code == 200):
+                    self._record_latency(url, time.monotonic() - start)
+            except requests.exceptions.Timeout as e:
+                dic['response']['status'] = 504
+                dic['response']['json'] = None
+                dic['response']['message'] = 'CDD did not respond in time: {0}'.format(
+                    str(e))
+            except requests.exceptions.RequestException as e:
+                dic['response']['status'] = 503
+                dic['response']['json'] = None
+                dic['response']['message'] = 'Connection with CDD failed: {0}'.format(
+                    str(e))
+            except Exception:
+                # Unexpected error, the trial request of a half-open circuit is not used
+                self._circuit_breaker.release()
+                raise
+            else:
+                # Get response variables
+                dic['response']['status'] = request.status_code
+                dic['response']['json'] = self._response_json(request)
+                dic['response']['message'] = request.text
+                retry_after = self._retry_after(request)
+            finally:
+                METRICS.add('cdd_requests_in_flight', -1)
+
+            labels = {'method': method, 'endpoint': self._latency_key(url)}
+            METRICS.observe('cdd_request_duration_seconds',
+                            time.monotonic() - start, labels)
+            request_context.add_timing('cdd', time.monotonic() - start, method=method, url=url,
+                                       status=dic['response']['status'])
+            METRICS.inc('cdd_responses_total', dict(
+                labels, status=str(dic['response']['status'])))
+
+            failed = request is None or dic['response']['status'] in RETRY_STATUSSES
+            if(failed):
+                self._circuit_breaker.record_failure()
+            else:
+                self._circuit_breaker.record_success()
+
+            if(not failed or attempt >= max_retries):
+                break
+
+            # Jittered exponential backoff, or as long as CDD asks
+            delay = random.uniform(0, min(self._retries['backoff_max'],
+                                          self._retries['backoff_base'] * 2 ** attempt))
+            if(retry_after is not None):
+                if(retry_after > self._retries['retry_after_max']):
+                    logger.warning('%s | CDD asks to retry %s after %s seconds, longer than allowed, give up',
+                                   filename, dic['request']['url'], retry_after)
+                    break
+                delay = retry_after
+
+            remaining = deadline.remaining()
+            if(remaining is not None and delay >= remaining):
+                # No time left for another attempt
+                break
+
+            attempt += 1
+            METRICS.inc('cdd_retries_total', {'method': method})
+            logger.warning('%s | Retry %s/%s of %s %s in %.2f seconds, status: %s',
+                           filename, attempt, max_retries, method, dic['request']['url'], delay, dic['response']['status'])
+            time.sleep(delay)
 
         if(dic['response']['status'] != 200):
             # Request failed, return
-            dic['response']['message'] = request.text
             return dic
 
         # Request success
@@ -109,9 +531,110 @@ class ApiCDD():
 
         return dic
 
-    def request_projects(self):
+    def _latency_key(self, url):
+        """ Returns url without query and id, e.g. 'batches/?page_size=999' > 'batches/'
+        """
+
+        return url.split('?')[0].rstrip('0123456789')
+
+    def _record_latency(self, url, seconds):
+        if(self._hedge_pool is None):
+            return
+        with self._latencies_lock:
+            key = self._latency_key(url)
+            if(key not in self._latencies):
+                self._latencies[key] = deque(maxlen=200)
+            self._latencies[key].append(seconds)
+
+    def _hedge_delay(self, url):
+        """ Returns seconds after which a GET request to url is hedged, None if not enough latencies are known yet
+        """
+
+        with self._latencies_lock:
+            latencies = sorted(self._latencies.get(
+                self._latency_key(url), []))
+        if(len(latencies) < self._hedging['min_samples']):
+            return None
+        index = int(round(self._hedging['percentile'] /
+                          100 * (len(latencies) - 1)))
+        return max(latencies[index], self._hedging['min_delay'])
+
+    def _send_hedged(self, url, priority, timeout):
+        """ Sends GET request to url, and a second one when the first takes longer than the hedge delay
+
+        Returns:
+            requests.Response -- first response, exception of request is raised when both failed
+        """
+
+        headers = self._request_headers()
+
+        def send():
+            return requests.request("GET", self._base_url+url, headers=headers, timeout=timeout)
+
+        futures = [self._hedge_pool.submit(send)]
+        hedge_delay = self._hedge_delay(url)
+        if(hedge_delay is not None):
+            done, _ = wait(futures, timeout=hedge_delay)
+            if(not done and self._rate_limiters["GET"].acquire(priority, 0) is not None):
+                # First request is slow, fire second request, that counts for the rate limiter
+                logger.debug('%s | Hedge GET %s after %.3f seconds',
+                             filename, url, hedge_delay)
+                METRICS.inc('cdd_hedged_requests_total')
+                futures.append(self._hedge_pool.submit(send))
+
+        pending = futures
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if(future.exception() is None or not pending):
+                    if(future is not futures[0]):
+                        METRICS.inc('cdd_hedge_wins_total')
+                    return future.result()
+
+    def _request_headers(self):
+        """ Returns headers of request, with correlation id of backend request
+        """
+
+        correlation_id = request_context.get_correlation_id()
+        if(correlation_id is None):
+            return self._headers
+        return dict(self._headers, **{'X-Correlation-ID': correlation_id})
+
+    def _response_json(self, request):
+        """ Returns json of response, None if the response has no (valid) json, e.g. error pages
+        """
+
+        try:
+            return request.json()
+        except ValueError:
+            return None
+
+    def _retry_after(self, request):
+        """ Returns the seconds of the 'Retry-After' header of response, None if not given
+        """
+
+        value = request.headers.get('Retry-After')
+        if(not value):
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            # Header can also be a HTTP-date
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    @observed
+    def request_projects(self, priority=INTERACTIVE, deadline=None, hedge=False):
         """ Function that request the projects from the CDD Vault
 
+        Keyword Arguments:
+            priority {string} -- INTERACTIVE or BACKGROUND, see rate limiter (default: {INTERACTIVE})
+            deadline {Deadline} -- time budget of request (default: {None})
+            hedge {bool} -- hedge request, see conventions (default: {False})
+
         Returns:
             {dic} -- discription above ^
         """
@@ -119,7 +642,7 @@ class ApiCDD():
         # Get-URL for projects
         get_url = "projects/"
 
-        dic = self.make_get_request(get_url)
+        dic = self.make_get_request(get_url, priority, deadline, hedge)
 
         if(dic['response']['status'] != 200):
             # Request failed, return
@@ -128,11 +651,16 @@ class ApiCDD():
 
         return dic
 
-    def request_batches(self, force_async=False, **kwargs):
+    @observed
+    def request_batches(self, force_async=False, priority=INTERACTIVE, deadline=None, hedge=False, reuse_export=True, **kwargs):
         """ Function that (synchronous) request the batches from CDD Vault
 
         Keyword Arguments:
             force_async {bool} -- [boolean to make asynchronous request] (default: {False})
+            priority {string} -- INTERACTIVE or BACKGROUND, see rate limiter (default: {INTERACTIVE})
+            deadline {Deadline} -- time budget of request (default: {None})
+            hedge {bool} -- hedge synchronous request, see conventions (default: {False})
+            reuse_export {bool} -- an asynchronous request may reuse an export of other caller, see request_batches_async (default: {True})
 
         Returns:
             dic -- discription above ^
@@ -149,35 +677,47 @@ class ApiCDD():
 
         # Force asynchronous request
         if(force_async):
-            return self.request_batches_async(get_url)
+            return self.request_batches_async(get_url, priority, deadline, reuse_export)
 
-        dic = self.make_get_request(get_url)
+        dic = self.make_get_request(get_url, priority, deadline, hedge)
         if(dic['response']['status'] != 200):
             # Request failed, return
             logger.error('%s | %s', filename, dic['response']['message'])
             return dic
+        if(self._invalid_json(dic, ['count', 'page_size', 'objects'])):
+            return dic
 
         if(dic['response']['json']['count'] > 1000):
             # Number of items in request over 1000, force asynchronous request, (see link for details)
             logger.info('%s | %s', filename,
                         'Alert: not all batches loaded, using async request!')
-            return self.request_batches_async(get_url)
+            return self.request_batches_async(get_url, priority, deadline, reuse_export)
 
         if(dic['response']['json']['count'] > dic['response']['json']['page_size']):
             # Number of items in request is smaller, than found on page, rerun
             logger.info('%s | %s', filename,
                         'Alert: count larger than page_size, reran with get_batches(page_size=1000)')
-            return self.request_batches(page_size=1000)
+            return self.request_batches(priority=priority, deadline=deadline, hedge=hedge, reuse_export=reuse_export, page_size=1000)
 
         # Request success
         dic['response']['message'] = 'The cdd-request was successfully completed'
         return dic
 
-    def request_batches_async(self, url='batches/?'):
+    @observed
+    def request_batches_async(self, url='batches/?', priority=INTERACTIVE, deadline=None, reuse_export=True):
         """ Function (asynchronous) requests the batches from CDD Vault
+            NOTE: Exports are shared by query url. A caller attaches to an export of the same url that is
+                  still in progress, or reuses one that finished less than export_max_age seconds ago.
+                  The export runs in its own thread with a budget of export_timeout seconds, so it continues
+                  (and can be reused) when the deadline of the caller is exceeded.
+                  Without reuse_export the caller always starts a new export (which other callers can reuse), so
+                  the batches are never older than the call, e.g. for the snapshot of batches.
 
         Arguments:
             url {string} -- URL without the base
+            priority {string} -- INTERACTIVE or BACKGROUND, see rate limiter
+            deadline {Deadline} -- time budget of request
+            reuse_export {bool} -- attach to an export of other caller (default: {True})
 
         Returns:
             {dic} -- discription above ^
@@ -186,11 +726,86 @@ class ApiCDD():
         # Add asynchronous to get-URL
         get_url = url + "async=true"
 
-        dic = self.make_get_request(get_url)
+        with self._exports_lock:
+            now = time.time()
+            for export_url, export in list(self._exports.items()):
+                # Forget finished exports that are too old to be reused
+                if(export['finished_on'] and now - export['finished_on'] > self._export_max_age):
+                    del self._exports[export_url]
+
+            export = self._exports.get(get_url) if reuse_export else None
+            is_owner = export is None
+            if(is_owner):
+                export = {'event': threading.Event(),
+                          'dic': None, 'finished_on': None}
+                self._exports[get_url] = export
+
+        METRICS.inc('cdd_exports_total', {
+                    'shared': 'false' if is_owner else 'true'})
+        if(is_owner):
+            threading.Thread(target=self._export_worker, args=(
+                get_url, export, priority, request_context.get_correlation_id()), daemon=True).start()
+        else:
+            # Export of same url is in progress or recently finished, wait for it and reuse it
+            logger.debug('%s | Reuse asynchronous export of \'%s\'',
+                         filename, get_url)
+
+        deadline = deadline or Deadline()
+        with request_context.timed('cddExport', shared=not is_owner):
+            finished = export['event'].wait(deadline.remaining())
+        if(not finished):
+            dic = {'request': {'type': "GET", 'url': self._base_url+get_url, 'json': None},
+                   'response': {'status': None, 'json': None, 'message': None}}
+            return self._deadline_exceeded(dic, deadline)
+
+        return self._copy_response(export['dic'])
+
+    def _export_worker(self, get_url, export, priority, correlation_id):
+        """ Runs asynchronous export and stores result in export, see request_batches_async
+            The export has the correlation id of the backend request that started it
+        """
+
+        request_context.start(correlation_id)
+
+        dic = {'request': {'type': "GET", 'url': self._base_url+get_url, 'json': None},
+               'response': {'status': 500, 'json': None, 'message': 'Asynchronous export failed'}}
+        start = time.monotonic()
+        try:
+            dic = self._run_export(
+                get_url, priority, Deadline(self._export_timeout))
+        except Exception as e:
+            logger.error('%s | %s | %s', filename,
+                         dic['response']['message'], str(e))
+        finally:
+            METRICS.observe('cdd_export_duration_seconds', time.monotonic() - start,
+                            {'status': str(dic['response']['status'])})
+            with self._exports_lock:
+                export['dic'] = dic
+                export['finished_on'] = time.time()
+                if(dic['response']['status'] != 200 and self._exports.get(get_url) is export):
+                    # Failed exports are never reused, next caller starts a new one
+                    del self._exports[get_url]
+            export['event'].set()
+
+    def _run_export(self, get_url, priority, deadline):
+        """ Starts asynchronous export on CDD, waits until it is finished and downloads it
+
+        Arguments:
+            get_url {string} -- URL without the base, including 'async=true'
+            priority {string} -- INTERACTIVE or BACKGROUND, see rate limiter
+            deadline {Deadline} -- time budget of export
+
+        Returns:
+            {dic} -- discription above ^
+        """
+
+        dic = self.make_get_request(get_url, priority, deadline)
         if(dic['response']['status'] != 200):
             # Asynchronoys request failed, return
             logger.error('%s | %s', filename, dic['response']['message'])
             return dic
+        if(self._invalid_json(dic, ['id', 'status'])):
+            return dic
 
         # ID and status of asynchronous request
         export_id = dic['response']['json']['id']
@@ -199,40 +814,77 @@ class ApiCDD():
         while export_status != 'finished':
             # Check every 1 second if export is 'finished'
             get_url = 'export_progress/'+str(export_id)
-            dic = self.make_get_request(get_url)
+            dic = self.make_get_request(get_url, priority, deadline)
+            METRICS.inc('cdd_export_polls_total')
 
             if(dic['response']['status'] != 200):
                 # Checking the asynchronous request failed, return
                 logger.error('%s | %s', filename,
                              dic['response']['message'])
                 return dic
+            if(self._invalid_json(dic, ['status'])):
+                return dic
 
             # Check status
             export_status = dic['response']['json']['status']
             if(export_status != 'finished'):
-                logger.debug('%s | %s', filename, 'Check request: export_status = %s, sleep for 1 second and recheck' %
-                             export_status)
+                logger.debug('%s | Check request: export_status = %s, sleep for 1 second and recheck',
+                             filename, export_status)
 
-            time.sleep(1)
+            if(export_status != 'finished'):
+                remaining = deadline.remaining()
+                if(remaining is not None and remaining < 1):
+                    # Export takes longer than its time budget, stop checking
+                    return self._deadline_exceeded(dic, deadline)
+                time.sleep(1)
 
         # When export is 'finished', download batches
         # Export request
         get_url = 'exports/'+str(export_id)
-        dic = self.make_get_request(get_url)
+        dic = self.make_get_request(get_url, priority, deadline)
 
         if(dic['response']['status'] != 200):
             # Export request failed, return
             logger.error('%s | %s', filename, dic['response']['message'])
             return dic
+        if(self._invalid_json(dic, ['objects'])):
+            return dic
 
         dic['response']['message'] = 'The cdd-request was successfully completed'
         return dic
 
-    def update_batch(self, id, data):
+    def _copy_response(self, dic):
+        """ Copies request/response dictionary of a shared export, so callers can edit it without affecting each other
+            NOTE: The json data itself is not copied, it must be treated as read-only
+
+        Arguments:
+            dic {dic} -- discription above ^
+
+        Returns:
+            {dic} -- discription above ^
+        """
+
+        return {'request': dict(dic['request']), 'response': dict(dic['response'])}
+
+    @observed
+    def update_batch(self, id, data, priority=INTERACTIVE, deadline=None):
+        """ Function that updates the batch with id in CDD Vault
+
+        Arguments:
+            id {int} -- CDD id of batch
+            data {dic} -- body of request, e.g. {'batch_fields': {'Status': 'Added'}}
+            priority {string} -- INTERACTIVE or BACKGROUND, see rate limiter (default: {INTERACTIVE})
+            deadline {Deadline} -- time budget of request (default: {None})
+
+        Returns:
+            {dic} -- discription above ^
+        """
+
         # Put-URL
         put_url = "batches/" + str(id)
 
-        dic = self.make_put_request(put_url, data)
+        dic = self.make_put_request(
+            put_url, data, priority, deadline=deadline)
 
         if(dic['response']['status'] != 200):
             # Request failed, return
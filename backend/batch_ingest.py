@@ -0,0 +1,123 @@
+import logging
+import re
+
+# Set logging, handlers and levels are set by logging_setup.setup_logging()
+filename = 'batch_ingest.py'
+logger = logging.getLogger(filename)
+
+"""
+    Ingest of batches of CDD: every batch is validated and normalized once, when a snapshot is built (see Snapshot),
+    so routes can use the fields of a batch without checks. A batch that is not valid is quarantined: it is left out
+    of the snapshot and reported with its reasons, see /quarantine.
+
+    Conventions:
+        - a clean batch has:
+            [id]            {int}
+            [projects]      {list}  -- exactly one project {'id': {int}, 'name': {str}}
+            [batch_fields]  {dic}   -- all BATCH_FIELDS, text without surrounding whitespace or None
+        - a batch with a status other than 'Registered' has a location '<project name>-<box>-<position>',
+          see location_string_to_array()
+        - a vial barcode is used by one batch only
+"""
+
+# Fields of batch_fields used by the backend, missing fields are None after ingest
+BATCH_FIELDS = ['Vial barcode', 'Status', 'Location',
+                'Container barcode', 'Container type']
+
+# Location of a vial, e.g. FJM-1-B12, see location_string_to_array()
+LOCATION_PATTERN = re.compile(r'[^-]*-[0-9]+-[A-Z]{1,2}[0-9]+')
+
+
+def ingest_batch(batch):
+    """ Validates and normalizes batch of CDD
+
+    Arguments:
+        batch {dic} -- batch as returned by CDD
+
+    Returns:
+        dic, list -- normalized batch (None if not valid) and reasons why it is not valid
+    """
+
+    if(not isinstance(batch, dict)):
+        return None, ['batch is not an object']
+
+    reasons = []
+    if(type(batch.get('id')) is not int):
+        reasons.append('id {0!r} is not an integer'.format(batch.get('id')))
+
+    projects = batch.get('projects')
+    if(not isinstance(projects, list) or len(projects) != 1):
+        # Batch is assigned to no or different projects, this cannot occur by convention
+        reasons.append('batch is assigned to {0} projects instead of one: {1!r}'.format(
+            len(projects) if isinstance(projects, list) else 0, projects))
+    elif(not isinstance(projects[0], dict) or type(projects[0].get('id')) is not int):
+        reasons.append(
+            'project {0!r} does not have an integer id'.format(projects[0]))
+
+    batch_fields = batch.get('batch_fields') or {}
+    if(not isinstance(batch_fields, dict)):
+        reasons.append('batch_fields is not an object')
+        return None, reasons
+
+    fields = dict(batch_fields)
+    for field in BATCH_FIELDS:
+        value = fields.get(field)
+        if(isinstance(value, (int, float)) and not isinstance(value, bool)):
+            value = str(value)
+        if(isinstance(value, str)):
+            value = value.strip() or None
+        elif(value is not None):
+            reasons.append('{0} {1!r} is not text'.format(field, value))
+        fields[field] = value
+
+    if(fields['Status'] and fields['Status'] != 'Registered' and
+       not (fields['Location'] and LOCATION_PATTERN.fullmatch(fields['Location']))):
+        # Location gives position of vial, e.g. the last location of a project
+        reasons.append('status is \'{0}\', but location {1!r} is not <project>-<box>-<position>'.format(
+            fields['Status'], fields['Location']))
+
+    if(reasons):
+        return None, reasons
+    return dict(batch, projects=[dict(projects[0])], batch_fields=fields), []
+
+
+def ingest_batches(batches):
+    """ Validates and normalizes batches of CDD, see ingest_batch()
+
+    Arguments:
+        batches {list} -- batches as returned by CDD
+
+    Returns:
+        list, list -- clean batches and quarantined batches {'id', 'reasons', 'batch'}
+    """
+
+    clean = []
+    quarantined = []
+    for batch in batches:
+        normalized, reasons = ingest_batch(batch)
+        if(normalized is None):
+            quarantined.append({'id': batch.get('id') if isinstance(batch, dict) else None,
+                                'reasons': reasons, 'batch': batch})
+        else:
+            clean.append(normalized)
+
+    # A barcode of multiple batches can not be looked up, all of them are quarantined
+    ids_by_barcode = {}
+    for batch in clean:
+        if(batch['batch_fields']['Vial barcode']):
+            ids_by_barcode.setdefault(
+                batch['batch_fields']['Vial barcode'], []).append(batch['id'])
+    duplicates = {barcode: ids for barcode,
+                  ids in ids_by_barcode.items() if len(ids) > 1}
+    if(duplicates):
+        unique = []
+        for batch in clean:
+            ids = duplicates.get(batch['batch_fields']['Vial barcode'])
+            if(ids):
+                quarantined.append({'id': batch['id'], 'reasons': ['vial barcode \'{0}\' is used by batches {1}'.format(
+                    batch['batch_fields']['Vial barcode'], ids)], 'batch': batch})
+            else:
+                unique.append(batch)
+        clean = unique
+
+    return clean, quarantined
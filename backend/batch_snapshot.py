@@ -0,0 +1,387 @@
+import bisect
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+from metrics import METRICS
+from batch_ingest import ingest_batches
+
+# Set logging, handlers and levels are set by logging_setup.setup_logging()
+filename = 'batch_snapshot.py'
+logger = logging.getLogger(filename)
+
+# Version of format of persisted snapshot, files of other versions are ignored, see BatchSnapshot.warm_start()
+SNAPSHOT_FILE_VERSION = 1
+
+
+class Snapshot():
+    """ All batches of the vault at one moment, validated and normalized (see batch_ingest.py) and indexed for O(1) lookups
+
+    Arguments:
+            batches {list} -- batches as returned by CDD
+            created_on {float} -- unix timestamp of CDD response (default: {now})
+            warm {bool} -- snapshot is read from disk at start and not yet reconciled with CDD (default: {False})
+
+    Conventions:
+        - batches, by_barcode {dic: barcode > batch}, by_id {dic: id > batch} and by_project {dic: project id > list of batches}
+          must be treated as read-only, use BatchSnapshot.update() to change a batch
+        - batches that are not valid are not in batches and indexes, but in quarantined {list: {'id', 'reasons', 'batch'}}
+    """
+
+    def __init__(self, batches, created_on=None, warm=False):
+        """ Initialized is called when class in created
+        """
+
+        self.created_on = created_on or time.time()
+        self.warm = warm
+        self.batches, self.quarantined = ingest_batches(batches)
+        self.by_barcode = {}
+        self.by_id = {}
+        self.by_project = {}
+        self.positions = {}  # Index of batch in batches by id
+        self._sorted_ids = None  # Ids of batches in order, made by first query()
+        for position, batch in enumerate(self.batches):
+            self.positions[batch['id']] = position
+            self.by_id[batch['id']] = batch
+            barcode = batch['batch_fields']['Vial barcode']
+            if(barcode):
+                self.by_barcode[barcode] = batch
+            self.by_project.setdefault(
+                batch['projects'][0]['id'], []).append(batch)
+
+    def age(self):
+        return time.time() - self.created_on
+
+    def query(self, projects=None, statuses=None, barcodes=None, location=None, after=None, limit=None):
+        """ Returns batches that match all given filters, in order of id
+
+        Keyword Arguments:
+            projects {set} -- ids of projects (default: {None})
+            statuses {set} -- statusses (default: {None})
+            barcodes {list} -- vial barcodes (default: {None})
+            location {string} -- prefix of location, e.g. 'FJM-1-' (default: {None})
+            after {int} -- only batches with a larger id, the cursor of the previous page (default: {None})
+            limit {int} -- maximum number of batches, None is all (default: {None})
+
+        Returns:
+            list, int -- batches and cursor of next page (None if there are no more batches)
+        """
+
+        # Candidates from an index, so a filter on barcode or project does not check all batches
+        if(barcodes is not None):
+            ids = sorted(set(self.by_barcode[barcode]['id']
+                             for barcode in barcodes if barcode in self.by_barcode))
+        elif(projects is not None):
+            ids = sorted(batch['id'] for project in projects
+                         for batch in self.by_project.get(project, []))
+        else:
+            if(self._sorted_ids is None):
+                self._sorted_ids = sorted(self.by_id)
+            ids = self._sorted_ids
+
+        batches = []
+        for index in range(bisect.bisect_right(ids, after) if after is not None else 0, len(ids)):
+            batch = self.by_id[ids[index]]
+            if(projects is not None and batch['projects'][0]['id'] not in projects):
+                continue
+            if(statuses is not None and batch['batch_fields']['Status'] not in statuses):
+                continue
+            if(location is not None and not (batch['batch_fields']['Location'] or '').startswith(location)):
+                continue
+            if(limit is not None and len(batches) == limit):
+                return batches, batches[-1]['id']
+            batches.append(batch)
+        return batches, None
+
+
+class BatchSnapshot():
+    """ Cached snapshot of all batches of the vault, loaded again when it is older than max_age
+
+    Arguments:
+            load {function} -- load(deadline, hedge, priority) returns status, message, batches, cdd_request (see server.fetch_batches)
+            max_age {float} -- seconds a snapshot is used (default: {30})
+            on_change {function} -- on_change(event_type, batch, fields, source) is called for every batch that is
+                                    updated by this backend (source 'submit') or changed in CDD since the previous
+                                    snapshot (source 'refresh'), see ChangeFeed.publish() (default: {None})
+            path {string} -- file the snapshot is persisted to, for warm_start(), None is not persisted (default: {None})
+            persist_interval {float} -- minimum seconds between writes of the file (default: {300})
+            warm_max_age {float} -- seconds after which a persisted snapshot is too old for warm_start() (default: {24 hours})
+            source {string} -- vault of snapshot (e.g. its url), a persisted snapshot of another vault is not used (default: {None})
+
+    Conventions:
+        - only one thread loads the snapshot, other threads wait for it
+        - batches that are updated by this backend are updated in the snapshot right away (see update())
+        - the persisted snapshot is gzipped json {'version': SNAPSHOT_FILE_VERSION, 'source': {str}, 'createdOn': {float},
+          'batches': {list}} with clean and quarantined batches, written in background after a load and replaced atomically
+    """
+
+    def __init__(self, load, max_age=30, on_change=None, path=None, persist_interval=300, warm_max_age=24*3600, source=None):
+        """ Initialized is called when class in created
+        """
+
+        self._load = load
+        self._max_age = max_age
+        self._on_change = on_change
+        self._path = path
+        self._persist_interval = persist_interval
+        self._warm_max_age = warm_max_age
+        self._source = source
+        self._persisted_on = 0
+        self._persisting = False
+        self._snapshot = None
+        self._updates = []  # Recent updates [time, batch_id, batch_fields], applied again to a snapshot that was loading
+        self._lock = threading.Lock()  # Protects self._snapshot and self._updates
+        self._load_lock = threading.Lock()  # Only one load at a time
+
+    def get(self, deadline=None, hedge=False, priority=None, max_age=None, warm=True):
+        """ Returns snapshot, loads it when it is too old
+
+        Keyword Arguments:
+            deadline {Deadline} -- time budget of load (default: {None})
+            hedge {bool} -- hedge CDD request of load (default: {False})
+            priority {string} -- priority of CDD request of load, None is default of load (default: {None})
+            max_age {float} -- maximum age in seconds, None is max_age of object (default: {None})
+            warm {bool} -- a warm snapshot (see warm_start()) may be returned, else waits until it is reconciled (default: {True})
+
+        Returns:
+            int, string, Snapshot, dic -- status, message, snapshot (None if failed) and cdd-request (None if success)
+        """
+
+        max_age = self._max_age if max_age is None else max_age
+        snapshot = self._snapshot
+        if(self._usable(snapshot, max_age, warm)):
+            METRICS.inc('batch_snapshot_hits_total')
+            return 200, 'All requests successfully completed.', snapshot, None
+
+        with self._load_lock:
+            snapshot = self._snapshot
+            if(self._usable(snapshot, max_age, warm)):
+                # Loaded (or reconciled) by other thread while waiting
+                METRICS.inc('batch_snapshot_hits_total')
+                return 200, 'All requests successfully completed.', snapshot, None
+
+            return self._reload(deadline, hedge, priority)
+
+    def _usable(self, snapshot, max_age, warm):
+        return snapshot is not None and (snapshot.age() <= max_age or (warm and snapshot.warm))
+
+    def _reload(self, deadline, hedge, priority):
+        """ Loads snapshot and makes it the current snapshot, load lock must be held
+
+        Returns:
+            int, string, Snapshot, dic -- see get()
+        """
+
+        METRICS.inc('batch_snapshot_misses_total')
+        kwargs = {'deadline': deadline, 'hedge': hedge}
+        if(priority):
+            kwargs['priority'] = priority
+        start = time.time()
+        status, message, batches, cdd_request = self._load(**kwargs)
+        if(status != 200):
+            return status, message, None, cdd_request
+
+        snapshot = Snapshot(batches, created_on=start)
+        self._install(snapshot)
+        logger.info('%s | Loaded snapshot of %s batches in %.2f seconds', filename, len(batches), time.time() - start)
+
+        if(self._path and not self._persisting and time.time() - self._persisted_on >= self._persist_interval):
+            self._persisting = True
+            threading.Thread(target=self._persist, args=(snapshot,),
+                             name='snapshot-persist', daemon=True).start()
+
+        return 200, message, snapshot, None
+
+    def warm_start(self, deadline=None, priority=None):
+        """ Makes persisted snapshot the current snapshot, and reconciles it with CDD in background. get() returns the
+            persisted snapshot (whatever its age) until it is reconciled, or until reconciling failed
+
+        Keyword Arguments:
+            deadline {Deadline} -- time budget of reconciling (default: {None})
+            priority {string} -- priority of CDD request of reconciling (default: {None})
+
+        Returns:
+            bool -- True if persisted snapshot is used
+        """
+
+        snapshot = self._read_persisted()
+        if(snapshot is None):
+            return False
+
+        snapshot.warm = True
+        self._install(snapshot)
+        threading.Thread(target=self._reconcile, args=(deadline, priority),
+                         name='snapshot-reconcile', daemon=True).start()
+        return True
+
+    def _reconcile(self, deadline, priority):
+        with self._load_lock:
+            warm_snapshot = self._snapshot
+            try:
+                status, message, _, _ = self._reload(
+                    deadline, False, priority)
+            except Exception as e:
+                status, message = 500, str(e)
+            if(status != 200):
+                logger.warning('%s | Reconciling persisted snapshot failed, it is loaded again by next request: %s',
+                               filename, message)
+            # Next get() loads snapshot, when it is not replaced
+            warm_snapshot.warm = False
+
+    def _read_persisted(self):
+        """ Returns persisted snapshot, None if there is none or it is not valid or too old
+        """
+
+        if(not self._path or not os.path.isfile(self._path)):
+            return None
+        start = time.time()
+        try:
+            with open(self._path, 'rb') as snapshot_file:
+                data = json.loads(gzip.decompress(snapshot_file.read()))
+            if(data.get('version') != SNAPSHOT_FILE_VERSION):
+                logger.warning('%s | Persisted snapshot has version %s instead of %s, not used',
+                               filename, data.get('version'), SNAPSHOT_FILE_VERSION)
+                return None
+            if(data.get('source') != self._source):
+                logger.info('%s | %s', filename,
+                            'Persisted snapshot is of other vault, not used')
+                return None
+            if(time.time() - data['createdOn'] > self._warm_max_age):
+                logger.info('%s | %s', filename,
+                            'Persisted snapshot is too old, not used')
+                return None
+            snapshot = Snapshot(data['batches'], created_on=data['createdOn'])
+        except Exception as e:
+            logger.warning('%s | Persisted snapshot can not be read, not used: %s', filename, e)
+            return None
+
+        logger.info('%s | Read persisted snapshot of %s batches (%.0f seconds old) in %.2f seconds',
+                    filename, len(snapshot.batches), snapshot.age(), time.time() - start)
+        return snapshot
+
+    def _persist(self, snapshot):
+        """ Writes snapshot to file, via a temporary file so readers never see a partial file
+        """
+
+        try:
+            data = gzip.compress(json.dumps({'version': SNAPSHOT_FILE_VERSION, 'source': self._source, 'createdOn': snapshot.created_on,
+                                             'batches': list(snapshot.batches) + [quarantined['batch'] for quarantined in snapshot.quarantined]},
+                                            separators=(',', ':')).encode('utf-8'),
+                                 compresslevel=1)
+            temporary_path = '%s.%s.tmp' % (self._path, os.getpid())
+            with open(temporary_path, 'wb') as snapshot_file:
+                snapshot_file.write(data)
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.replace(temporary_path, self._path)
+            self._persisted_on = time.time()
+        except Exception as e:
+            logger.error('%s | Persisting snapshot failed: %s', filename, e)
+        finally:
+            self._persisting = False
+
+    def _install(self, snapshot, publish=True):
+        """ Makes snapshot the current snapshot, and publishes changes since the previous snapshot (when publish)
+        """
+
+        with self._lock:
+            previous = self._snapshot
+            self._snapshot = snapshot
+            # Updates made while loading may not be in the response of CDD
+            self._updates = [update for update in self._updates
+                             if update[0] >= snapshot.created_on]
+            for _, batch_id, batch_fields in self._updates:
+                self._update(snapshot, batch_id, batch_fields)
+
+        if(self._on_change and previous and publish):
+            self._publish_changes(previous, snapshot)
+        self._report_quarantine(previous, snapshot)
+
+    def _report_quarantine(self, previous, snapshot):
+        """ Logs batches that are quarantined since previous snapshot, see batch_ingest.py
+        """
+
+        previous_ids = set(quarantined['id'] for quarantined in previous.quarantined) if previous else set()
+        new = [quarantined for quarantined in snapshot.quarantined
+               if quarantined['id'] not in previous_ids]
+        if(new):
+            reasons = '; '.join('batch %s: %s' % (quarantined['id'], ', '.join(quarantined['reasons']))
+                                for quarantined in new[:10])
+            logger.warning('%s | %s batch(es) quarantined (%s in total, see /quarantine): %s',
+                           filename, len(new), len(snapshot.quarantined), reasons)
+
+    def quarantined(self):
+        """ Returns quarantined batches of current snapshot, see Snapshot, without loading it
+        """
+
+        snapshot = self._snapshot
+        return snapshot.quarantined if snapshot is not None else []
+
+    def update(self, batch_id, batch_fields):
+        """ Updates fields of batch in current snapshot, after it is updated in CDD (or journal)
+        """
+
+        with self._lock:
+            self._updates.append([time.time(), batch_id, batch_fields])
+            if(self._snapshot is not None):
+                self._update(self._snapshot, batch_id, batch_fields)
+                batch = self._snapshot.by_id.get(batch_id)
+                if(self._on_change and batch):
+                    self._on_change('update', batch, batch_fields, 'submit')
+
+    def _publish_changes(self, previous, snapshot):
+        """ Calls on_change for batches that are added, changed or removed in snapshot since previous snapshot
+        """
+
+        for batch in snapshot.batches:
+            old_batch = previous.by_id.get(batch['id'])
+            if(old_batch is None):
+                self._on_change('update', batch, batch['batch_fields'], 'refresh')
+                continue
+            fields = {key: value for key, value in batch['batch_fields'].items()
+                      if old_batch['batch_fields'].get(key) != value}
+            if(fields):
+                self._on_change('update', batch, fields, 'refresh')
+
+        for batch_id, old_batch in previous.by_id.items():
+            if(batch_id not in snapshot.by_id):
+                self._on_change('remove', old_batch, {}, 'refresh')
+
+    def _update(self, snapshot, batch_id, batch_fields):
+        """ Replaces batch in snapshot by copy with updated fields, lock must be held
+        """
+
+        if(batch_id not in snapshot.by_id):
+            return
+
+        old_batch = snapshot.by_id[batch_id]
+        batch = dict(old_batch, batch_fields=dict(
+            old_batch['batch_fields'], **batch_fields))
+
+        # Replace batch in list and indexes, readers see either the old or the new batch
+        snapshot.batches[snapshot.positions[batch_id]] = batch
+        snapshot.by_id[batch_id] = batch
+        old_barcode = old_batch['batch_fields'].get('Vial barcode')
+        if(old_barcode and snapshot.by_barcode.get(old_barcode) is old_batch):
+            del snapshot.by_barcode[old_barcode]
+        if(batch['batch_fields'].get('Vial barcode')):
+            snapshot.by_barcode[batch['batch_fields']
+                                ['Vial barcode']] = batch
+        for project in batch['projects']:
+            project_batches = snapshot.by_project.get(project['id'], [])
+            for i, project_batch in enumerate(project_batches):
+                if(project_batch is old_batch):
+                    project_batches[i] = batch
+
+    def invalidate(self):
+        """ Marks snapshot as too old, next get() loads it again
+        """
+
+        with self._lock:
+            if(self._snapshot is not None):
+                # Keep snapshot, so the next snapshot is compared with it
+                self._snapshot.created_on = 0
+                self._snapshot.warm = False
@@ -0,0 +1,285 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+import jwt
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from fake_cdd import FakeVault
+
+"""
+    Benchmarks of the hot paths of the backend, against synthetic vaults (see fake_cdd.FakeVault):
+        - location_string_to_array and get_last_location_from_batches
+        - /getlocation (snapshot loaded and not loaded) and /submitdata through the Flask test client, with StubApiCDD
+        - make_response_object serialization of all batches
+        - token_required overhead
+
+    Usage:
+        python benchmark.py                     -- run all benchmarks (vaults of 1k, 10k and 100k batches)
+        python benchmark.py --save              -- run and store results as baselines
+        python benchmark.py --check --quick     -- run (1k and 10k) and fail when slower than the baselines
+
+    Conventions:
+        - results are the fastest seconds per call
+        - baselines (benchmark_baselines.json) are made on the machine that checks them and are not committed, a
+          calibration loop is stored with them and results are scaled by the speed of the machine at the check
+        - the backend runs in a temporary directory with its own settings, keys and databases, the directory is
+          removed afterwards
+        - a project has a fifth of the batches of a vault, so per-project benchmarks grow with the vault
+"""
+
+BASELINES_FILE = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'benchmark_baselines.json')
+
+# Sizes of synthetic vaults
+SIZES = [1000, 10000, 100000]
+QUICK_SIZES = [1000, 10000]
+
+# Projects of synthetic vaults, so the batches of a project grow with the size of the vault
+PROJECTS = 5
+
+# Number of times benchmarks run again, before slower results are reported as regression
+CHECK_RETRIES = 2
+
+# Number of items of a /submitdata benchmark
+SUBMIT_ITEMS = 10
+
+
+class StubApiCDD():
+    """ Replaces ApiCDD of server, answers from a FakeVault without network
+    """
+
+    def __init__(self, vault):
+        """ Initialized is called when class in created
+        """
+
+        self._vault = vault
+
+    def _dic(self, method, url, json_data, status=200):
+        return {'request': {'type': method, 'url': url, 'json': None},
+                'response': {'status': status, 'json': json_data, 'message': 'The cdd-request was successfully completed'}}
+
+    def request_projects(self, *args, **kwargs):
+        return self._dic('GET', 'projects/', self._vault.projects)
+
+    def request_batches(self, force_async=False, priority=None, deadline=None, hedge=False, reuse_export=True, **kwargs):
+        project_ids = [int(kwargs['projects'])] if kwargs.get(
+            'projects') else None
+        objects = self._vault.query(project_ids)
+        return self._dic('GET', 'batches/', {'count': len(objects), 'page_size': len(objects), 'objects': objects})
+
+    def update_batch(self, id, data, priority=None, deadline=None):
+        return self._dic('PUT', 'batches/%s' % id, self._vault.update(id, data))
+
+
+def measure(function, min_time=0.5, min_repeat=5, max_repeat=1000):
+    """ Returns fastest seconds of function(), called until min_time seconds have passed (at least min_repeat times),
+        the fastest call is the least disturbed by other processes (as timeit)
+    """
+
+    durations = []
+    start = time.perf_counter()
+    while len(durations) < max_repeat and (len(durations) < min_repeat or time.perf_counter() - start < min_time):
+        call_start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - call_start)
+    return min(durations)
+
+
+def calibrate():
+    """ Returns fastest seconds of a fixed pure-python workload, the speed of this machine
+    """
+
+    def workload():
+        total = 0
+        for i in range(200000):
+            total += i % 7
+        return total
+
+    return measure(workload, min_repeat=10)
+
+
+@contextlib.contextmanager
+def make_workspace(settings=None):
+    """ Creates temporary directory with settings, requirements and keys of the backend and changes to it, the
+        directory is removed and the working directory is restored when the context ends
+
+    Keyword Arguments:
+        settings {dic} -- settings of backend, added to the settings of the benchmark (default: {None})
+
+    Yields:
+        string -- path of directory
+    """
+
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='zobioweb-benchmark-') as directory:
+        os.mkdir(os.path.join(directory, 'ssl'))
+        os.chdir(directory)
+        try:
+            private_key = rsa.generate_private_key(
+                public_exponent=65537, key_size=2048, backend=default_backend())
+            with open('ssl/private_key.pem', 'wb') as key_file:
+                key_file.write(private_key.private_bytes(encoding=serialization.Encoding.PEM,
+                                                         format=serialization.PrivateFormat.PKCS8,
+                                                         encryption_algorithm=serialization.NoEncryption()))
+            with open('ssl/requirements.txt', 'w') as requirements_file:
+                json.dump({'cdd_vault_id': 1, 'cdd_token': 'benchmark', 'secret_key': 'benchmark',
+                           'service_account_pwd': 'benchmark'}, requirements_file)
+            with open('settings.json', 'w') as settings_file:
+                json.dump(dict({'ssl_directory': './ssl/', 'print_directory': './print/', 'journal_mode': 'off',
+                                'logging': {'level': 'WARNING'}}, **(settings or {})), settings_file)
+            yield directory
+        finally:
+            os.chdir(working_directory)
+
+
+def run(sizes):
+    """ Runs all benchmarks for vaults of sizes in the current directory (see make_workspace()), returns {name: seconds}
+    """
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import server
+    server.create_app()
+    from box_functions_9x9 import location_string_to_array, get_last_location_from_batches
+
+    client = server.app.test_client()
+    token = jwt.encode({'user': 'benchmark', 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)},
+                       server.app.config['SECRET_KEY'])
+    headers = {'Token': token.decode() if isinstance(token, bytes) else token}
+
+    results = {}
+    for size in sizes:
+        vault = FakeVault(size, projects=PROJECTS)
+        server.ApiCdd = StubApiCDD(vault)
+        server.BATCH_SNAPSHOT.invalidate()
+        batches = vault.query()
+        project = vault.projects[0]
+        project_batches = vault.query([project['id']])
+        located = [batch for batch in batches if batch['batch_fields']['Location']]
+        barcode = batches[size // 2]['batch_fields']['Vial barcode']
+        checked_in = [batch for batch in batches
+                      if batch['batch_fields']['Status'] == 'Checked in'][:SUBMIT_ITEMS]
+
+        def parse_locations():
+            for batch in located:
+                location_string_to_array(batch['batch_fields']['Location'])
+
+        def get_location():
+            response = client.post('/getlocation', headers=headers, json={'type': 'Check-out', 'project': project,
+                                                                          'barcode': barcode})
+            assert response.status_code == 200, response.json
+
+        def get_location_cold():
+            server.BATCH_SNAPSHOT.invalidate()
+            get_location()
+
+        def submit_data():
+            # Check out and check in again, so every call changes the batches
+            for scan_type in ['Check-out', 'Check-in']:
+                items = [{'barcode': batch['batch_fields']['Vial barcode'], 'project': batch['projects'][0], 'box': 1,
+                          'poslabel': 'A1', 'fullname': 'benchmark', 'containerbarcode': None, 'containertype': None}
+                         for batch in checked_in]
+                response = client.post(
+                    '/submitdata', headers=headers, json={'type': scan_type, 'data': items})
+                assert response.status_code == 200, response.json
+
+        def serialize():
+            with server.app.test_request_context('/batches'):
+                server.make_response_object(
+                    200, 'benchmark', output={'batches': batches}).get_data()
+
+        protected = server.token_required(lambda: 'ok')
+
+        def check_token():
+            with server.app.test_request_context('/', headers=headers):
+                protected()
+
+        benchmarks = [('location_string_to_array', parse_locations),
+                      ('get_last_location_from_batches', lambda: get_last_location_from_batches(
+                          project_batches, project['name'])),
+                      ('getlocation', get_location),
+                      ('getlocation_cold', get_location_cold),
+                      ('submitdata', submit_data),
+                      ('make_response_object', serialize),
+                      ('token_required', check_token)]
+        for name, function in benchmarks:
+            results['%s[%s]' % (name, size)] = measure(function)
+            print('%-45s %10.3f ms' % ('%s[%s]' % (name, size),
+                                       results['%s[%s]' % (name, size)] * 1000))
+
+    return results
+
+
+def check(results, baselines, tolerance):
+    """ Compares results with baselines, scaled by speed of machine, returns names of regressions
+    """
+
+    scale = calibrate() / baselines['calibration']
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        baseline = baselines['results'].get(name)
+        if(baseline is None):
+            continue
+        ratio = seconds / (baseline * scale)
+        flag = 'REGRESSION' if ratio > 1 + tolerance else 'ok'
+        print('%-45s %10.3f ms  baseline %10.3f ms  x%.2f  %s' %
+              (name, seconds * 1000, baseline * scale * 1000, ratio, flag))
+        if(flag != 'ok'):
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the hot paths of the backend')
+    parser.add_argument('--quick', action='store_true',
+                        help='only vaults of %s batches' % QUICK_SIZES)
+    parser.add_argument('--save', action='store_true',
+                        help='store results as baselines')
+    parser.add_argument('--check', action='store_true',
+                        help='compare with baselines, exit code 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed slowdown as fraction of baseline')
+    args = parser.parse_args()
+
+    with make_workspace():
+        results = run(QUICK_SIZES if args.quick else SIZES)
+
+        if(args.save):
+            baselines = {'calibration': calibrate(), 'results': results}
+            if(args.quick and os.path.isfile(BASELINES_FILE)):
+                # Keep baselines of sizes that did not run
+                with open(BASELINES_FILE) as baselines_file:
+                    old_baselines = json.load(baselines_file)
+                baselines['results'] = dict(old_baselines['results'], **results)
+            with open(BASELINES_FILE, 'w') as baselines_file:
+                json.dump(baselines, baselines_file, indent=2, sort_keys=True)
+            print('> Baselines stored in %s' % BASELINES_FILE)
+
+        if(args.check):
+            if(not os.path.isfile(BASELINES_FILE)):
+                print('> No baselines, run: python benchmark.py --save')
+                sys.exit(1)
+            with open(BASELINES_FILE) as baselines_file:
+                baselines = json.load(baselines_file)
+            regressions = check(results, baselines, args.tolerance)
+            for attempt in range(CHECK_RETRIES):
+                if(not regressions):
+                    break
+                # Run again to rule out noise, the fastest result of all runs counts
+                print('> Run again to confirm: %s' % ', '.join(regressions))
+                results = {name: min(seconds, results[name])
+                           for name, seconds in run(QUICK_SIZES if args.quick else SIZES).items()}
+                regressions = check(results, baselines, args.tolerance)
+            if(regressions):
+                print('> %s benchmark(s) slower than baseline: %s' %
+                      (len(regressions), ', '.join(regressions)))
+                sys.exit(1)
+            print('> No regressions')
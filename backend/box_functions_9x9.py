@@ -1,13 +1,8 @@
 import logging
 
-# Set logging
+# Set logging, handlers and levels are set by logging_setup.setup_logging()
 filename = 'box_functions_9x9.py'
 logger = logging.getLogger(filename)
-logger.setLevel(level=logging.INFO)  # When debugging put to loggin.DEBUG
-formatter = logging.Formatter("%(levelname)s | %(message)s")
-ch = logging.StreamHandler()
-ch.setFormatter(formatter)
-logger.addHandler(ch)
 
 
 def location_string_to_array(location):
@@ -109,8 +104,8 @@ def map_pos_string_to_interger(pos):
     col = pos[number_of_row_char:]
     col_index = int(col)
 
-    logger.debug('{0} | ({1},{2}) > ({3},{4})'.format(
-        filename, row, col, row_index, col_index))
+    logger.debug('%s | (%s,%s) > (%s,%s)', filename,
+                 row, col, row_index, col_index)
     return row_index, col_index
 
 
@@ -149,35 +144,28 @@ def latest_location(location, last_location):
     box, row, col = location
     last_box, last_row, last_col = last_location
 
-    logger.debug('{0} | get_latest_location({1},{2})'.format(
-        filename, location, last_location))
+    logger.debug('%s | get_latest_location(%s,%s)',
+                 filename, location, last_location)
 
     if(box < last_box):
-        logger.debug('{0} | box < last_box'.format(
-            filename))
+        logger.debug('%s | box < last_box', filename)
         # box is below last_box, do not change anything
-        logger.debug('{0} | >1 return {1}'.format(
-            filename, last_location))
+        logger.debug('%s | >1 return %s', filename, last_location)
         return last_box, last_row, last_col
 
     elif(box == last_box):
-        logger.debug('{0} | boxes equal'.format(
-            filename))
+        logger.debug('%s | boxes equal', filename)
         # box number the same
         if(row < last_row):
             # row is below last_row, do not change anything
-            logger.debug('{0} | >2 return {1}'.format(
-                filename, last_location))
+            logger.debug('%s | >2 return %s', filename, last_location)
             return last_box, last_row, last_col
         if(row == last_row):
-            logger.debug('{0} | rows equal'.format(
-                filename))
+            logger.debug('%s | rows equal', filename)
             if(col < last_col):
                 # col is below last_col, do not change anything
-                logger.debug('{0} | >3 return {1}'.format(
-                    filename, last_location))
+                logger.debug('%s | >3 return %s', filename, last_location)
                 return last_box, last_row, last_col
 
-    logger.debug('{0} | >4 return {1}'.format(
-        filename, location))
+    logger.debug('%s | >4 return %s', filename, location)
     return box, row, col
@@ -0,0 +1,90 @@
+import collections
+import threading
+import time
+
+
+def make_event(event_type, batch, fields, source):
+    """ Returns event of batch {dic} with changed fields {dic}, without seq, see ChangeFeed
+    """
+
+    return {'type': event_type, 'batchId': batch['id'], 'barcode': batch['batch_fields'].get('Vial barcode'),
+            'projectIds': [project['id'] for project in batch['projects']], 'fields': fields, 'source': source,
+            'createdOn': time.time()}
+
+
+class ChangeFeed():
+    """ Feed of changes of batches, clients wait for the events after the last event they have seen (see /feed)
+
+    Arguments:
+            history {int} -- number of events that are kept, a client that missed more events must reload (default: {1000})
+
+    Conventions:
+        - all events are a dictionary with keys:
+            [seq]           {int}      -- sequence number of event
+            [type]          {str}      -- 'update' (batch added or changed) or 'remove' (batch no longer in vault)
+            [batchId]       {int}      -- CDD id of batch
+            [barcode]       {str}      -- vial barcode of batch
+            [projectIds]    {list}     -- ids of projects of batch
+            [fields]        {dic}      -- changed batch fields with their new value, all fields of an added batch
+            [source]        {str}      -- 'submit' (update by this backend) or 'refresh' (difference with CDD)
+            [createdOn]     {float}    -- unix timestamp
+        - seq starts at 1 when the process starts, in multi-worker mode events are shared, see SharedChangeFeed
+    """
+
+    def __init__(self, history=1000):
+        """ Initialized is called when class in created
+        """
+
+        self._condition = threading.Condition()
+        self._seq = 0
+        self._history = collections.deque(maxlen=history)
+        self._listeners = 0
+
+    def publish(self, event_type, batch, fields, source):
+        """ Adds event of batch {dic} with changed fields {dic} and wakes up waiting clients
+        """
+
+        event = make_event(event_type, batch, fields, source)
+        with self._condition:
+            self._seq += 1
+            self._history.append(dict(event, seq=self._seq))
+            self._condition.notify_all()
+
+    def last_seq(self):
+        with self._condition:
+            return self._seq
+
+    def wait(self, last_seq, timeout):
+        """ Returns events after last_seq, waits at most timeout seconds when there are none
+
+        Returns:
+            list, bool, int -- events, True if events after last_seq are no longer kept (client must reload)
+                               and seq of last event
+        """
+
+        with self._condition:
+            if(last_seq > self._seq):
+                # Seq of previous process, client must reload
+                return [], True, self._seq
+            self._condition.wait_for(lambda: self._seq > last_seq, timeout)
+            missed = bool(self._history) and self._history[0]['seq'] > last_seq + 1
+            events = [event for event in self._history if event['seq'] > last_seq]
+            return events, missed, self._seq
+
+    def listen(self):
+        """ Registers listening client, call unlisten() when it stops
+        """
+
+        with self._condition:
+            self._listeners += 1
+
+    def unlisten(self):
+        with self._condition:
+            self._listeners -= 1
+
+    def listeners(self):
+        """ Returns number of listening clients
+        """
+
+        with self._condition:
+            return self._listeners
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+
+"""
+    Configuration of the backend, loaded when it is first needed (not when a module is imported):
+        settings.json               -- settings, see README.md
+        <ssl_directory>/requirements.txt  -- secrets: cdd_vault_id, cdd_token, secret_key, service_account_pwd
+        <ssl_directory>/private_key.pem   -- private key of login, see generate_keys.py
+
+    The file of settings is 'settings.json' in the working directory, or the file of environment variable
+    ZOBIOWEB_SETTINGS. A missing file or key raises ConfigError with what is missing.
+"""
+
+# Keys that must be in settings.json
+REQUIRED_SETTINGS = {'ssl_directory': 'directory of public_key.pem, private_key.pem and requirements.txt',
+                     'print_directory': 'directory where print files must be stored'}
+
+# Keys that must be in requirements.txt
+REQUIRED_REQUIREMENTS = ['cdd_vault_id',
+                         'cdd_token', 'secret_key', 'service_account_pwd']
+
+_lock = threading.Lock()
+_config = None
+_private_key = None
+
+
+class ConfigError(Exception):
+    """ Configuration is missing or not valid
+    """
+
+
+def load_config(settings_file=None):
+    """ Reads and validates settings and requirements
+
+    Keyword Arguments:
+        settings_file {string} -- file of settings, None is ZOBIOWEB_SETTINGS or 'settings.json' (default: {None})
+
+    Returns:
+        dic -- {'settings': {dic}, 'requirements': {dic}}
+    """
+
+    settings_file = settings_file or os.environ.get(
+        'ZOBIOWEB_SETTINGS', 'settings.json')
+    if(not os.path.isfile(settings_file)):
+        raise ConfigError('please create %s file with keys:\n%s' % (settings_file, '\n'.join(
+            '* %s - %s' % item for item in REQUIRED_SETTINGS.items())))
+    try:
+        with open(settings_file) as file:
+            settings = json.load(file)
+    except ValueError as e:
+        raise ConfigError('%s is not valid json: %s' % (settings_file, e))
+    missing = [key for key in REQUIRED_SETTINGS if key not in settings]
+    if(missing):
+        raise ConfigError('%s misses keys: %s' %
+                          (settings_file, ', '.join(missing)))
+
+    requirements_file = os.path.join(
+        settings['ssl_directory'], 'requirements.txt')
+    try:
+        with open(requirements_file) as file:
+            requirements = json.load(file)
+    except (OSError, ValueError) as e:
+        raise ConfigError('%s can not be read: %s' % (requirements_file, e))
+    missing = [key for key in REQUIRED_REQUIREMENTS if key not in requirements]
+    if(missing):
+        raise ConfigError('%s misses keys: %s' %
+                          (requirements_file, ', '.join(missing)))
+
+    return {'settings': settings, 'requirements': requirements}
+
+
+def get_config():
+    """ Returns configuration, it is loaded at the first call, see load_config()
+    """
+
+    global _config
+    with _lock:
+        if(_config is None):
+            _config = load_config()
+        return _config
+
+
+def set_config(config):
+    """ Sets configuration, e.g. the one create_app() of server loaded from another file
+    """
+
+    global _config, _private_key
+    with _lock:
+        _config = config
+        _private_key = None
+
+
+def get_private_key():
+    """ Returns private key of login (PEM bytes), it is read at the first call
+    """
+
+    global _private_key
+    settings = get_config()['settings']
+    with _lock:
+        if(_private_key is None):
+            key_file_name = os.path.join(
+                settings['ssl_directory'], 'private_key.pem')
+            try:
+                with open(key_file_name, 'rb') as key_file:
+                    _private_key = key_file.read()
+            except OSError as e:
+                raise ConfigError('%s can not be read: %s' %
+                                  (key_file_name, e))
+        return _private_key
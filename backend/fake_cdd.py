@@ -0,0 +1,303 @@
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+"""
+    Local simulator of the CDD Vault API, implements the endpoints ApiCDD uses:
+        GET     /api/v1/vaults/<vault id>/projects/
+        GET     /api/v1/vaults/<vault id>/batches/?page_size=&offset=&projects=&async=true
+        GET     /api/v1/vaults/<vault id>/export_progress/<export id>
+        GET     /api/v1/vaults/<vault id>/exports/<export id>
+        PUT     /api/v1/vaults/<vault id>/batches/<batch id>
+
+    Usage:
+        python fake_cdd.py --batches 20000 --latency 0.05 --error-rate 0.01 --export-seconds 5
+        and set "cdd_base_url": "http://localhost:8765/api/v1/vaults/1/" in settings.json
+
+    Conventions:
+        - the vault is synthetic and kept in memory, see FakeVault
+        - every response is delayed by latency (+/- jitter) seconds, a fraction error_rate of the requests fails with
+          error_status (with 'Retry-After' header when retry_after is given)
+        - an asynchronous export is finished export_seconds after it is started
+"""
+
+# Set logging, handlers and levels are set by logging_setup.setup_logging()
+filename = 'fake_cdd.py'
+logger = logging.getLogger(filename)
+
+# Default fault injection of FakeCDDServer
+DEFAULT_FAULTS = {'latency': 0.0, 'jitter': 0.0, 'error_rate': 0.0, 'error_status': 503,
+                  'retry_after': None, 'export_seconds': 2.0}
+
+# Maximum page size of a synchronous batches request, as CDD
+MAX_PAGE_SIZE = 1000
+
+# Seconds an export can be downloaded
+EXPORT_RETENTION = 600
+
+# Statusses of synthetic batches, with their fraction of the vault
+STATUSSES = [('Registered', 0.4), ('Added', 0.3),
+             ('Checked in', 0.2), ('Checked out', 0.1)]
+
+
+class FakeVault():
+    """ Synthetic vault with projects and batches
+
+    Arguments:
+            batches {int} -- number of batches (default: {1000})
+            projects {int} -- number of projects, batches are spread over them (default: {5})
+            seed {int} -- seed of random generator, the same seed gives the same vault (default: {0})
+
+    Conventions:
+        - batches have the batch fields 'Vial barcode', 'Status', 'Location', 'Container barcode' and 'Container type',
+          batches that are not 'Registered' are placed in 9x9 boxes of their project, in order
+    """
+
+    def __init__(self, batches=1000, projects=5, seed=0):
+        """ Initialized is called when class in created
+        """
+
+        generator = random.Random(seed)
+        self.lock = threading.Lock()
+        self.projects = [{'id': 1000 + i, 'name': 'PRJ%s' % (i + 1)}
+                         for i in range(projects)]
+        self.batches = []
+        self.by_id = {}
+        self.exports = {}
+        self._export_seq = 0
+
+        positions = {project['id']: 0 for project in self.projects}
+        for i in range(batches):
+            project = self.projects[i % projects]
+            status = generator.choices([status for status, _ in STATUSSES],
+                                       [fraction for _, fraction in STATUSSES])[0]
+            location = None
+            if(status != 'Registered'):
+                position = positions[project['id']]
+                positions[project['id']] += 1
+                box, pos = divmod(position, 81)
+                location = '%s-%s-%s%s' % (project['name'], box + 1,
+                                           chr(65 + pos // 9), pos % 9 + 1)
+            batch = {'id': 500000 + i, 'class': 'batch', 'name': 'ZB-%06d' % i,
+                     'projects': [dict(project)],
+                     'batch_fields': {'Vial barcode': 'VB%08d' % i, 'Status': status, 'Location': location,
+                                      'Container barcode': None, 'Container type': None}}
+            self.batches.append(batch)
+            self.by_id[batch['id']] = batch
+
+    def query(self, project_ids=None):
+        """ Returns copies of batches, only of projects with ids {list} when given
+        """
+
+        with self.lock:
+            return [json.loads(json.dumps(batch)) for batch in self.batches
+                    if project_ids is None or batch['projects'][0]['id'] in project_ids]
+
+    def update(self, batch_id, data):
+        """ Updates batch fields of batch, returns batch, None if it does not exist
+        """
+
+        with self.lock:
+            batch = self.by_id.get(batch_id)
+            if(batch is None):
+                return None
+            batch['batch_fields'].update(data.get('batch_fields', {}))
+            return json.loads(json.dumps(batch))
+
+    def start_export(self, objects):
+        """ Stores objects as export, returns id of export, exports older than EXPORT_RETENTION seconds are removed
+        """
+
+        with self.lock:
+            now = time.time()
+            for export_id in [export_id for export_id, export in self.exports.items()
+                              if now - export['startedOn'] > EXPORT_RETENTION]:
+                del self.exports[export_id]
+            self._export_seq += 1
+            self.exports[self._export_seq] = {
+                'startedOn': time.time(), 'objects': objects}
+            return self._export_seq
+
+
+class FakeCDDHandler(BaseHTTPRequestHandler):
+    """ Handles requests of ApiCDD, see conventions of module
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug('%s | ' + format, filename, *args)
+
+    def _send(self, status, data=None, headers=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _prepare(self):
+        """ Injects latency and errors, checks token and returns path below vault and query, None if request is answered
+        """
+
+        faults = self.server.faults
+        time.sleep(max(faults['latency'] + random.uniform(-faults['jitter'], faults['jitter']), 0))
+
+        if(self.server.token is not None and self.headers.get('X-CDD-token') != self.server.token):
+            self._send(401, {'error': 'Unauthorized'})
+            return None
+        if(random.random() < faults['error_rate']):
+            headers = {'Retry-After': faults['retry_after']
+                       } if faults['retry_after'] is not None else None
+            self._send(faults['error_status'], {
+                       'error': 'Injected failure'}, headers)
+            return None
+
+        url = urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        if(len(parts) < 5 or parts[:3] != ['api', 'v1', 'vaults']):
+            self._send(404, {'error': 'Not Found'})
+            return None
+        return parts[4:], {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+    def do_GET(self):
+        prepared = self._prepare()
+        if(prepared is None):
+            return
+        (resource, *rest), query = prepared
+        vault = self.server.vault
+
+        if(resource == 'projects'):
+            self._send(200, vault.projects)
+
+        elif(resource == 'batches' and not any(rest)):
+            project_ids = [int(project_id) for project_id in query['projects'].split(',')
+                           ] if query.get('projects') else None
+            objects = vault.query(project_ids)
+            if(query.get('async') == 'true'):
+                export_id = vault.start_export(objects)
+                self._send(200, {'id': export_id, 'status': 'new'})
+                return
+            page_size = min(int(query.get('page_size', 50)), MAX_PAGE_SIZE)
+            offset = int(query.get('offset', 0))
+            self._send(200, {'count': len(objects), 'offset': offset, 'page_size': page_size,
+                             'objects': objects[offset:offset + page_size]})
+
+        elif(resource in ['export_progress', 'exports'] and rest and rest[0].isdigit()):
+            export = vault.exports.get(int(rest[0]))
+            if(export is None):
+                self._send(404, {'error': 'Not Found'})
+                return
+            finished = time.time() - \
+                export['startedOn'] >= self.server.faults['export_seconds']
+            if(resource == 'export_progress'):
+                self._send(200, {'id': int(rest[0]), 'status': 'finished' if finished else 'started'})
+            elif(not finished):
+                self._send(400, {'error': 'Export is not finished'})
+            else:
+                self._send(200, {'count': len(export['objects']), 'objects': export['objects']})
+
+        else:
+            self._send(404, {'error': 'Not Found'})
+
+    def do_PUT(self):
+        prepared = self._prepare()
+        if(prepared is None):
+            return
+        resource, query = prepared
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            data = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send(400, {'error': 'Malformed JSON'})
+            return
+
+        if(len(resource) == 2 and resource[0] == 'batches' and resource[1].isdigit()):
+            batch = self.server.vault.update(int(resource[1]), data)
+            if(batch is None):
+                self._send(404, {'error': 'Not Found'})
+            else:
+                self._send(200, batch)
+        else:
+            self._send(404, {'error': 'Not Found'})
+
+
+class FakeCDDServer(ThreadingHTTPServer):
+    """ HTTP server of a FakeVault
+
+    Arguments:
+            address {tuple} -- (host, port), port 0 is a free port
+            vault {FakeVault} -- vault that is served
+            token {string} -- required 'X-CDD-token', None accepts all (default: {None})
+            faults {dic} -- fault injection, see DEFAULT_FAULTS (default: {DEFAULT_FAULTS})
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, vault, token=None, faults=None):
+        """ Initialized is called when class in created
+        """
+
+        super().__init__(address, FakeCDDHandler)
+        self.vault = vault
+        self.token = token
+        self.faults = dict(DEFAULT_FAULTS, **(faults or {}))
+
+    def base_url(self, vault_id=1):
+        """ Returns base url of vault, e.g. for 'cdd_base_url' setting
+        """
+
+        host, port = self.server_address[:2]
+        return 'http://%s:%s/api/v1/vaults/%s/' % (host, port, vault_id)
+
+    def start(self):
+        """ Serves requests in background thread, returns self
+        """
+
+        threading.Thread(target=self.serve_forever,
+                         name='fake-cdd', daemon=True).start()
+        return self
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local simulator of the CDD Vault API')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--batches', type=int, default=1000,
+                        help='number of batches in vault')
+    parser.add_argument('--projects', type=int, default=5,
+                        help='number of projects in vault')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of synthetic vault')
+    parser.add_argument('--token', default=None,
+                        help='required X-CDD-token, default accepts all')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds every response is delayed')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='maximum random seconds added to or subtracted from latency')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests that fails')
+    parser.add_argument('--error-status', type=int, default=503,
+                        help='status of failed requests')
+    parser.add_argument('--retry-after', type=int, default=None,
+                        help='Retry-After header of failed requests')
+    parser.add_argument('--export-seconds', type=float, default=2.0,
+                        help='seconds an asynchronous export takes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(levelname)s | %(message)s")
+    server = FakeCDDServer((args.host, args.port), FakeVault(args.batches, args.projects, args.seed),
+                           token=args.token, faults={'latency': args.latency, 'jitter': args.jitter,
+                                                     'error_rate': args.error_rate, 'error_status': args.error_status,
+                                                     'retry_after': args.retry_after, 'export_seconds': args.export_seconds})
+    logger.info('%s | Fake CDD serving %s batches at %s', filename,
+                args.batches, server.base_url())
+    server.serve_forever()
@@ -0,0 +1,20 @@
+import multiprocessing
+
+"""
+    Settings of gunicorn for multi-worker serving of the backend, set "multi_worker" in settings.json (see README.md) and run:
+        gunicorn -c gunicorn.conf.py 'server:create_app()'
+"""
+
+bind = '0.0.0.0:5000'
+
+# Every worker creates its own clients and background threads, see create_app() of server
+workers = multiprocessing.cpu_count()
+preload_app = False
+
+# Threads per worker, a client of /feed holds a thread as long as it listens
+worker_class = 'gthread'
+threads = 8
+
+# Longer than the time budget of /submitdata, see ROUTE_DEADLINES of server
+timeout = 330
+graceful_timeout = 30
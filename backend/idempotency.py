@@ -0,0 +1,77 @@
+import json
+import sqlite3
+import time
+
+
+class IdempotencyStore():
+    """ Results of requests by idempotency key, so a retried request is answered without doing the work again.
+        Stored in SQLite, so results survive restarts and are shared by all processes.
+
+    Arguments:
+            path {string} -- SQLite database file
+            ttl {int} -- seconds a key is remembered (default: {24 hours})
+            running_timeout {int} -- seconds after which a key that is still running may be claimed again (default: {600})
+
+    Conventions:
+        - keys are 'running' from begin() until done() stores the result, or release() forgets the key
+    """
+
+    def __init__(self, path, ttl=24*3600, running_timeout=600):
+        """ Initialized is called when class in created
+        """
+
+        self._path = path
+        self._ttl = ttl
+        self._running_timeout = running_timeout
+
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS idempotency_keys (
+                                key TEXT PRIMARY KEY, status TEXT, result TEXT, created_on REAL)""")
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=30)
+
+    def begin(self, key):
+        """ Claims key, when it is not known yet
+
+        Returns:
+            string, dic -- 'new' (claimed, None), 'running' (None) or 'done' (stored result)
+        """
+
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM idempotency_keys WHERE created_on < ? OR (status = 'running' AND created_on < ?)",
+                         (now - self._ttl, now - self._running_timeout))
+            claimed = conn.execute("INSERT OR IGNORE INTO idempotency_keys (key, status, created_on) VALUES (?, 'running', ?)",
+                                   (key, now)).rowcount
+            if(claimed):
+                return 'new', None
+            status, result = conn.execute("SELECT status, result FROM idempotency_keys WHERE key = ?",
+                                          (key,)).fetchone()
+
+        return status, json.loads(result) if result else None
+
+    def get(self, key):
+        """ Returns stored result of key, None if key is unknown or still running
+        """
+
+        with self._connect() as conn:
+            row = conn.execute("SELECT result FROM idempotency_keys WHERE key = ? AND status = 'done' AND created_on >= ?",
+                               (key, time.time() - self._ttl)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def done(self, key, result):
+        """ Stores result {dic} of key
+        """
+
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO idempotency_keys (key, status, result, created_on) VALUES (?, 'done', ?, ?)",
+                         (key, json.dumps(result), time.time()))
+
+    def release(self, key):
+        """ Forgets key, e.g. when the request failed and may be done again
+        """
+
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM idempotency_keys WHERE key = ?", (key,))
@@ -0,0 +1,196 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+# Set logging, handlers and levels are set by logging_setup.setup_logging()
+filename = 'jobs.py'
+logger = logging.getLogger(filename)
+
+
+class JobQueue():
+    """ Durable queue of background jobs, stored in SQLite and executed by a pool of worker threads
+
+    Arguments:
+            path {string} -- SQLite database file of the queue
+            handlers {dic} -- function per kind of job, handler(payload, progress) returns the result {dic},
+                              progress(done, total, result) can be called to store progress and partial results
+            workers {int} -- number of worker threads (default: {4})
+            retention {int} -- seconds finished jobs are kept (default: {7 days})
+            owner {string} -- owner of the jobs this queue runs, e.g. the worker slot of a multi-worker deployment,
+                              None when one process uses the queue (default: {None})
+
+    Conventions:
+        - all jobs are a dictionary with keys:
+            [id]            {str}      -- id of job
+            [kind]          {str}      -- kind of job, key of handlers
+            [status]        {str}      -- 'queued', 'running', 'finished' or 'failed'
+            [progress]      {dic}      -- {'done': {int}, 'total': {int}}
+            [result]        {dic}      -- result of handler, while running the partial result
+            [error]         {str}      -- error message, only when status is 'failed'
+            [createdOn], [startedOn], [finishedOn] {float} -- unix timestamps
+        - jobs that were running when the process stopped are queued again on start(), with an owner only the jobs
+          of that owner (jobs of other processes may still be running)
+    """
+
+    def __init__(self, path, handlers, workers=4, retention=7*24*3600, owner=None):
+        """ Initialized is called when class in created
+        """
+
+        self._path = path
+        self._handlers = handlers
+        self._workers = workers
+        self._retention = retention
+        self._owner = owner
+        self._condition = threading.Condition()
+        self._started = False
+
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                id TEXT PRIMARY KEY, kind TEXT, status TEXT, payload TEXT,
+                                progress TEXT, result TEXT, error TEXT,
+                                created_on REAL, started_on REAL, finished_on REAL, owner TEXT)""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_on)")
+            if('owner' not in [column[1] for column in conn.execute("PRAGMA table_info(jobs)")]):
+                # Queue made before jobs had an owner
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=30)
+
+    def start(self):
+        """ Queues interrupted jobs again, removes old jobs and starts the worker threads
+        """
+
+        if(self._started):
+            return
+        self._started = True
+
+        with self._connect() as conn:
+            if(self._owner is None):
+                requeued = conn.execute(
+                    "UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+            else:
+                requeued = conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running' AND (owner = ? OR owner IS NULL)",
+                                        (self._owner,)).rowcount
+            conn.execute("DELETE FROM jobs WHERE finished_on < ?",
+                         (time.time() - self._retention,))
+        if(requeued):
+            logger.warning('%s | %s interrupted job(s) queued again', filename, requeued)
+
+        for i in range(self._workers):
+            threading.Thread(target=self._work, name='job-worker-%s' %
+                             i, daemon=True).start()
+
+    def submit(self, kind, payload, total=0):
+        """ Adds job to queue
+
+        Arguments:
+            kind {string} -- kind of job, key of handlers
+            payload {dic} -- input of handler
+            total {int} -- number of steps of job, e.g. number of vials (default: {0})
+
+        Returns:
+            string -- id of job
+        """
+
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute("INSERT INTO jobs (id, kind, status, payload, progress, created_on) VALUES (?, ?, 'queued', ?, ?, ?)",
+                         (job_id, kind, json.dumps(payload), json.dumps({'done': 0, 'total': total}), time.time()))
+
+        with self._condition:
+            self._condition.notify_all()
+
+        logger.info('%s | Job %s (%s) queued', filename, job_id, kind)
+        return job_id
+
+    def get(self, job_id):
+        """ Returns job, see conventions, None if it does not exist
+        """
+
+        with self._connect() as conn:
+            row = conn.execute("SELECT id, kind, status, progress, result, error, created_on, started_on, finished_on FROM jobs WHERE id = ?",
+                               (job_id,)).fetchone()
+        if(row is None):
+            return None
+
+        return {'id': row[0], 'kind': row[1], 'status': row[2], 'progress': json.loads(row[3]),
+                'result': json.loads(row[4]) if row[4] else None, 'error': row[5],
+                'createdOn': row[6], 'startedOn': row[7], 'finishedOn': row[8]}
+
+    def wait(self, job_id, timeout):
+        """ Returns job when it is finished or failed, or when timeout seconds have passed
+        """
+
+        end = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = end - time.monotonic()
+            if(job is None or job['status'] in ['finished', 'failed'] or remaining <= 0):
+                return job
+            with self._condition:
+                self._condition.wait(min(remaining, 1))
+
+    def size(self):
+        """ Returns number of jobs per status, e.g. {'queued': 2, 'running': 1}
+        """
+
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status").fetchall())
+
+    def _claim(self):
+        """ Marks oldest queued job as running and returns it, None if queue is empty
+        """
+
+        with self._connect() as conn:
+            while True:
+                row = conn.execute(
+                    "SELECT id, kind, payload FROM jobs WHERE status = 'queued' ORDER BY created_on LIMIT 1").fetchone()
+                if(row is None):
+                    return None
+                # Other workers (or processes) may claim the same job, only one update succeeds
+                claimed = conn.execute("UPDATE jobs SET status = 'running', started_on = ?, owner = ? WHERE id = ? AND status = 'queued'",
+                                       (time.time(), self._owner, row[0])).rowcount
+                conn.commit()
+                if(claimed):
+                    return {'id': row[0], 'kind': row[1], 'payload': json.loads(row[2])}
+
+    def _work(self):
+        while True:
+            job = self._claim()
+            if(job is None):
+                # Wait for new job, check every second for jobs of other processes
+                with self._condition:
+                    self._condition.wait(1)
+                continue
+
+            self._run(job)
+
+    def _run(self, job):
+        def progress(done, total, result=None):
+            with self._connect() as conn:
+                conn.execute("UPDATE jobs SET progress = ?, result = ? WHERE id = ?",
+                             (json.dumps({'done': done, 'total': total}), json.dumps(result), job['id']))
+            with self._condition:
+                self._condition.notify_all()
+
+        logger.info('%s | Job %s (%s) started', filename, job['id'], job['kind'])
+        try:
+            result = self._handlers[job['kind']](job['payload'], progress)
+        except Exception as e:
+            logger.exception('%s | Job %s (%s) failed: %s', filename, job['id'], job['kind'], e)
+            with self._connect() as conn:
+                conn.execute("UPDATE jobs SET status = 'failed', error = ?, finished_on = ? WHERE id = ?",
+                             (str(e), time.time(), job['id']))
+        else:
+            logger.info('%s | Job %s (%s) finished', filename, job['id'], job['kind'])
+            with self._connect() as conn:
+                conn.execute("UPDATE jobs SET status = 'finished', result = ?, finished_on = ? WHERE id = ?",
+                             (json.dumps(result), time.time(), job['id']))
+
+        with self._condition:
+            self._condition.notify_all()
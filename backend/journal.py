@@ -0,0 +1,327 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from metrics import METRICS
+
+# Set logging, handlers and levels are set by logging_setup.setup_logging()
+filename = 'journal.py'
+logger = logging.getLogger(filename)
+
+# Status codes of CDD after which an update is never retried
+PERMANENT_FAILURE_STATUSSES = [400, 401, 403, 404]
+
+
+class JournalError(Exception):
+    """ Record could not be written to the journal file
+    """
+
+
+class Journal():
+    """ Durable write-ahead journal of batch updates, an update is appended before it is sent to CDD
+
+    Arguments:
+            path {string} -- journal file, one json record per line
+            flush_interval {float} -- seconds appends are collected before they are written with one fsync (default: {0.005})
+            compact_size {int} -- bytes after which the file is emptied, when no update is pending (default: {1 MB})
+            write_timeout {float} -- seconds append() waits until its record is on disk (default: {30})
+
+    Conventions:
+        - records are a dictionary with keys:
+            [seq]           {int}      -- sequence number of record
+            [op]            {str}      -- 'update' or 'ack'
+            [batchId]       {int}      -- only 'update': CDD id of batch
+            [data]          {dic}      -- only 'update': body of CDD PUT request
+            [barcode]       {str}      -- only 'update': vial barcode, for logging
+            [ackSeq]        {int}      -- only 'ack': seq of acknowledged update
+            [status]        {int}      -- only 'ack': status of CDD response
+        - append() returns after the record is on disk (fsync), or raises JournalError when writing failed or took longer
+          than write_timeout, the update is then not pending and never sent by the replay thread
+        - updates without 'ack' are pending, they are sent by the replay thread (see start_replay()) in order of seq,
+          a later update of a batch is never sent before an earlier pending update of the same batch
+    """
+
+    def __init__(self, path, flush_interval=0.005, compact_size=1024*1024, write_timeout=30):
+        """ Initialized is called when class in created
+        """
+
+        self._path = path
+        self._flush_interval = flush_interval
+        self._compact_size = compact_size
+        self._write_timeout = write_timeout
+
+        self._condition = threading.Condition()
+        self._buffer = []  # [seq, line] of records waiting to be written
+        self._waiting = set()  # Seq of records of which a caller waits until they are on disk
+        self._failed = {}  # Error per seq of waited records that could not be written
+        self._damaged = False  # Last write failed, file may end with a partial line
+        self._seq = 0  # Last given seq
+        self._durable_seq = 0  # Last seq that is on disk
+        self._pending = {}  # Pending updates by seq
+        self._claimed = set()  # Seq of pending updates that are being sent inline
+
+        self._load()
+        self._file = open(self._path, 'a', encoding='utf-8')
+
+        threading.Thread(target=self._write_loop,
+                         name='journal-writer', daemon=True).start()
+
+    def _load(self):
+        """ Reads pending updates from journal file and rewrites it with only the pending updates
+        """
+
+        if(os.path.isfile(self._path)):
+            with open(self._path, encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    if(not line.strip()):
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Incomplete last line of a crash, the update was never acknowledged to the client
+                        logger.warning('%s | Skipped damaged journal record: %s', filename, line.strip())
+                        continue
+                    self._seq = max(self._seq, record['seq'])
+                    if(record['op'] == 'update'):
+                        self._pending[record['seq']] = record
+                    elif(record['op'] == 'ack'):
+                        self._pending.pop(record['ackSeq'], None)
+
+        self._durable_seq = self._seq
+        self._rewrite()
+        if(self._pending):
+            logger.warning('%s | %s pending update(s) in journal, will be sent to CDD', filename, len(self._pending))
+
+    def _rewrite(self):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as tmp_file:
+            for seq in sorted(self._pending):
+                tmp_file.write(json.dumps(self._pending[seq]) + '\n')
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, self._path)
+
+    def _write(self, record, claim=False):
+        """ Adds record to buffer of writer thread and waits until it is on disk, updates are pending from now on
+
+        Raises:
+            JournalError -- record could not be written within write_timeout seconds
+        """
+
+        with self._condition:
+            self._seq += 1
+            seq = record['seq'] = self._seq
+            if(record['op'] == 'update'):
+                self._pending[seq] = record
+                if(claim):
+                    self._claimed.add(seq)
+            self._buffer.append([seq, json.dumps(record) + '\n'])
+            self._waiting.add(seq)
+            self._condition.notify_all()
+
+            end = time.monotonic() + self._write_timeout
+            try:
+                while True:
+                    error = self._failed.pop(seq, None)
+                    if(error is not None):
+                        self._abandon(seq)
+                        raise JournalError(
+                            'Writing journal failed: %s' % str(error))
+                    if(self._durable_seq >= seq):
+                        return seq
+                    remaining = end - time.monotonic()
+                    if(remaining <= 0):
+                        self._abandon(seq)
+                        raise JournalError('Journal record %s was not written within %s seconds' % (
+                            seq, self._write_timeout))
+                    self._condition.wait(remaining)
+            finally:
+                self._waiting.discard(seq)
+
+    def _abandon(self, seq):
+        """ Forgets record seq that was not written, condition must be held
+        """
+
+        self._pending.pop(seq, None)
+        self._claimed.discard(seq)
+        buffer_size = len(self._buffer)
+        self._buffer = [entry for entry in self._buffer if entry[0] != seq]
+        if(len(self._buffer) == buffer_size):
+            # Record may be (partly) on disk, an ack makes sure it is not sent after a restart
+            self._seq += 1
+            self._buffer.append([self._seq, json.dumps(
+                {'op': 'ack', 'ackSeq': seq, 'status': None, 'seq': self._seq}) + '\n'])
+            self._condition.notify_all()
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while not self._buffer:
+                    self._condition.wait()
+
+            # Collect appends of other threads, so they share one fsync
+            time.sleep(self._flush_interval)
+
+            with self._condition:
+                entries = self._buffer
+                self._buffer = []
+                last_seq = self._seq
+
+            try:
+                # After a failed write the file may end with a partial line, it is skipped by _load()
+                self._file.write(('\n' if self._damaged else '') +
+                                 ''.join(line for _, line in entries))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._damaged = False
+            except Exception as e:
+                logger.critical('%s | Writing journal failed: %s', filename, e)
+                self._damaged = True
+                try:
+                    # Drop data buffered by the failed write
+                    self._file.close()
+                except Exception:
+                    pass
+                self._file = open(self._path, 'a', encoding='utf-8')
+                with self._condition:
+                    for seq, _ in entries:
+                        if(seq in self._waiting):
+                            self._failed[seq] = e
+                    self._condition.notify_all()
+                continue
+
+            with self._condition:
+                self._durable_seq = last_seq
+                self._condition.notify_all()
+                if(not self._pending and not self._buffer and self._file.tell() > self._compact_size):
+                    # Everything is acknowledged, start with empty file
+                    self._file.seek(0)
+                    self._file.truncate()
+
+    def append(self, batch_id, data, barcode=None, claim=False):
+        """ Appends update of batch, returns when it is on disk
+
+        Arguments:
+            batch_id {int} -- CDD id of batch
+            data {dic} -- body of CDD PUT request
+            barcode {string} -- vial barcode (default: {None})
+            claim {bool} -- caller sends update itself, replay thread skips it until release() (default: {False})
+
+        Returns:
+            int -- seq of update
+        """
+
+        record = {'op': 'update', 'batchId': batch_id, 'data': data,
+                  'barcode': barcode, 'createdOn': time.time()}
+        seq = self._write(record, claim)
+        METRICS.inc('journal_appends_total')
+        return seq
+
+    def ack(self, seq, status):
+        """ Marks update seq as done, with status of CDD response
+        """
+
+        with self._condition:
+            self._pending.pop(seq, None)
+            self._claimed.discard(seq)
+        try:
+            self._write({'op': 'ack', 'ackSeq': seq, 'status': status})
+        except JournalError as e:
+            # Update is done, after a restart it is sent once more
+            logger.error('%s | Ack of journal update %s not written: %s', filename, seq, e)
+
+    def release(self, seq):
+        """ Gives claimed update seq to the replay thread
+        """
+
+        with self._condition:
+            self._claimed.discard(seq)
+            self._condition.notify_all()
+
+    def has_pending(self, batch_id):
+        """ Returns True if batch has a pending update
+        """
+
+        with self._condition:
+            return any(record['batchId'] == batch_id for record in self._pending.values())
+
+    def pending_fields(self):
+        """ Returns batch fields of all pending updates merged per batch, {batch_id: {field: value}}
+        """
+
+        with self._condition:
+            fields = {}
+            for seq in sorted(self._pending):
+                record = self._pending[seq]
+                fields.setdefault(record['batchId'], {}).update(
+                    record['data'].get('batch_fields', {}))
+            return fields
+
+    def size(self):
+        """ Returns number of pending updates
+        """
+
+        with self._condition:
+            return len(self._pending)
+
+    def start_replay(self, send, retry_interval=5, retry_max=300):
+        """ Starts thread that sends pending updates to CDD, until they succeed or fail permanently
+
+        Arguments:
+            send {function} -- send(batch_id, data) makes the CDD request and returns the status code
+            retry_interval {float} -- seconds before first retry, doubled after every failed round (default: {5})
+            retry_max {float} -- maximum seconds between retries (default: {300})
+        """
+
+        threading.Thread(target=self._replay_loop, args=(
+            send, retry_interval, retry_max), name='journal-replay', daemon=True).start()
+
+    def _replay_loop(self, send, retry_interval, retry_max):
+        delay = retry_interval
+        while True:
+            with self._condition:
+                records = [(seq, self._pending[seq], seq in self._claimed)
+                           for seq in sorted(self._pending)]
+
+            failed_batches = set()
+            blocked_batches = set()
+            sent = 0
+            for seq, record, claimed in records:
+                if(claimed or record['batchId'] in failed_batches or record['batchId'] in blocked_batches):
+                    # Keep order of updates per batch, claimed updates are being sent by their caller
+                    blocked_batches.add(record['batchId'])
+                    continue
+
+                try:
+                    status = send(record['batchId'], record['data'])
+                except Exception as e:
+                    # Retried like an unavailable CDD, the replay thread keeps running
+                    logger.exception('%s | Sending journal update %s of barcode %s failed: %s',
+                                     filename, seq, record['barcode'], e)
+                    status = None
+                sent += 1
+                METRICS.inc('journal_replays_total', {'status': str(status)})
+                if(status == 200 or status in PERMANENT_FAILURE_STATUSSES):
+                    if(status != 200):
+                        logger.error('%s | Journal update %s of barcode %s failed permanently, status: %s, data: %s',
+                                     filename, seq, record['barcode'], status, json.dumps(record['data']))
+                    else:
+                        logger.info('%s | Journal update %s of barcode %s submitted to CDD',
+                                    filename, seq, record['barcode'])
+                    self.ack(seq, status)
+                else:
+                    failed_batches.add(record['batchId'])
+
+            with self._condition:
+                if(failed_batches):
+                    logger.warning('%s | %s batch(es) could not be updated, retry in %s seconds',
+                                   filename, len(failed_batches), delay)
+                    self._condition.wait(delay)
+                    delay = min(delay * 2, retry_max)
+                else:
+                    delay = retry_interval
+                    if(not sent):
+                        # Nothing to send, or only updates that wait for a claimed update of the same batch
+                        self._condition.wait(retry_interval)
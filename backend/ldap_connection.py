@@ -3,28 +3,11 @@ import json
 import datetime
 import logging
 
-# Set logging
+from config import get_config
+
+# Set logging, handlers and levels are set by logging_setup.setup_logging()
 filename = 'ldap_connection.py'
 logger = logging.getLogger(filename)
-logger.setLevel(level=logging.INFO)  # When debugging put to loggin.DEBUG
-formatter = logging.Formatter("%(levelname)s | %(message)s")
-ch = logging.StreamHandler()
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-
-# Load settings with location of ssl directory
-with open('settings.json') as settings_file:
-    settings = json.load(settings_file)
-    ssl_dir = settings['ssl_directory']
-
-# Load (secret) requirements
-with open(ssl_dir + 'requirements.txt') as json_file:
-    requirements = json.load(json_file)
-    SERVICE_PWD = requirements['service_account_pwd']
-
-# Load private_key # /var/www/backend/ssl/requirements.txt
-with open(ssl_dir + 'private_key.pem', 'rb') as key_file:
-    PRIVATE_KEY = key_file.read()
 
 
 def ldap_connection(username, password):
@@ -47,10 +30,10 @@ def ldap_connection(username, password):
     output = {'status': False, 'message': None,
               'userData': None}
 
-    # Setup connection for Service Account (to extract user data)
+    # Setup connection for Service Account (to extract user data), password is in (secret) requirements
     server = Server(host, port=port, get_info=ALL)  # Setup server
     conn = Connection(server, 'CN=Service Account ZoBioWeb,OU=Service Users,OU=Users,OU=Zobio,DC=zobio,DC=local',
-                      SERVICE_PWD)
+                      get_config()['requirements']['service_account_pwd'])
 
     try:
         # Make connection
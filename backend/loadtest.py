@@ -0,0 +1,439 @@
+import argparse
+import contextlib
+import datetime
+import json
+import random
+import sys
+import threading
+import time
+from base64 import b64encode
+
+import jwt
+import requests
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+"""
+    Load test of the backend with concurrent scanners, every scanner repeats the workflow of the frontend:
+        1 - logs in (once)
+        2 - picks a project and asks its last location          -- POST /getlastlocation
+        3 - scans vials one by one, every scan is checked       -- POST /getlocation
+        4 - submits the scanned vials                           -- POST /submitdata
+    with scan type Add, Check-in, Check-out or Delete, chosen by weight.
+
+    Usage:
+        python loadtest.py --url http://localhost:5000/ --username <user> --password <password> --public-key ../ssl/public_key.pem
+        python loadtest.py --url http://localhost:5000/ --token <token>
+        python loadtest.py --local --batches 20000 --cdd-latency 0.05      -- backend and fake CDD in this process
+
+    Conventions:
+        - vials are picked from the batches of the vault (GET /batches at start) in a status the scan type allows,
+          a vial is used by one scanner at a time and gets the status of the scan when it is submitted
+        - a request is an error when it raises (e.g. timeout) or its status is not 200, a submitted vial is failed when
+          it is in 'failedVials' of the response
+        - with --local the backend runs on a free port with a fake CDD (see fake_cdd.py) in a temporary directory,
+          LDAP is not available so tokens are made with the secret key instead of by /login
+"""
+
+# Default weights of scan types of a workflow
+DEFAULT_FLOWS = {'Add': 1.0, 'Check-in': 1.0, 'Check-out': 1.0, 'Delete': 0.1}
+
+# Statusses of batches that scan types accept, as server.SCAN_TYPES
+SCAN_TYPES = {
+    'Add': {'to_status': 'Added', 'allowed_statusses': ['Registered']},
+    'Check-in': {'to_status': 'Checked in', 'allowed_statusses': ['Checked out']},
+    'Check-out': {'to_status': 'Checked out', 'allowed_statusses': ['Added', 'Checked in']},
+    'Delete': {'to_status': 'Deleted', 'allowed_statusses': ['Added', 'Checked in', 'Checked out']}
+}
+
+# Percentiles of latency in report
+PERCENTILES = [50, 90, 95, 99]
+
+
+class Stats():
+    """ Latencies and errors of requests, by name (e.g. 'getlocation' or 'submitdata:Add')
+    """
+
+    def __init__(self):
+        """ Initialized is called when class in created
+        """
+
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.counters = {}
+
+    def add(self, name, seconds, error=None):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if(error is not None):
+                self.errors.setdefault(name, {})
+                self.errors[name][error] = self.errors[name].get(error, 0) + 1
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self, duration):
+        """ Returns report of requests
+
+        Arguments:
+            duration {float} -- seconds of load test
+
+        Returns:
+            dic -- {'durationSeconds', 'counters', 'requests': {name: {count, errors, errorRate, throughput, p50, ..., max}}}
+                   (latencies in seconds)
+        """
+
+        with self.lock:
+            report = {'durationSeconds': duration,
+                      'counters': dict(self.counters), 'requests': {}}
+            for name, latencies in sorted(self.latencies.items()):
+                latencies = sorted(latencies)
+                errors = sum(self.errors.get(name, {}).values())
+                line = {'count': len(latencies), 'errors': errors, 'errorRate': errors / len(latencies),
+                        'errorTypes': dict(self.errors.get(name, {})), 'throughput': len(latencies) / duration}
+                for percentile in PERCENTILES:
+                    # Nearest rank
+                    line['p%s' % percentile] = latencies[max(
+                        int(round(percentile / 100 * len(latencies))) - 1, 0)]
+                line['max'] = latencies[-1]
+                report['requests'][name] = line
+        return report
+
+
+class VialPool():
+    """ Vials of the vault by project and status, a vial is taken by one scanner at a time
+
+    Arguments:
+            batches {list} -- batches of vault, see /batches
+    """
+
+    def __init__(self, batches):
+        """ Initialized is called when class in created
+        """
+
+        self.lock = threading.Lock()
+        self.projects = {}
+        self.vials = {}
+        for batch in batches:
+            if(not batch.get('projects') or not batch['batch_fields'].get('Vial barcode')):
+                continue
+            project = {'id': batch['projects'][0]['id'],
+                       'name': batch['projects'][0]['name']}
+            self.projects[project['id']] = project
+            self.vials.setdefault((project['id'], batch['batch_fields'].get('Status')), []).append(
+                batch['batch_fields']['Vial barcode'])
+
+    def take(self, scan_type, amount):
+        """ Takes up to amount vials of one (random) project in a status scan_type accepts
+
+        Returns:
+            dic, list -- project and [(barcode, status)], None and [] if there are no vials for scan_type
+        """
+
+        statusses = SCAN_TYPES[scan_type]['allowed_statusses']
+        with self.lock:
+            project_ids = [project_id for project_id in self.projects
+                           if any(self.vials.get((project_id, status)) for status in statusses)]
+            if(not project_ids):
+                return None, []
+            project_id = random.choice(project_ids)
+            taken = []
+            for status in statusses:
+                vials = self.vials.get((project_id, status), [])
+                while(vials and len(taken) < amount):
+                    taken.append(
+                        (vials.pop(random.randrange(len(vials))), status))
+            return self.projects[project_id], taken
+
+    def put(self, project, vials):
+        """ Returns vials [(barcode, status)] to pool
+        """
+
+        with self.lock:
+            for barcode, status in vials:
+                self.vials.setdefault(
+                    (project['id'], status), []).append(barcode)
+
+
+class Scanner(threading.Thread):
+    """ Virtual scanner that repeats workflows until stop is set, see conventions of module
+
+    Arguments:
+            index {int} -- number of scanner
+            options {argparse.Namespace} -- options of load test
+            pool {VialPool} -- vials of vault
+            stats {Stats} -- results
+            stop {threading.Event} -- set to end load test
+    """
+
+    def __init__(self, index, options, pool, stats, stop):
+        """ Initialized is called when class in created
+        """
+
+        super().__init__(name='scanner-%s' % index, daemon=True)
+        self.index = index
+        self.options = options
+        self.pool = pool
+        self.stats = stats
+        self.stop = stop
+        self.session = requests.Session()
+        self.flows = list(options.flows)
+        self.weights = [options.flows[flow] for flow in self.flows]
+
+    def call(self, name, method, route, **kwargs):
+        """ Makes request to backend and adds it to stats
+
+        Returns:
+            dic -- output of response, None if request failed
+        """
+
+        start = time.perf_counter()
+        error = None
+        output = None
+        try:
+            response = self.session.request(method, self.options.url + route,
+                                            timeout=self.options.timeout, **kwargs)
+            if(response.status_code != 200):
+                error = str(response.status_code)
+            else:
+                output = response.json(
+                )['backendRequest']['response']['output']
+        except Exception as e:
+            error = type(e).__name__
+        self.stats.add(name, time.perf_counter() - start, error)
+        return output
+
+    def login(self):
+        if(self.options.token):
+            self.session.headers['Token'] = self.options.token
+            return True
+        output = self.call('login', 'POST', 'login', headers={'username': self.options.username,
+                                                              'password': self.options.encrypted_password})
+        if(output is None):
+            return False
+        self.session.headers['Token'] = output['token']
+        return True
+
+    def run(self):
+        if(not self.login()):
+            return
+        while(not self.stop.is_set()):
+            self.workflow(random.choices(self.flows, self.weights)[0])
+            self.stop.wait(self.options.think_time)
+
+    def workflow(self, scan_type):
+        project, vials = self.pool.take(scan_type, self.options.vials)
+        if(not vials):
+            self.stats.count('workflowsSkipped')
+            self.stop.wait(1)
+            return
+
+        submitted = []
+        try:
+            output = self.call('getlastlocation', 'POST',
+                               'getlastlocation', json={'project': project})
+            box, position = 1, 0
+            if(output and output['hasLastLocation']):
+                # Continue after last location, positions of 9x9 boxes
+                box, position = output['lastLocation'][1], (output['lastLocation'][2] - 1) * 9 + \
+                    output['lastLocation'][3]
+
+            items = []
+            for barcode, status in vials:
+                if(self.stop.wait(self.options.scan_interval)):
+                    return
+                output = self.call('getlocation', 'POST', 'getlocation', json={'type': scan_type, 'project': project,
+                                                                               'barcode': barcode})
+                self.stats.count('scans')
+                if(output is not None and not (output['isInCDD'] and output['isInCorrectProject'] and output['isCorrectStatus'])):
+                    self.stats.count('scansInvalid')
+                if(position == 81):
+                    box, position = box + 1, 0
+                items.append({'id': len(items), 'barcode': barcode, 'project': project, 'box': box,
+                              'poslabel': '%s%s' % (chr(65 + position // 9), position % 9 + 1),
+                              'fullname': 'Load test %s' % self.index, 'containerbarcode': None,
+                              'containertype': None, 'timestamp': datetime.datetime.now().isoformat(),
+                              'username': 'loadtest'})
+                position += 1
+
+            output = self.call('submitdata:' + scan_type, 'POST',
+                               'submitdata', json={'type': scan_type, 'data': items})
+            if(output is None):
+                return
+            failed = set(vial['scanData']['barcode']
+                         for vial in output.get('failedVials', []))
+            self.stats.count('workflows')
+            self.stats.count('vialsSubmitted', len(items))
+            self.stats.count('vialsFailed', len(failed))
+            submitted = [(barcode, SCAN_TYPES[scan_type]['to_status'])
+                         for barcode, status in vials if barcode not in failed]
+        finally:
+            # Submitted vials have new status, others are used again as they were
+            submitted_barcodes = set(barcode for barcode, status in submitted)
+            self.pool.put(project, submitted + [(barcode, status) for barcode, status in vials
+                                                if barcode not in submitted_barcodes])
+
+
+@contextlib.contextmanager
+def start_local(options):
+    """ Starts fake CDD and backend in this process, see conventions of module, both are stopped and the temporary
+        directory of the backend is removed when the context ends
+
+    Yields:
+        string, string -- url and token of backend
+    """
+
+    from werkzeug.serving import make_server
+    from benchmark import make_workspace
+    from fake_cdd import FakeCDDServer, FakeVault
+
+    fake_cdd = FakeCDDServer(('127.0.0.1', 0), FakeVault(options.batches, options.projects),
+                             faults={'latency': options.cdd_latency, 'error_rate': options.cdd_error_rate}).start()
+    try:
+        with make_workspace({'cdd_base_url': fake_cdd.base_url(),
+                             'journal_mode': options.journal_mode}):
+            import server
+            server.create_app()
+
+            backend = make_server('127.0.0.1', 0, server.app, threaded=True)
+            threading.Thread(target=backend.serve_forever,
+                             name='backend', daemon=True).start()
+            token = jwt.encode({'user': 'loadtest', 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)},
+                               server.app.config['SECRET_KEY'])
+            try:
+                yield 'http://127.0.0.1:%s/' % backend.server_port, token.decode() if isinstance(token, bytes) else token
+            finally:
+                backend.shutdown()
+    finally:
+        fake_cdd.shutdown()
+
+
+def encrypt_password(password, public_key_file):
+    """ Encrypts password as the frontend does for /login
+    """
+
+    with open(public_key_file, 'rb') as key_file:
+        public_key = serialization.load_pem_public_key(
+            key_file.read(), backend=default_backend())
+    return b64encode(public_key.encrypt(password.encode('utf-8'), padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None))).decode('ascii')
+
+
+def print_report(report):
+    print('> %s seconds, %s' % (round(report['durationSeconds'], 1), ', '.join(
+        '%s: %s' % item for item in sorted(report['counters'].items()))))
+    print('%-22s %7s %7s %8s %8s' % ('request', 'count', 'errors', 'req/s', 'err %') +
+          ''.join(' %8s' % ('p%s ms' % percentile) for percentile in PERCENTILES) + ' %8s' % 'max ms')
+    for name, line in report['requests'].items():
+        print('%-22s %7s %7s %8.2f %8.2f' % (name, line['count'], line['errors'], line['throughput'],
+                                             line['errorRate'] * 100) +
+              ''.join(' %8.1f' % (line['p%s' % percentile] * 1000) for percentile in PERCENTILES) +
+              ' %8.1f' % (line['max'] * 1000))
+        if(line['errorTypes']):
+            print('%-22s errors: %s' % ('', line['errorTypes']))
+
+
+def parse_flows(text):
+    """ Parses weights of scan types, e.g. 'Add=1,Check-in=2'
+    """
+
+    flows = {}
+    for part in text.split(','):
+        flow, _, weight = part.partition('=')
+        if(flow not in SCAN_TYPES):
+            raise argparse.ArgumentTypeError(
+                'scan type \'%s\' is not valid' % flow)
+        flows[flow] = float(weight or 1)
+    return flows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Load test of the backend with concurrent scanners')
+    parser.add_argument('--url', default='http://localhost:5000/',
+                        help='url of backend')
+    parser.add_argument('--token', default=None,
+                        help='token of backend, instead of login')
+    parser.add_argument('--username', default=None, help='username of login')
+    parser.add_argument('--password', default=None, help='password of login')
+    parser.add_argument('--public-key', default='../ssl/public_key.pem',
+                        help='public key of backend, to encrypt password')
+    parser.add_argument('--local', action='store_true',
+                        help='run backend with fake CDD in this process')
+    parser.add_argument('--batches', type=int, default=10000,
+                        help='number of batches of fake CDD (--local)')
+    parser.add_argument('--projects', type=int, default=10,
+                        help='number of projects of fake CDD (--local)')
+    parser.add_argument('--cdd-latency', type=float, default=0.05,
+                        help='seconds every fake CDD response is delayed (--local)')
+    parser.add_argument('--cdd-error-rate', type=float, default=0.0,
+                        help='fraction of fake CDD requests that fails (--local)')
+    parser.add_argument('--journal-mode', default='sync',
+                        help='journal mode of backend (--local)')
+    parser.add_argument('--scanners', type=int, default=10,
+                        help='number of concurrent scanners')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='seconds of load test')
+    parser.add_argument('--ramp-up', type=float, default=0,
+                        help='seconds over which scanners are started')
+    parser.add_argument('--vials', type=int, default=10,
+                        help='vials per workflow')
+    parser.add_argument('--scan-interval', type=float, default=0.5,
+                        help='seconds between scans of a scanner')
+    parser.add_argument('--think-time', type=float, default=2.0,
+                        help='seconds between workflows of a scanner')
+    parser.add_argument('--flows', type=parse_flows, default=DEFAULT_FLOWS,
+                        help='weights of scan types, e.g. Add=1,Check-in=1,Check-out=1,Delete=0.1')
+    parser.add_argument('--timeout', type=float, default=330,
+                        help='seconds a request may take')
+    parser.add_argument('--output', default=None,
+                        help='file report is written to as json')
+    options = parser.parse_args()
+
+    with contextlib.ExitStack() as workspace:
+        if(options.local):
+            options.url, options.token = workspace.enter_context(
+                start_local(options))
+        elif(not options.token):
+            if(not options.username or not options.password):
+                parser.error('give --token, --username and --password, or --local')
+            options.encrypted_password = encrypt_password(
+                options.password, options.public_key)
+        options.url = options.url.rstrip('/') + '/'
+
+        stats = Stats()
+        loader = Scanner(-1, options, None, stats, threading.Event())
+        if(not loader.login()):
+            print('> Login failed')
+            sys.exit(1)
+        print('> Loading batches of %s' % options.url)
+        batches = loader.call('batches', 'GET', 'batches', params={
+                              'fields': 'Vial barcode,Status'})
+        if(batches is None):
+            print('> Loading batches failed')
+            sys.exit(1)
+        pool = VialPool(batches['batches'])
+        print('> %s vials in %s projects, %s scanners for %s seconds' %
+              (len(batches['batches']), len(pool.projects), options.scanners, options.duration))
+
+        stop = threading.Event()
+        scanners = [Scanner(index, options, pool, stats, stop)
+                    for index in range(options.scanners)]
+        start = time.perf_counter()
+        for scanner in scanners:
+            scanner.start()
+            time.sleep(options.ramp_up / options.scanners)
+        stop.wait(max(options.duration - (time.perf_counter() - start), 0))
+        stop.set()
+        for scanner in scanners:
+            # Running requests are finished
+            scanner.join(options.timeout)
+
+        report = stats.report(time.perf_counter() - start)
+    print_report(report)
+    if(options.output):
+        with open(options.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
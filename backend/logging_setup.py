@@ -0,0 +1,92 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+import request_context  # Adds correlation_id to all log records
+from metrics import METRICS
+
+# Default settings of logging, see setup_logging()
+DEFAULT_LOGGING = {'level': 'INFO', 'levels': {}, 'format': 'json',
+                   'file': None, 'queue_size': 10000}
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats record as one json object per line, with keys time, level, logger, message, correlationId and thread
+        (and exception when there is one)
+    """
+
+    def format(self, record):
+        data = {'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+                'level': record.levelname, 'logger': record.name, 'message': record.getMessage(),
+                'correlationId': getattr(record, 'correlation_id', None), 'thread': record.threadName}
+        if(record.exc_text):
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ Queue handler that never blocks the logging thread, records are dropped (and counted) when the queue is full
+    """
+
+    def prepare(self, record):
+        # Only merge message and arguments here, formatting is done by the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        if(record.exc_info):
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            METRICS.inc('log_records_dropped_total')
+
+
+def setup_logging(settings=None):
+    """ Sets up logging of all modules: records are put on a queue by the logging thread, and formatted and
+        written by one listener thread, so logging I/O is not on the path of requests
+
+    Keyword Arguments:
+        settings {dic} -- see DEFAULT_LOGGING (default: {None})
+            [level]         {str}       -- level of all loggers, e.g. 'INFO'
+            [levels]        {dic}       -- level per module, e.g. {'server.py': 'DEBUG', 'api_cdd.py': 'WARNING'}
+            [format]        {str}       -- 'json' (one json object per line) or 'text'
+            [file]          {str}       -- file records are written to, None is stderr
+            [queue_size]    {int}       -- maximum number of records waiting to be written, more are dropped
+
+    Returns:
+        logging.handlers.QueueListener -- running listener, stopped when the process exits
+    """
+
+    settings = dict(DEFAULT_LOGGING, **(settings or {}))
+
+    if(settings['file']):
+        handler = logging.FileHandler(settings['file'], encoding='utf-8')
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    if(settings['format'] == 'json'):
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            "%(levelname)s | %(correlation_id)s | %(message)s"))
+
+    log_queue = queue.Queue(settings['queue_size'])
+    root = logging.getLogger()
+    for root_handler in list(root.handlers):
+        root.removeHandler(root_handler)
+    root.addHandler(DroppingQueueHandler(log_queue))
+    root.setLevel(settings['level'])
+    for name, level in settings['levels'].items():
+        logging.getLogger(name).setLevel(level)
+
+    listener = logging.handlers.QueueListener(
+        log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
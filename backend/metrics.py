@@ -0,0 +1,155 @@
+import threading
+
+# Upper bounds (seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+class Metrics():
+    """ Process-wide store of counters, gauges and histograms, rendered in Prometheus text format by render()
+
+    Conventions:
+        - every metric has a name and optional labels {dic}, e.g. inc('cdd_requests_total', {'method': 'GET'})
+        - counters only go up, gauges go up and down, histograms count observations per bucket and keep their sum
+        - gauges of sizes that are known elsewhere (e.g. queued jobs) are functions, called by render()
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """ Initialized is called when class in created
+        """
+
+        self._buckets = buckets
+        self._counters = {}
+        self._gauges = {}
+        self._gauge_functions = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def inc(self, name, labels=None, value=1):
+        """ Increases counter name with value
+
+        Arguments:
+            name {string} -- name of counter
+            labels {dic} -- labels of counter (default: {None})
+            value {float} -- value to add (default: {1})
+        """
+
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add(self, name, value, labels=None):
+        """ Adds value (may be negative) to gauge name, e.g. number of requests in progress
+        """
+
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        """ Sets gauge name to value
+        """
+
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def gauge(self, name, function):
+        """ Registers function of gauge name, function() returns the value, or a list of [labels, value]
+        """
+
+        with self._lock:
+            self._gauge_functions[name] = function
+
+    def observe(self, name, value, labels=None):
+        """ Adds observation (e.g. duration in seconds) to histogram name
+
+        Arguments:
+            name {string} -- name of histogram
+            value {float} -- observed value
+            labels {dic} -- labels of histogram (default: {None})
+        """
+
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if(histogram is None):
+                histogram = self._histograms[key] = {
+                    'buckets': [0] * len(self._buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self._buckets):
+                if(value <= bound):
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def get(self, name, labels=None):
+        """ Returns value of counter, or {'buckets', 'sum', 'count'} of histogram, None if it does not exist
+        """
+
+        key = self._key(name, labels)
+        with self._lock:
+            if(key in self._counters):
+                return self._counters[key]
+            if(key in self._gauges):
+                return self._gauges[key]
+            histogram = self._histograms.get(key)
+            return dict(histogram) if histogram else None
+
+    @staticmethod
+    def _format(name, labels, value):
+        if(labels):
+            name += '{' + ','.join('%s="%s"' % (label, str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                                   for label, label_value in labels) + '}'
+        return '%s %s' % (name, repr(float(value)) if value != float('inf') else '+Inf')
+
+    def render(self):
+        """ Returns all metrics in Prometheus text format
+        """
+
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            gauge_functions = dict(self._gauge_functions)
+            histograms = {key: dict(histogram, buckets=list(histogram['buckets']))
+                          for key, histogram in self._histograms.items()}
+
+        for name, function in gauge_functions.items():
+            value = function()
+            for labels, label_value in (value if isinstance(value, list) else [[None, value]]):
+                gauges[self._key(name, labels)] = label_value
+
+        lines = []
+        for metric_type, metrics in [('counter', counters), ('gauge', gauges)]:
+            previous_name = None
+            for (name, labels), value in sorted(metrics.items()):
+                if(name != previous_name):
+                    lines.append('# TYPE %s %s' % (name, metric_type))
+                    previous_name = name
+                lines.append(self._format(name, labels, value))
+
+        previous_name = None
+        for (name, labels), histogram in sorted(histograms.items()):
+            if(name != previous_name):
+                lines.append('# TYPE %s histogram' % name)
+                previous_name = name
+            cumulative = 0
+            for bound, count in zip(self._buckets, histogram['buckets']):
+                cumulative += count
+                bucket_labels = labels + \
+                    (('le', '+Inf' if bound == float('inf') else repr(float(bound))),)
+                lines.append(self._format(
+                    name + '_bucket', bucket_labels, cumulative))
+            lines.append(self._format(name + '_sum', labels, histogram['sum']))
+            lines.append(self._format(
+                name + '_count', labels, histogram['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of this process
+METRICS = Metrics()
@@ -0,0 +1,632 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from batch_snapshot import BatchSnapshot, Snapshot
+from change_feed import ChangeFeed, make_event
+from metrics import METRICS
+
+"""
+    Multi-worker mode: several processes (e.g. gunicorn workers) serve the backend on one host and share state
+    through a directory:
+        snapshot.sqlite3    -- one snapshot of all batches, with the updates workers made to it, and the events of
+                               the change feed, see SnapshotStore and SharedChangeFeed
+        sessions.sqlite3    -- scan sessions and reserved barcodes, see SharedScanSessions
+        worker-<n>.lock     -- worker slots, see claim_worker_slot()
+
+    A snapshot is loaded from CDD by one worker at a time (the worker that holds the load lock), the other workers
+    wait for it and read it from the store. So CDD load does not grow with the number of workers.
+"""
+
+# Set logging, handlers and levels are set by logging_setup.setup_logging()
+filename = 'multi_worker.py'
+logger = logging.getLogger(filename)
+
+# Default settings of multi-worker mode, see README.md
+DEFAULT_MULTI_WORKER = {'directory': 'shared',
+                        'poll_interval': 0.5, 'load_timeout': 300}
+
+# Worker slots stay locked as long as the process runs, see claim_worker_slot()
+_slot_files = []
+
+
+def claim_worker_slot(directory):
+    """ Claims the lowest free worker slot, a slot is free again when its process stops (also when it is killed).
+        A worker that replaces a stopped worker gets its slot, and so its journal and jobs, see create_app() of server
+
+    Returns:
+        int -- slot, 0, 1, 2, ...
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    slot = 0
+    while True:
+        slot_file = open(os.path.join(directory, 'worker-%s.lock' % slot), 'a')
+        try:
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            slot_file.close()
+            slot += 1
+            continue
+        _slot_files.append(slot_file)
+        return slot
+
+
+def _is_alive(owner):
+    """ Checks if owner '<host>:<pid>' is a running process, owners on other hosts are assumed to be running
+    """
+
+    host, _, pid = owner.rpartition(':')
+    if(host != socket.gethostname()):
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (OSError, ValueError):
+        pass
+    return True
+
+
+class SnapshotStore():
+    """ Snapshot of all batches shared by the workers, stored in SQLite
+
+    Arguments:
+            path {string} -- SQLite database file
+
+    Conventions:
+        - every snapshot that is written gets the next generation, workers read it again when the generation changed
+        - updates are changes of batches by a worker, they are read by the other workers; updates older than the
+          current snapshot are removed when a snapshot is written
+        - locks are held by an owner ('<host>:<pid>') until they are released, expire or their process stopped
+        - events of the change feed of all workers are numbered by the store, see SharedChangeFeed
+    """
+
+    def __init__(self, path):
+        """ Initialized is called when class in created
+        """
+
+        self._path = path
+
+        with self._connect() as conn:
+            # Readers do not wait for the writer of a snapshot
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS snapshot (
+                                id INTEGER PRIMARY KEY CHECK (id = 1), generation INTEGER, created_on REAL, batches TEXT)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS updates (
+                                seq INTEGER PRIMARY KEY AUTOINCREMENT, created_on REAL, owner TEXT,
+                                batch_id INTEGER, batch_fields TEXT)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS locks (
+                                name TEXT PRIMARY KEY, owner TEXT, expires_on REAL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS events (
+                                seq INTEGER PRIMARY KEY AUTOINCREMENT, event TEXT)""")
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=30)
+
+    def read(self, generation=0, seq=0):
+        """ Reads snapshot when its generation is newer than generation, and the updates after seq
+
+        Returns:
+            dic, list -- snapshot {generation, createdOn, batches} (None if not newer) and updates
+                         [{seq, createdOn, owner, batchId, batchFields}], when the snapshot is newer all its updates
+        """
+
+        with self._connect() as conn:
+            # One read transaction, so snapshot and updates belong together
+            conn.execute("BEGIN")
+            row = conn.execute(
+                "SELECT generation, created_on FROM snapshot WHERE id = 1").fetchone()
+            snapshot = None
+            if(row and row[0] > generation):
+                snapshot = {'generation': row[0], 'createdOn': row[1], 'batches': json.loads(conn.execute(
+                    "SELECT batches FROM snapshot WHERE id = 1").fetchone()[0])}
+                seq = 0
+            rows = conn.execute("SELECT seq, created_on, owner, batch_id, batch_fields FROM updates WHERE seq > ? ORDER BY seq",
+                                (seq,)).fetchall()
+            conn.execute("COMMIT")
+
+        return snapshot, [{'seq': row[0], 'createdOn': row[1], 'owner': row[2], 'batchId': row[3],
+                           'batchFields': json.loads(row[4])} for row in rows]
+
+    def write(self, created_on, batches):
+        """ Writes snapshot, returns its generation
+        """
+
+        data = json.dumps(batches)
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT generation FROM snapshot WHERE id = 1").fetchone()
+            generation = (row[0] if row else 0) + 1
+            conn.execute("INSERT OR REPLACE INTO snapshot (id, generation, created_on, batches) VALUES (1, ?, ?, ?)",
+                         (generation, created_on, data))
+            conn.execute(
+                "DELETE FROM updates WHERE created_on < ?", (created_on,))
+        return generation
+
+    def add_update(self, owner, batch_id, batch_fields):
+        with self._connect() as conn:
+            conn.execute("INSERT INTO updates (created_on, owner, batch_id, batch_fields) VALUES (?, ?, ?, ?)",
+                         (time.time(), owner, batch_id, json.dumps(batch_fields)))
+
+    def add_event(self, event, history):
+        """ Adds event {dic} of change feed, only the last history events are kept
+
+        Returns:
+            int -- seq of event
+        """
+
+        with self._connect() as conn:
+            seq = conn.execute(
+                "INSERT INTO events (event) VALUES (?)", (json.dumps(event),)).lastrowid
+            conn.execute("DELETE FROM events WHERE seq <= ?",
+                         (seq - history,))
+        return seq
+
+    def last_event_seq(self):
+        """ Returns seq of last event of change feed, 0 if none
+        """
+
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'events'").fetchone()
+        return row[0] if row else 0
+
+    def read_events(self, seq):
+        """ Reads events of change feed after seq
+
+        Returns:
+            list, int, int -- events with their seq, seq of oldest event that is kept (None if none) and seq of last
+                              event (0 if none)
+        """
+
+        with self._connect() as conn:
+            conn.execute("BEGIN")
+            rows = conn.execute(
+                "SELECT seq, event FROM events WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+            first_seq = conn.execute("SELECT MIN(seq) FROM events").fetchone()[0]
+            # Last seq is kept by AUTOINCREMENT, also when the events are removed
+            row = conn.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'events'").fetchone()
+            conn.execute("COMMIT")
+
+        return [dict(json.loads(event), seq=event_seq) for event_seq, event in rows], first_seq, row[0] if row else 0
+
+    def acquire(self, name, owner, ttl):
+        """ Acquires lock name for ttl seconds, returns True if owner holds it
+        """
+
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT owner, expires_on FROM locks WHERE name = ?", (name,)).fetchone()
+            if(row and row[0] != owner and row[1] > now and _is_alive(row[0])):
+                return False
+            # Other process may acquire the same lock, only one update succeeds
+            if(row):
+                acquired = conn.execute("UPDATE locks SET owner = ?, expires_on = ? WHERE name = ? AND owner = ? AND expires_on = ?",
+                                        (owner, now + ttl, name, row[0], row[1])).rowcount
+            else:
+                acquired = conn.execute("INSERT OR IGNORE INTO locks (name, owner, expires_on) VALUES (?, ?, ?)",
+                                        (name, owner, now + ttl)).rowcount
+        return bool(acquired)
+
+    def release(self, name, owner):
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+
+class SharedBatchSnapshot(BatchSnapshot):
+    """ BatchSnapshot that is shared by the workers through a SnapshotStore
+
+    Arguments:
+            load {function} -- see BatchSnapshot
+            store {SnapshotStore} -- shared snapshot
+            max_age {float} -- seconds a snapshot is used (default: {30})
+            on_change {function} -- see BatchSnapshot, only called for changes found by this worker, other workers
+                                    publish their own changes to the shared feed (default: {None})
+            poll_interval {float} -- seconds between checks of the store for a new snapshot and updates (default: {0.5})
+            load_timeout {float} -- seconds a worker may hold the load lock (default: {300})
+            warm_max_age {float} -- seconds after which the snapshot of the store is too old for warm_start() (default: {24 hours})
+
+    Conventions:
+        - only one worker loads the snapshot from CDD, other workers wait for it (see get())
+        - updates of a worker are seen by the other workers within poll_interval seconds
+    """
+
+    def __init__(self, load, store, max_age=30, on_change=None, poll_interval=0.5, load_timeout=300, warm_max_age=24*3600):
+        """ Initialized is called when class in created
+        """
+
+        super().__init__(load, max_age=max_age, on_change=on_change,
+                         warm_max_age=warm_max_age)
+        self._store = store
+        self._poll_interval = poll_interval
+        self._load_timeout = load_timeout
+        self._owner = '%s:%s' % (socket.gethostname(), os.getpid())
+        self._generation = 0
+        self._written_generation = None
+        self._seq = 0
+        self._checked_on = 0
+        self._sync_lock = threading.Lock()
+
+    def get(self, deadline=None, hedge=False, priority=None, max_age=None, warm=True):
+        """ Returns snapshot, see BatchSnapshot.get(). A snapshot that is too old is loaded by one worker, the other
+            workers wait until it is in the store
+        """
+
+        max_age = self._max_age if max_age is None else max_age
+        self._sync()
+        snapshot = self._snapshot
+        if(self._usable(snapshot, max_age, warm)):
+            METRICS.inc('batch_snapshot_hits_total')
+            return 200, 'All requests successfully completed.', snapshot, None
+
+        with self._load_lock:
+            return self._reload(deadline, hedge, priority, max_age)
+
+    def _reload(self, deadline, hedge, priority, max_age=None):
+        """ Returns snapshot of store when it is not older than max_age, else loads it when no other worker loads it,
+            load lock must be held
+
+        Returns:
+            int, string, Snapshot, dic -- see get()
+        """
+
+        max_age = self._max_age if max_age is None else max_age
+        while True:
+            self._sync(force=True)
+            snapshot = self._snapshot
+            if(snapshot and not snapshot.warm and snapshot.age() <= max_age):
+                # Loaded by other thread or worker while waiting
+                METRICS.inc('batch_snapshot_hits_total')
+                return 200, 'All requests successfully completed.', snapshot, None
+
+            if(self._store.acquire('snapshot', self._owner, self._load_timeout)):
+                try:
+                    return self._load_shared(deadline, hedge, priority)
+                finally:
+                    self._store.release('snapshot', self._owner)
+
+            if(deadline is not None and deadline.expired()):
+                return 504, 'Gateway Timeout: time budget of request exceeded while other worker loads snapshot', None, None
+            # Other worker loads snapshot
+            time.sleep(self._poll_interval if deadline is None or deadline.remaining() is None else
+                       min(self._poll_interval, deadline.remaining()))
+
+    def warm_start(self, deadline=None, priority=None):
+        """ Makes snapshot of store the current snapshot, the store is persisted by itself, see BatchSnapshot.warm_start()
+        """
+
+        self._sync(force=True)
+        snapshot = self._snapshot
+        if(snapshot is None or snapshot.age() > self._warm_max_age):
+            return False
+        if(snapshot.age() <= self._max_age):
+            # Other workers keep snapshot up to date
+            return True
+
+        snapshot.warm = True
+        threading.Thread(target=self._reconcile, args=(deadline, priority),
+                         name='snapshot-reconcile', daemon=True).start()
+        return True
+
+    def _load_shared(self, deadline, hedge, priority):
+        """ Loads snapshot from CDD and writes it to the store, load lock of store must be held
+        """
+
+        METRICS.inc('batch_snapshot_misses_total')
+        kwargs = {'deadline': deadline, 'hedge': hedge}
+        if(priority):
+            kwargs['priority'] = priority
+        start = time.time()
+        status, message, batches, cdd_request = self._load(**kwargs)
+        if(status != 200):
+            return status, message, None, cdd_request
+
+        with self._sync_lock:
+            generation = self._store.write(start, batches)
+            self._written_generation = generation
+        logger.info('%s | Loaded snapshot %s of %s batches in %.2f seconds',
+                    filename, generation, len(batches), time.time() - start)
+        # Read it back with the updates of other workers made while loading
+        self._sync(force=True)
+        return 200, message, self._snapshot, None
+
+    def _sync(self, force=False):
+        """ Reads new snapshot and updates of other workers from store, at most every poll_interval seconds
+        """
+
+        if(not force and time.monotonic() - self._checked_on < self._poll_interval):
+            return
+        with self._sync_lock:
+            self._checked_on = time.monotonic()
+            try:
+                shared, updates = self._store.read(
+                    self._generation, self._seq)
+            except sqlite3.Error as e:
+                # Keep using the snapshot of this worker
+                logger.error('%s | Reading shared snapshot failed: %s', filename, e)
+                return
+
+            if(shared is not None):
+                snapshot = Snapshot(
+                    shared['batches'], created_on=shared['createdOn'])
+                with self._lock:
+                    for update in updates:
+                        if(update['owner'] != self._owner):
+                            self._update(
+                                snapshot, update['batchId'], update['batchFields'])
+                # Only the worker that loaded the snapshot publishes its changes, see SharedChangeFeed
+                self._install(
+                    snapshot, publish=shared['generation'] == self._written_generation)
+                self._generation = shared['generation']
+            else:
+                for update in updates:
+                    if(update['owner'] != self._owner):
+                        self._apply(update['batchId'], update['batchFields'])
+            if(updates):
+                self._seq = updates[-1]['seq']
+
+    def _apply(self, batch_id, batch_fields):
+        """ Applies update of other worker to current snapshot, the other worker published it
+        """
+
+        with self._lock:
+            if(self._snapshot is None):
+                return
+            self._update(self._snapshot, batch_id, batch_fields)
+
+    def update(self, batch_id, batch_fields):
+        """ Updates fields of batch in current snapshot, and in the store for the other workers
+        """
+
+        super().update(batch_id, batch_fields)
+        try:
+            self._store.add_update(self._owner, batch_id, batch_fields)
+        except sqlite3.Error as e:
+            logger.error('%s | Sharing update of batch %s failed: %s', filename, batch_id, e)
+
+
+class SharedChangeFeed(ChangeFeed):
+    """ ChangeFeed shared by the workers through a SnapshotStore, so a client gets the same events with the same seqs
+        from every worker, also when it reconnects to another worker with Last-Event-ID
+
+    Arguments:
+            store {SnapshotStore} -- shared events
+            history {int} -- see ChangeFeed (default: {1000})
+            poll_interval {float} -- seconds between checks of the store for events of other workers (default: {0.5})
+
+    Conventions:
+        - seq is given by the store, it continues when workers restart
+        - events of this worker wake up its clients right away, events of other workers within poll_interval seconds
+        - listeners are counted per worker
+    """
+
+    def __init__(self, store, history=1000, poll_interval=0.5):
+        """ Initialized is called when class in created
+        """
+
+        super().__init__(history=history)
+        self._store = store
+        self._history_size = history
+        self._poll_interval = poll_interval
+
+    def publish(self, event_type, batch, fields, source):
+        """ Adds event to store and wakes up waiting clients of this worker, see ChangeFeed.publish()
+        """
+
+        try:
+            self._store.add_event(make_event(
+                event_type, batch, fields, source), self._history_size)
+        except sqlite3.Error as e:
+            logger.error('%s | Publishing change of batch %s failed: %s', filename, batch['id'], e)
+            return
+
+        with self._condition:
+            self._condition.notify_all()
+
+    def last_seq(self):
+        return self._store.last_event_seq()
+
+    def wait(self, last_seq, timeout):
+        """ Returns events after last_seq, waits at most timeout seconds when there are none, see ChangeFeed.wait()
+        """
+
+        end = time.monotonic() + timeout
+        while True:
+            events, first_seq, seq = self._store.read_events(last_seq)
+            if(last_seq > seq):
+                # Seq of other store, client must reload
+                return [], True, seq
+            remaining = end - time.monotonic()
+            if(events or remaining <= 0):
+                missed = first_seq is not None and first_seq > last_seq + 1
+                return events, missed, seq
+            with self._condition:
+                self._condition.wait(min(self._poll_interval, remaining))
+
+
+class SharedScanSessions():
+    """ ScanSessions shared by the workers, stored in SQLite, so a session opened by one worker can be used by all
+
+    Arguments:
+            path {string} -- SQLite database file
+            ttl {int} -- seconds an unused session is kept (default: {1 hour})
+            commit_timeout {int} -- seconds after which a session that is still committing is open again (default: {10 minutes})
+
+    Conventions:
+        - sessions are as in ScanSessions, a barcode is reserved by one open session of all workers at a time
+        - every change of a session is one transaction, so two workers can not reserve the same barcode
+    """
+
+    def __init__(self, path, ttl=3600, commit_timeout=600):
+        """ Initialized is called when class in created
+        """
+
+        self._path = path
+        self._ttl = ttl
+        self._commit_timeout = commit_timeout
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                                id TEXT PRIMARY KEY, type TEXT, project TEXT, status TEXT, items TEXT, result TEXT,
+                                created_on REAL, updated_on REAL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS reservations (
+                                barcode TEXT PRIMARY KEY, session_id TEXT)""")
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=30, isolation_level=None)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """ Yields connection that holds the write lock, the transaction is committed when the block ends
+        """
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _get(self, conn, session_id):
+        row = conn.execute("SELECT id, type, project, status, items, result, created_on, updated_on FROM sessions WHERE id = ?",
+                           (session_id,)).fetchone()
+        if(row is None):
+            return None
+        return {'id': row[0], 'type': row[1], 'project': json.loads(row[2]), 'status': row[3],
+                'items': json.loads(row[4]), 'result': json.loads(row[5]) if row[5] else None,
+                'createdOn': row[6], 'updatedOn': row[7]}
+
+    def _expire(self, conn):
+        """ Removes sessions that are not used for ttl seconds, and their reservations, and opens sessions that are
+            committing for commit_timeout seconds again (e.g. the worker stopped during the commit)
+        """
+
+        now = time.time()
+        conn.execute("UPDATE sessions SET status = 'open', updated_on = ? WHERE status = 'committing' AND updated_on < ?",
+                     (now, now - self._commit_timeout))
+        expired = "SELECT id FROM sessions WHERE updated_on < ? AND status != 'committing'"
+        expires_on = now - self._ttl
+        conn.execute("DELETE FROM reservations WHERE session_id IN (%s)" %
+                     expired, (expires_on,))
+        conn.execute("DELETE FROM sessions WHERE id IN (%s)" %
+                     expired, (expires_on,))
+
+    def open(self, scan_type, project):
+        """ Opens session for scan type and project, returns session
+        """
+
+        now = time.time()
+        session = {'id': uuid.uuid4().hex, 'type': scan_type, 'project': project, 'status': 'open', 'items': {},
+                   'result': None, 'createdOn': now, 'updatedOn': now}
+        with self._transaction() as conn:
+            self._expire(conn)
+            conn.execute("INSERT INTO sessions (id, type, project, status, items, result, created_on, updated_on) VALUES (?, ?, ?, 'open', '{}', NULL, ?, ?)",
+                         (session['id'], scan_type, json.dumps(project), now, now))
+        return session
+
+    def get(self, session_id):
+        """ Returns session, None if it does not exist (or expired)
+        """
+
+        with self._transaction() as conn:
+            self._expire(conn)
+            return self._get(conn, session_id)
+
+    def size(self):
+        """ Returns number of sessions per status, e.g. {'open': 2}
+        """
+
+        conn = self._connect()
+        try:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM sessions GROUP BY status").fetchall())
+        finally:
+            conn.close()
+
+    def add(self, session_id, item, batch):
+        """ Adds validated item to open session and reserves its barcode, see ScanSessions.add()
+        """
+
+        barcode = item['barcode']
+        with self._transaction() as conn:
+            session = self._get(conn, session_id)
+            if(session is None or session['status'] != 'open'):
+                return 'closed'
+            conn.execute("UPDATE sessions SET updated_on = ? WHERE id = ?",
+                         (time.time(), session_id))
+            if(barcode in session['items']):
+                return 'duplicate'
+            row = conn.execute(
+                "SELECT session_id FROM reservations WHERE barcode = ?", (barcode,)).fetchone()
+            if(row and row[0] != session_id):
+                return 'reserved'
+            conn.execute("INSERT OR REPLACE INTO reservations (barcode, session_id) VALUES (?, ?)",
+                         (barcode, session_id))
+            session['items'][barcode] = {'scanData': item, 'batch': batch}
+            conn.execute("UPDATE sessions SET items = ? WHERE id = ?",
+                         (json.dumps(session['items']), session_id))
+        return 'added'
+
+    def remove(self, session_id, barcode):
+        """ Removes item from open session, returns False if barcode is not in session or session is not open
+        """
+
+        with self._transaction() as conn:
+            session = self._get(conn, session_id)
+            if(session is None or session['status'] != 'open'):
+                return False
+            if(session['items'].pop(barcode, None) is None):
+                conn.execute("UPDATE sessions SET updated_on = ? WHERE id = ?",
+                             (time.time(), session_id))
+                return False
+            conn.execute("UPDATE sessions SET items = ?, updated_on = ? WHERE id = ?",
+                         (json.dumps(session['items']), time.time(), session_id))
+            conn.execute("DELETE FROM reservations WHERE barcode = ? AND session_id = ?",
+                         (barcode, session_id))
+        return True
+
+    def begin_commit(self, session_id):
+        """ Marks open session as committing, see ScanSessions.begin_commit()
+        """
+
+        with self._transaction() as conn:
+            self._expire(conn)
+            session = self._get(conn, session_id)
+            if(session is None):
+                return None, None
+            status = session['status']
+            if(status == 'open'):
+                session['status'] = 'committing'
+                session['updatedOn'] = time.time()
+                conn.execute("UPDATE sessions SET status = 'committing', updated_on = ? WHERE id = ?",
+                             (session['updatedOn'], session_id))
+            return status, session
+
+    def end_commit(self, session_id, result=None):
+        """ Marks session as committed with result {dic} and releases its barcodes, without result the session is open again
+        """
+
+        with self._transaction() as conn:
+            if(result is None):
+                conn.execute("UPDATE sessions SET status = 'open', updated_on = ? WHERE id = ?",
+                             (time.time(), session_id))
+                return
+            conn.execute("UPDATE sessions SET status = 'committed', result = ?, updated_on = ? WHERE id = ?",
+                         (json.dumps(result), time.time(), session_id))
+            conn.execute(
+                "DELETE FROM reservations WHERE session_id = ?", (session_id,))
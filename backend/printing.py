@@ -0,0 +1,459 @@
+import csv
+import datetime
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Set logging, handlers and levels are set by logging_setup.setup_logging()
+filename = 'printing.py'
+logger = logging.getLogger(filename)
+
+# Buffer size of print files, a print file is written with a few large writes
+WRITE_BUFFER_SIZE = 64 * 1024
+
+# Fields of a label, in order of the columns of a print file
+LABEL_FIELDS = ['barcode', 'project', 'box', 'position']
+
+# Default of 'print_spooler' setting, see README.md
+DEFAULT_PRINT_SPOOLER = {'window': 2, 'retention': 7*24*3600,
+                         'printers': {'default': {'directory': '', 'format': 'text'}}}
+
+
+class LabelCounter():
+    """ Counter of label numbers, stored in SQLite so it is atomic for all threads and processes, a print file is named
+        after the number of its first label
+
+    Arguments:
+            path {string} -- SQLite database file
+            legacy_path {string} -- counter.json of older versions, the counter continues from it (default: {'counter.json'})
+
+    Conventions:
+        - reserve() never gives the same ID twice, also not after a crash (the counter is updated in one transaction)
+    """
+
+    def __init__(self, path, legacy_path='counter.json'):
+        """ Initialized is called when class in created
+        """
+
+        self._path = path
+
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+            start = 0
+            if(legacy_path and os.path.isfile(legacy_path)):
+                try:
+                    with open(legacy_path) as counter_file:
+                        start = int(json.load(counter_file)['counter'])
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning('%s | %s can not be read, counter starts at 0: %s', filename, legacy_path, e)
+            if(conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('labels', ?)", (start,)).rowcount and start):
+                logger.info('%s | Counter continues from %s of %s', filename, start, legacy_path)
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=30, isolation_level=None)
+
+    def reserve(self, count=1):
+        """ Reserves count consecutive ID's
+
+        Returns:
+            int -- first reserved ID, the ID's are first, first + 1, ..., first + count - 1
+        """
+
+        if(count < 1):
+            raise ValueError('count must be at least 1, not %s' % count)
+
+        conn = self._connect()
+        try:
+            # Write lock for the whole read-modify-write
+            conn.execute("BEGIN IMMEDIATE")
+            last = conn.execute(
+                "SELECT value FROM counters WHERE name = 'labels'").fetchone()[0]
+            conn.execute(
+                "UPDATE counters SET value = ? WHERE name = 'labels'", (last + count,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return last + 1
+
+    def last(self):
+        """ Returns last reserved ID, 0 if none
+        """
+
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT value FROM counters WHERE name = 'labels'").fetchone()[0]
+        finally:
+            conn.close()
+
+
+def temporary_print_path(directory, name):
+    """ Returns path of the hidden temporary file of print file name, see write_print_file()
+    """
+
+    return os.path.join(directory, '.%s.tmp' % name)
+
+
+def write_print_file(directory, name, lines, commit=None):
+    """ Writes print file atomically: it is written to a hidden temporary file, and renamed when it is complete,
+        so a printer that watches directory never reads a partial file
+
+    Arguments:
+        directory {string} -- print directory
+        name {string} -- file name, unique
+        lines {iterable} -- lines of file, without line endings
+        commit {function} -- called when the temporary file is complete, right before it is renamed, e.g. to record
+                             that the file is printed, when it raises the file is not written (default: {None})
+
+    Returns:
+        string -- path of print file
+    """
+
+    path = os.path.join(directory, name)
+    temporary_path = temporary_print_path(directory, name)
+    try:
+        with io.open(temporary_path, 'w', encoding='utf-8', newline='', buffering=WRITE_BUFFER_SIZE) as print_file:
+            print_file.write('\n'.join(lines))
+            print_file.flush()
+            os.fsync(print_file.fileno())
+        if(commit):
+            commit()
+    except BaseException:
+        if(os.path.exists(temporary_path)):
+            os.remove(temporary_path)
+        raise
+    os.replace(temporary_path, path)
+    return path
+
+
+def render_text(labels):
+    """ Renders labels as text file, the layout of older versions
+    """
+
+    yield 'Barcode, Project, Box, Position'
+    for label in labels:
+        yield '{0}, {1}, {2}, {3}'.format(*[label[field] for field in LABEL_FIELDS])
+
+
+def _csv_line(values):
+    line = io.StringIO()
+    csv.writer(line, lineterminator='').writerow(values)
+    return line.getvalue()
+
+
+def render_csv(labels):
+    """ Renders labels as CSV file with header, the number of the label is the first column
+    """
+
+    yield _csv_line(['number'] + LABEL_FIELDS)
+    for label in labels:
+        yield _csv_line([label.get('number')] + [label[field] for field in LABEL_FIELDS])
+
+
+def _zpl_field(value):
+    # Field data is hexadecimal escaped with '_' (^FH), so '^' and '~' of a value are not read as commands
+    return str(value).replace('_', '_5F').replace('^', '_5E').replace('~', '_7E')
+
+
+def render_zpl(labels):
+    """ Renders labels as ZPL of Zebra printers, one label per item: barcode (Code 128), project, box and position,
+        and number of label
+    """
+
+    for label in labels:
+        yield '^XA'
+        yield '^FO30,30^BY2^BCN,80,Y,N,N^FH_^FD%s^FS' % _zpl_field(label['barcode'])
+        yield '^FO30,150^A0N,28,28^FH_^FD%s %s %s^FS' % tuple(_zpl_field(label[field])
+                                                             for field in ['project', 'box', 'position'])
+        if(label.get('number') is not None):
+            yield '^FO30,190^A0N,22,22^FH_^FD#%s^FS' % _zpl_field(label['number'])
+        yield '^XZ'
+
+
+# Formats of print files: extension of file and render(labels) that returns the lines of the file
+# Another format is added with an entry here, and can be used by a printer or print request
+LABEL_FORMATS = {'text': {'extension': '.txt', 'render': render_text},
+                 'csv': {'extension': '.csv', 'render': render_csv},
+                 'zpl': {'extension': '.zpl', 'render': render_zpl}}
+
+
+class PrintSpooler():
+    """ Durable queue of print jobs, stored in SQLite, a worker thread renders them to print files
+
+    Arguments:
+            path {string} -- SQLite database file of the queue
+            print_dir {string} -- print directory
+            counter {LabelCounter} -- counter of label numbers
+            printers {dic} -- printer per name: {'directory': directory in print_dir, 'format': default format}
+            formats {dic} -- formats of print files, see LABEL_FORMATS (default: {LABEL_FORMATS})
+            window {float} -- seconds jobs are collected before they are printed (default: {2})
+            retention {int} -- seconds finished jobs are kept (default: {7 days})
+            owner {string} -- owner of the jobs this spooler prints, e.g. the worker slot of a multi-worker deployment,
+                              None when one process uses the queue (default: {None})
+
+    Conventions:
+        - all jobs are a dictionary with keys:
+            [id]            {str}      -- id of job
+            [printer]       {str}      -- name of printer
+            [format]        {str}      -- format of print file, key of formats
+            [status]        {str}      -- 'queued', 'running', 'finished' or 'failed'
+            [labels]        {int}      -- number of labels
+            [file]          {str}      -- name of print file, stored before it is written
+            [error]         {str}      -- error message, only when status is 'failed'
+            [createdOn], [finishedOn] {float} -- unix timestamps
+        - the labels of a job are numbered when it is submitted, with one range of the counter, so they keep their
+          numbers when the job is printed again
+        - the queued jobs of one printer and format are printed together in one file, when the oldest is window
+          seconds old, so many small requests do not make many small files
+        - a job is 'finished' in the same step as its print file is renamed (see write_print_file()), so a job is
+          printed once, also when printers remove the files they print. On start(), a print file of finished jobs
+          that was not renamed when the process stopped is renamed, and jobs that were running are queued again
+          (see JobQueue) after their partial print file is removed
+        - default_printer is printer 'default', or the first printer when there is no printer 'default'
+    """
+
+    def __init__(self, path, print_dir, counter, printers, formats=LABEL_FORMATS, window=2, retention=7*24*3600, owner=None):
+        """ Initialized is called when class in created
+        """
+
+        self._path = path
+        self._print_dir = print_dir
+        self._counter = counter
+        self._printers = printers
+        self._formats = formats
+        self._window = window
+        self._retention = retention
+        self._owner = owner
+        self.default_printer = 'default' if 'default' in printers else next(
+            iter(printers), None)
+        self._condition = threading.Condition()
+        self._started = False
+
+        for printer in printers.values():
+            directory = os.path.join(print_dir, printer.get('directory', ''))
+            if(not os.path.isdir(directory)):
+                logger.info('%s | Print directory %s does not exist -> created', filename, directory)
+                os.makedirs(directory)
+
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS print_jobs (
+                                id TEXT PRIMARY KEY, printer TEXT, format TEXT, status TEXT, labels TEXT,
+                                label_count INTEGER, file TEXT, error TEXT, batch TEXT, owner TEXT,
+                                created_on REAL, finished_on REAL)""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS print_jobs_status ON print_jobs (status, created_on)")
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=30)
+
+    def start(self):
+        """ Queues interrupted jobs again, removes old jobs and starts the worker thread
+        """
+
+        if(self._started):
+            return
+        self._started = True
+
+        with self._connect() as conn:
+            self._recover(conn)
+            if(self._owner is None):
+                requeued = conn.execute(
+                    "UPDATE print_jobs SET status = 'queued', batch = NULL WHERE status = 'running'").rowcount
+            else:
+                requeued = conn.execute("UPDATE print_jobs SET status = 'queued', batch = NULL WHERE status = 'running' AND (owner = ? OR owner IS NULL)",
+                                        (self._owner,)).rowcount
+            conn.execute("DELETE FROM print_jobs WHERE finished_on < ?",
+                         (time.time() - self._retention,))
+        if(requeued):
+            logger.warning('%s | %s interrupted print job(s) queued again', filename, requeued)
+
+        threading.Thread(target=self._work, name='print-spooler',
+                         daemon=True).start()
+
+    def _recover(self, conn):
+        """ Completes print files of jobs that were interrupted, before running jobs are queued again, see conventions
+        """
+
+        query = "SELECT DISTINCT printer, file, status FROM print_jobs WHERE status IN ('running', 'finished') AND file IS NOT NULL"
+        if(self._owner is None):
+            rows = conn.execute(query).fetchall()
+        else:
+            rows = conn.execute(query + " AND (owner = ? OR owner IS NULL)",
+                                (self._owner,)).fetchall()
+
+        for printer, name, status in rows:
+            if(printer not in self._printers):
+                continue
+            directory = os.path.join(
+                self._print_dir, self._printers[printer].get('directory', ''))
+            temporary_path = temporary_print_path(directory, name)
+            if(not os.path.isfile(temporary_path)):
+                continue
+            try:
+                if(status == 'finished'):
+                    os.replace(temporary_path, os.path.join(directory, name))
+                    logger.warning('%s | Print file %s of %s was finished but not renamed -> renamed',
+                                   filename, name, printer)
+                else:
+                    os.remove(temporary_path)
+            except OSError as e:
+                logger.error('%s | Recovering print file %s of %s failed: %s',
+                             filename, name, printer, e)
+
+    def printer(self, name):
+        """ Returns printer, None if it does not exist
+        """
+
+        return self._printers.get(name)
+
+    def submit(self, printer, label_format, labels):
+        """ Adds print job to queue
+
+        Arguments:
+            printer {string} -- name of printer
+            label_format {string} -- format of print file, key of formats
+            labels {list} -- labels, dictionaries with LABEL_FIELDS, they get a 'number' of the counter
+
+        Returns:
+            string -- id of job
+        """
+
+        if(printer not in self._printers):
+            raise ValueError('printer \'%s\' does not exist' % printer)
+        if(label_format not in self._formats):
+            raise ValueError('format \'%s\' does not exist' % label_format)
+        if(not labels):
+            raise ValueError('print job does not have labels')
+
+        # One range of numbers for all labels of job
+        first = self._counter.reserve(len(labels))
+        labels = [dict(label, number=first + i)
+                  for i, label in enumerate(labels)]
+
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute("INSERT INTO print_jobs (id, printer, format, status, labels, label_count, created_on) VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                         (job_id, printer, label_format, json.dumps(labels), len(labels), time.time()))
+
+        with self._condition:
+            self._condition.notify_all()
+
+        logger.info('%s | Print job %s (%s labels, %s) queued', filename, job_id, len(labels), printer)
+        return job_id
+
+    def get(self, job_id):
+        """ Returns job, see conventions, None if it does not exist
+        """
+
+        with self._connect() as conn:
+            row = conn.execute("SELECT id, printer, format, status, label_count, file, error, created_on, finished_on FROM print_jobs WHERE id = ?",
+                               (job_id,)).fetchone()
+        if(row is None):
+            return None
+
+        return {'id': row[0], 'printer': row[1], 'format': row[2], 'status': row[3], 'labels': row[4],
+                'file': row[5], 'error': row[6], 'createdOn': row[7], 'finishedOn': row[8]}
+
+    def wait(self, job_id, timeout):
+        """ Returns job when it is finished or failed, or when timeout seconds have passed
+        """
+
+        end = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = end - time.monotonic()
+            if(job is None or job['status'] in ['finished', 'failed'] or remaining <= 0):
+                return job
+            with self._condition:
+                self._condition.wait(min(remaining, 1))
+
+    def size(self):
+        """ Returns number of jobs per status, e.g. {'queued': 2, 'running': 1}
+        """
+
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM print_jobs WHERE status IN ('queued', 'running') GROUP BY status").fetchall())
+
+    def _claim(self):
+        """ Marks queued jobs of printer and format of oldest job as running, when the oldest is window seconds old
+
+        Returns:
+            tuple -- (batch, printer, format), or (None, seconds to wait) when no jobs can be printed yet
+        """
+
+        with self._connect() as conn:
+            while True:
+                row = conn.execute(
+                    "SELECT printer, format, created_on FROM print_jobs WHERE status = 'queued' ORDER BY created_on LIMIT 1").fetchone()
+                if(row is None):
+                    return None, 1
+                wait = row[2] + self._window - time.time()
+                if(wait > 0):
+                    return None, wait
+
+                # Other processes may claim the same jobs, a job is only claimed by one of them
+                batch = uuid.uuid4().hex
+                claimed = conn.execute("UPDATE print_jobs SET status = 'running', batch = ?, owner = ? WHERE status = 'queued' AND printer = ? AND format = ?",
+                                       (batch, self._owner, row[0], row[1])).rowcount
+                conn.commit()
+                if(claimed):
+                    return batch, row[0], row[1]
+
+    def _work(self):
+        while True:
+            claim = self._claim()
+            if(claim[0] is None):
+                # Wait for new job or window of oldest job, check every second for jobs of other processes
+                with self._condition:
+                    self._condition.wait(min(claim[1], 1))
+                continue
+
+            self._print(*claim)
+
+    def _print(self, batch, printer, label_format):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, labels FROM print_jobs WHERE batch = ? ORDER BY created_on",
+                                (batch,)).fetchall()
+
+        directory = os.path.join(
+            self._print_dir, self._printers[printer].get('directory', ''))
+
+        def finish():
+            # Jobs are finished right before the print file is renamed, see conventions
+            with self._connect() as conn:
+                conn.execute("UPDATE print_jobs SET status = 'finished', finished_on = ? WHERE batch = ? AND status = 'running'",
+                             (time.time(), batch))
+
+        try:
+            labels = [label for row in rows for label in json.loads(row[1])]
+            file_format = self._formats[label_format]
+            date_string = datetime.datetime.strftime(
+                datetime.datetime.now(), "%Y-%m-%d_%H_%M_%S")
+            # Print file is named after its first label, numbers of labels are unique
+            name = date_string + "_Labels_" + \
+                str(labels[0]['number']) + file_format['extension']
+            # Name is stored before the file is written, see _recover()
+            with self._connect() as conn:
+                conn.executemany("UPDATE print_jobs SET file = ? WHERE id = ?",
+                                 [(name, row[0]) for row in rows])
+            write_print_file(directory, name,
+                             file_format['render'](labels), commit=finish)
+        except Exception as e:
+            logger.exception('%s | Print jobs %s failed: %s', filename, ', '.join(row[0] for row in rows), e)
+            with self._connect() as conn:
+                conn.execute("UPDATE print_jobs SET status = 'failed', error = ?, finished_on = ? WHERE batch = ? AND status = 'running'",
+                             (str(e), time.time(), batch))
+        else:
+            logger.info('%s | Print file %s of %s (%s labels, %s job(s)) written',
+                        filename, name, printer, len(labels), len(rows))
+
+        with self._condition:
+            self._condition.notify_all()
@@ -0,0 +1,104 @@
+import cProfile
+import hmac
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+# Set logging, handlers and levels are set by logging_setup.setup_logging()
+filename = 'profiling.py'
+logger = logging.getLogger(filename)
+
+# Default settings of profiler, see Profiler
+DEFAULT_PROFILING = {'sample_rate': 0.0, 'key': None,
+                     'directory': 'profiles', 'max_files': 100}
+
+
+class Profiler():
+    """ Profiles live requests with cProfile, and writes the call graph of every profiled request to a file
+
+    Arguments:
+            sample_rate {float} -- fraction of requests that is profiled, 0.0 is none (default: {0.0})
+            key {string} -- secret, a request with header 'X-Profile: <key>' is always profiled, None is never (default: {None})
+            directory {string} -- directory of profiles (default: {'profiles'})
+            max_files {int} -- maximum number of profiles in directory, the oldest are removed (default: {100})
+
+    Conventions:
+        - profiles are pstats files named '<unix time>_<route>_<correlation id>.prof',
+          e.g. read with: python -m pstats profiles/<file>
+        - one request is profiled at a time, other requests are not profiled while it runs
+        - only the thread of the request is profiled, not the threads it waits for (e.g. exports, hedged requests)
+    """
+
+    def __init__(self, sample_rate=0.0, key=None, directory='profiles', max_files=100):
+        """ Initialized is called when class in created
+        """
+
+        self._sample_rate = sample_rate
+        self._key = key
+        self._directory = directory
+        self._max_files = max_files
+        self._lock = threading.Lock()
+
+    def enabled(self):
+        return self._sample_rate > 0 or self._key is not None
+
+    def start(self, profile_header=None):
+        """ Starts profiling current request when it is sampled, or asked for with the key
+
+        Arguments:
+            profile_header {string} -- value of 'X-Profile' header of request (default: {None})
+
+        Returns:
+            cProfile.Profile -- running profile, None if request is not profiled
+        """
+
+        asked = self._key is not None and profile_header is not None and hmac.compare_digest(
+            profile_header, self._key)
+        if(not asked and random.random() >= self._sample_rate):
+            return None
+        if(not self._lock.acquire(blocking=False)):
+            # Other request is profiled
+            return None
+
+        try:
+            profile = cProfile.Profile()
+            profile.enable()
+        except Exception:
+            self._lock.release()
+            raise
+        return profile
+
+    def stop(self, profile, route, correlation_id):
+        """ Stops profile and writes it to directory
+
+        Returns:
+            string -- file name of profile
+        """
+
+        try:
+            profile.disable()
+        finally:
+            self._lock.release()
+
+        name = '%.6f_%s_%s.prof' % (time.time(), re.sub(
+            r'[^A-Za-z0-9]+', '-', route).strip('-') or 'root', correlation_id)
+        os.makedirs(self._directory, exist_ok=True)
+        profile.dump_stats(os.path.join(self._directory, name))
+        self._prune()
+        logger.info('%s | Profile of %s written to %s', filename, route, name)
+        return name
+
+    def _prune(self):
+        """ Removes oldest profiles, when there are more than max_files
+        """
+
+        profiles = sorted(file_name for file_name in os.listdir(
+            self._directory) if file_name.endswith('.prof'))
+        for file_name in profiles[:max(len(profiles) - self._max_files, 0)]:
+            try:
+                os.remove(os.path.join(self._directory, file_name))
+            except OSError:
+                pass
@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+"""
+    Context of the backend request that is handled by the current thread:
+        - correlation id, sent to CDD as 'X-Correlation-ID' header and added to log records as 'correlation_id'
+        - timings, only collected when the client asks for them, see server.make_response_object()
+
+    Threads that work for a request (e.g. a background job) call start() with the correlation id of the request.
+"""
+
+_local = threading.local()
+
+
+def start(correlation_id=None, timings=False):
+    """ Starts context of request in this thread
+
+    Keyword Arguments:
+        correlation_id {string} -- correlation id, a new one is made when None (default: {None})
+        timings {bool} -- collect timings of request (default: {False})
+
+    Returns:
+        string -- correlation id
+    """
+
+    _local.correlation_id = correlation_id or uuid.uuid4().hex
+    _local.timings = [] if timings else None
+    return _local.correlation_id
+
+
+def end():
+    _local.correlation_id = None
+    _local.timings = None
+
+
+def get_correlation_id():
+    return getattr(_local, 'correlation_id', None)
+
+
+def get_timings():
+    """ Returns timings of request, None when they are not collected
+
+    Returns:
+        list -- [{'name': {str}, 'seconds': {float}, 'count': {int}, ...details}]
+    """
+
+    return getattr(_local, 'timings', None)
+
+
+def add_timing(name, seconds, **details):
+    """ Adds seconds to timing name, timings with the same name and details are summed
+    """
+
+    timings = get_timings()
+    if(timings is None):
+        return
+    for timing in timings:
+        if(timing['name'] == name and all(timing.get(key) == value for key, value in details.items())
+           and len(timing) == len(details) + 3):
+            timing['seconds'] += seconds
+            timing['count'] += 1
+            return
+    timings.append(dict(details, name=name, seconds=seconds, count=1))
+
+
+@contextmanager
+def timed(name, **details):
+    """ Adds duration of with-block to timing name, see add_timing()
+    """
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(name, time.perf_counter() - start_time, **details)
+
+
+_record_factory = logging.getLogRecordFactory()
+
+
+def _make_record(*args, **kwargs):
+    record = _record_factory(*args, **kwargs)
+    record.correlation_id = get_correlation_id() or '-'
+    return record
+
+
+# All log records have the correlation id of the request
+logging.setLogRecordFactory(_make_record)
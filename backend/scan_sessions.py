@@ -0,0 +1,170 @@
+import threading
+import time
+import uuid
+
+
+class ScanSessions():
+    """ Server-side scan sessions, scans are validated when they are added and submitted to CDD on commit
+
+    Arguments:
+            ttl {int} -- seconds an unused session is kept (default: {1 hour})
+            commit_timeout {int} -- seconds after which a session that is still committing is open again (default: {10 minutes})
+
+    Conventions:
+        - all sessions are a dictionary with keys:
+            [id]            {str}      -- id of session
+            [type]          {str}      -- scan type, key of server.SCAN_TYPES
+            [project]       {dic}      -- {'id': {int}, 'name': {str}}
+            [status]        {str}      -- 'open', 'committing' or 'committed'
+            [items]         {dic}      -- scanned items by barcode: {'scanData': {dic}, 'batch': {dic}}
+            [result]        {dic}      -- result of commit, only when status is 'committed'
+            [createdOn], [updatedOn] {float} -- unix timestamps
+        - a barcode is reserved by one open session at a time, it is released on commit or when the session expires
+        - a commit that did not end within commit_timeout (e.g. the process stopped) is given up, the session is open
+          again and can be committed again
+        - sessions are kept in memory of this process, returned sessions are copies
+    """
+
+    def __init__(self, ttl=3600, commit_timeout=600):
+        """ Initialized is called when class in created
+        """
+
+        self._ttl = ttl
+        self._commit_timeout = commit_timeout
+        self._sessions = {}
+        self._reserved = {}  # Session id by reserved barcode
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        """ Removes sessions that are not used for ttl seconds, and opens sessions that are committing for
+            commit_timeout seconds again, lock must be held
+        """
+
+        now = time.time()
+        for session in self._sessions.values():
+            if(session['status'] == 'committing' and session['updatedOn'] < now - self._commit_timeout):
+                session['status'] = 'open'
+                session['updatedOn'] = now
+        for session_id in [session_id for session_id, session in self._sessions.items()
+                           if session['updatedOn'] < now - self._ttl and session['status'] != 'committing']:
+            self._release(self._sessions.pop(session_id))
+
+    def _release(self, session):
+        """ Releases reserved barcodes of session, lock must be held
+        """
+
+        for barcode in session['items']:
+            if(self._reserved.get(barcode) == session['id']):
+                del self._reserved[barcode]
+
+    def _copy(self, session):
+        """ Returns copy of session, that is not changed by other threads, lock must be held
+        """
+
+        return dict(session, items=dict(session['items']))
+
+    def open(self, scan_type, project):
+        """ Opens session for scan type and project, returns session
+        """
+
+        now = time.time()
+        session = {'id': uuid.uuid4().hex, 'type': scan_type, 'project': project, 'status': 'open', 'items': {},
+                   'result': None, 'createdOn': now, 'updatedOn': now}
+        with self._lock:
+            self._expire()
+            self._sessions[session['id']] = session
+            return self._copy(session)
+
+    def get(self, session_id):
+        """ Returns session, None if it does not exist (or expired)
+        """
+
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            return self._copy(session) if session else None
+
+    def size(self):
+        """ Returns number of sessions per status, e.g. {'open': 2}
+        """
+
+        with self._lock:
+            sizes = {}
+            for session in self._sessions.values():
+                sizes[session['status']] = sizes.get(session['status'], 0) + 1
+            return sizes
+
+    def add(self, session_id, item, batch):
+        """ Adds validated item to open session and reserves its barcode
+
+        Arguments:
+            session_id {string} -- id of session
+            item {dic} -- scanned item, see server.submit_items()
+            batch {dic} -- batch of barcode in CDD
+
+        Returns:
+            string -- 'added', 'duplicate' (already in session), 'reserved' (in other open session)
+                      or 'closed' (session does not exist or is not open)
+        """
+
+        barcode = item['barcode']
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if(session is None or session['status'] != 'open'):
+                return 'closed'
+            session['updatedOn'] = time.time()
+            if(barcode in session['items']):
+                return 'duplicate'
+            if(self._reserved.get(barcode, session_id) != session_id):
+                return 'reserved'
+            self._reserved[barcode] = session_id
+            session['items'][barcode] = {'scanData': item, 'batch': batch}
+        return 'added'
+
+    def remove(self, session_id, barcode):
+        """ Removes item from open session, returns False if barcode is not in session or session is not open
+        """
+
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if(session is None or session['status'] != 'open'):
+                return False
+            session['updatedOn'] = time.time()
+            if(session['items'].pop(barcode, None) is None):
+                return False
+            if(self._reserved.get(barcode) == session_id):
+                del self._reserved[barcode]
+        return True
+
+    def begin_commit(self, session_id):
+        """ Marks open session as committing, so no items are added while it is submitted
+
+        Returns:
+            string, dic -- previous status of session ('open', 'committing' or 'committed') and session,
+                           None, None if session does not exist
+        """
+
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if(session is None):
+                return None, None
+            status = session['status']
+            if(status == 'open'):
+                session['status'] = 'committing'
+                session['updatedOn'] = time.time()
+            return status, self._copy(session)
+
+    def end_commit(self, session_id, result=None):
+        """ Marks session as committed with result {dic} and releases its barcodes, without result the session is open again
+        """
+
+        with self._lock:
+            session = self._sessions[session_id]
+            session['updatedOn'] = time.time()
+            if(result is None):
+                session['status'] = 'open'
+                return
+            session['status'] = 'committed'
+            session['result'] = result
+            self._release(session)
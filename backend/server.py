@@ -1,10 +1,14 @@
 import time
 import datetime
+import hmac
+import ipaddress
 import jwt
 import json
 import logging
 import os
-from flask import Flask, request, make_response
+import re
+import threading
+from flask import Flask, Response, g, request, make_response
 from flask_cors import CORS
 from functools import wraps
 from cryptography.hazmat.primitives import serialization
@@ -14,9 +18,23 @@ from cryptography.hazmat.backends import default_backend
 from base64 import b64decode
 
 import ldap_connection
-from api_cdd import ApiCDD
+from api_cdd import ApiCDD, Deadline, INTERACTIVE, BACKGROUND
+from jobs import JobQueue
+from journal import Journal, JournalError, PERMANENT_FAILURE_STATUSSES
+from idempotency import IdempotencyStore
+from logging_setup import setup_logging
+from batch_snapshot import BatchSnapshot
+from multi_worker import SharedBatchSnapshot, SharedChangeFeed, SharedScanSessions, SnapshotStore, claim_worker_slot, \
+    DEFAULT_MULTI_WORKER
+from scan_sessions import ScanSessions
+from change_feed import ChangeFeed
+from metrics import METRICS
+import request_context
+from profiling import Profiler, DEFAULT_PROFILING
 from box_functions_9x9 import *
-from ldap_connection import ldap_connection, PRIVATE_KEY
+from ldap_connection import ldap_connection
+from config import load_config, set_config, get_private_key, ConfigError
+from printing import LabelCounter, PrintSpooler, LABEL_FORMATS, DEFAULT_PRINT_SPOOLER
 
 """
     Conventions:
@@ -33,6 +51,11 @@ from ldap_connection import ldap_connection, PRIVATE_KEY
                         >> [response]   {dic}
                             * [message]     {string}    -- Response message
                             * [output]      {dic}       -- Reponse data, this contains the important data
+                        >> [correlationId]  {string}    -- Id of request in logs and CDD requests, given by client as
+                                                           'X-Correlation-ID' header or made by server
+                        >> [timings]    {dic}   -- Only when asked by 'X-Timings: true' header or 'timings=true' query:
+                            * [totalSeconds]    {float}     -- Seconds since start of request
+                            * [steps]           {list}      -- Seconds per step, e.g. auth, batchFetch, query, validation, cdd, serialization
                 > [cddRequest]      {dic}   -- request made to CDD server, through api_cdd.py
                         >> [request]    {dic}
                         >> [response]   {dic}
@@ -40,90 +63,172 @@ from ldap_connection import ldap_connection, PRIVATE_KEY
     Status codes:
         status  --  statusText              -- Description
         200     --  OK                      -- The request was successfully completed.
+        202     --  Accepted                -- The request is accepted and is (being) processed as background job.
         400     --  Bad request             -- The request was invalid.
         401     --  Unauthorized            -- The request did not include an authentication token or the authentication token was expired.
+        404     --  Not Found               -- The requested resource (e.g. job) does not exist.
+        409     --  Conflict                -- A request with the same idempotency key is still in progress.
         500     --  Internal Server Error   -- The request was not completed due to an internal error on the server side.
+        504     --  Gateway Timeout         -- The request was not completed within its time budget, because CDD is too slow.
 """
 
-# Set logging
+# Set logging, handlers and levels are set by logging_setup.setup_logging()
 filename = 'server.py'
 logger = logging.getLogger(filename)
-logger.setLevel(level=logging.DEBUG)  # When debugging put to loggin.DEBUG
-formatter = logging.Formatter("%(levelname)s | %(message)s")
-ch = logging.StreamHandler()
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-
-# Check if counter file exist, needed for print-file ID's
-if(not os.path.isfile('counter.json')):
-    print('> counter.json does not exist -> created')
-    with open('counter.json', 'w') as counter_file:
-        dic = {'counter': 0}
-        counter_file.write(json.dumps(dic))
-
-# Check if settings file exist, this file is mandatory
-if(not os.path.isfile('settings.json')):
-    print('> please create settings.json file with keys:')
-    print('* ssl_directory - directory of public_key.pem, private_key.pem and requirements.txt')
-    print('* print_directory - directory where print files must me stored')
-    exit()
-
-# Read settings file
-with open('settings.json') as settings_file:
-    settings = json.load(settings_file)
-    ssl_dir = settings['ssl_directory']
-    print_dir = settings['print_directory']
-    if(not os.path.isdir(print_dir)):
-        print('> print directory does not exist -> created')
-        os.mkdir(print_dir)
-
-# Check if requirements file exist, this file is mandatory
-with open(ssl_dir + 'requirements.txt') as json_file:
-    requirements = json.load(json_file)
-    BASE_URL = "https://app.collaborativedrug.com/api/v1/vaults/%s/" % (
-        requirements['cdd_vault_id'])
-    TOKEN = requirements['cdd_token']
-    SECRET_KEY = requirements['secret_key']
-
-# Create CDD API Connection
-ApiCdd = ApiCDD(BASE_URL, TOKEN)
-
-# Create local API Connection for server
+
+# Configuration, clients and stores of the backend, they are created by create_app(), so importing this module does not
+# read files or start threads
+settings = None
+print_dir = None
+ApiCdd = None
+JOURNAL_MODE = 'off'
+JOURNAL = None
+IDEMPOTENCY = None
+SCAN_SESSIONS = None
+CHANGE_FEED = None
+BATCH_SNAPSHOT = None
+JOB_QUEUE = None
+LABEL_COUNTER = None
+PRINT_SPOOLER = None
+
+# Profiling of live requests, see Profiler and create_app(), disabled until the app is created
+PROFILER = Profiler()
+
+# Access to /metrics, see 'metrics' setting: addresses (networks) that may scrape it, and key of other scrapers
+DEFAULT_METRICS = {'allow': ['127.0.0.1', '::1'], 'key': None}
+METRICS_ACCESS = {'allow': [], 'key': None}
+
+# Correlation ids of clients that are accepted, other ids are replaced by a new one
+CORRELATION_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+# Seconds after which /feed sends a keep-alive when there are no changes
+FEED_KEEPALIVE = 15
+
+# Time budget in seconds per route, all CDD requests of a route together never exceed it, see 'route_deadlines' setting
+# 'submitjob' is the budget of a submission that runs as background job, see /submitdata
+ROUTE_DEADLINES = {'projects': 30, 'batches': 60, 'getlocation': 60, 'validatebarcodes': 60, 'getlastlocation': 60,
+                   'sessions': 60, 'submitdata': 300, 'submitjob': 1800}
+
+# Per scan type, status of batch after the scan and the statusses that are allowed before the scan
+SCAN_TYPES = {
+    'Add': {'to_status': 'Added', 'allowed_statusses': ['Registered']},
+    'Check-in': {'to_status': 'Checked in', 'allowed_statusses': ['Checked out']},
+    'Check-out': {'to_status': 'Checked out', 'allowed_statusses': ['Added', 'Checked in']},
+    'Delete': {'to_status': 'Deleted', 'allowed_statusses': ['Added', 'Checked in', 'Checked out']}
+}
+
+# Create local API Connection for server, configured by create_app()
 app = Flask(__name__)
-app.config['SECRET_KEY'] = SECRET_KEY
 cors = CORS(app)
-if __name__ == "__main__":
-    app.run(debug=True, port=5000)
-    # app.run(debug=True, port=5000, ssl_context=(
-    #     './ssl/server.crt', './ssl/server.key'))
+_create_lock = threading.Lock()
 
 
 def make_response_object(status, message=None, request=None, output=None, cdd_request=None):
-    data = {'backendRequest': {'request': request, 'response': {'message': message, 'output': output}},
+    data = {'backendRequest': {'request': request, 'response': {'message': message, 'output': output},
+                               'correlationId': request_context.get_correlation_id()},
             'cddRequest': cdd_request}
 
+    timings = request_context.get_timings()
+    if(timings is not None):
+        # Client asked for timings, serialization is measured by serializing the response once more
+        with request_context.timed('serialization'):
+            json.dumps(data)
+        data['backendRequest']['timings'] = {'totalSeconds': time.monotonic() - g.request_start,
+                                             'steps': timings}
+
     response = make_response(data, status)
     return response
 
 
-def token_required(f):
+def make_cdd_error_response(backend_request, cdd_request):
+    """ Returns response when a CDD request failed, 504 if the time budget of the request was exceeded, else 500
+    """
+
+    if(cdd_request['response']['status'] == 504):
+        message = 'Gateway Timeout: time budget of request exceeded, please check cdd-request'
+        return make_response_object(status=504, message=message, request=backend_request, output=None, cdd_request=cdd_request)
+
+    message = 'CDD Error: please check cdd-request'
+    return make_response_object(status=500, message=message, request=backend_request, output=None, cdd_request=cdd_request)
+
+
+@ app.before_request
+def start_request_metrics():
+    """ Starts context of request, with correlation id of client ('X-Correlation-ID' header) or a new one
+        Timings are collected when asked for by 'X-Timings' header or 'timings' query argument, see make_response_object()
+    """
+
+    g.request_start = time.monotonic()
+    METRICS.add('http_requests_in_flight', 1)
+
+    correlation_id = request.headers.get('X-Correlation-ID')
+    if(correlation_id and not CORRELATION_ID_PATTERN.fullmatch(correlation_id)):
+        correlation_id = None
+    timings = (request.headers.get('X-Timings')
+               or request.args.get('timings', '')).lower() in ['1', 'true']
+    request_context.start(correlation_id, timings)
+
+    g.profile = PROFILER.start(request.headers.get(
+        'X-Profile')) if PROFILER.enabled() else None
+
+
+@ app.after_request
+def store_request_metrics(response):
+    """ Stores duration and status of request in METRICS, per route
+    """
+
+    labels = {'route': request.url_rule.rule if request.url_rule else 'unknown',
+              'method': request.method}
+    METRICS.observe('http_request_duration_seconds',
+                    time.monotonic() - g.request_start, labels)
+    METRICS.inc('http_requests_total', dict(
+        labels, status=str(response.status_code)))
+    response.headers['X-Correlation-ID'] = request_context.get_correlation_id()
+    if(g.get('profile')):
+        response.headers['X-Profile'] = stop_profile()
+    return response
+
+
+@ app.teardown_request
+def end_request_metrics(exception=None):
+    METRICS.add('http_requests_in_flight', -1)
+    if(g.get('profile')):
+        # Request failed before after_request
+        stop_profile()
+    request_context.end()
+
+
+def stop_profile():
+    """ Stops profile of request and writes it to profiling directory, returns file name
+    """
+
+    profile = g.pop('profile')
+    return PROFILER.stop(profile, request.url_rule.rule if request.url_rule else 'unknown',
+                         request_context.get_correlation_id())
+
+
+def token_required(f, query=False):
     """ Decorator that secures function by a token, only if the correct token is given the function can be called
 
     Args:
         f (function)
+        query (bool): the token may also be given in the query string, see query_token_required()
 
     """
 
     @ wraps(f)
     def decorated(*args, **kwargs):
-        token = request.headers['Token']
+        token = request.headers.get('Token')
+        if(not token and query):
+            token = request.args.get('token')
 
         if not token:
             logger.critical('%s | %s', filename, 'Token is missing')
             return make_response_object(401, 'Token is missing')
 
         try:
-            data = jwt.decode(token, app.config['SECRET_KEY'])
+            with request_context.timed('auth'):
+                data = jwt.decode(token, app.config['SECRET_KEY'])
             logger.debug('%s | %s', filename, 'Token valid')
         except Exception as e:
             logger.error('%s | %s | %s', filename, 'Token invalid', e)
@@ -134,6 +239,19 @@ def token_required(f):
     return decorated
 
 
+def query_token_required(f):
+    """ Decorator as token_required(), that also accepts the token in the query string ('?token=<token>'), only for
+        /feed: EventSource of browsers can not set headers. Other routes only accept the 'Token' header, so tokens
+        do not end up in urls (and logs of proxies)
+
+    Args:
+        f (function)
+
+    """
+
+    return token_required(f, query=True)
+
+
 @ app.route('/projects', methods=['GET'])
 @ token_required
 def get_projects():
@@ -147,7 +265,8 @@ def get_projects():
     backend_request = {'type': 'GET', 'url': request.host_url +
                        'projects', 'headers': dict(request.headers)}
 
-    cdd_request = ApiCdd.request_projects()
+    cdd_request = ApiCdd.request_projects(
+        deadline=Deadline(ROUTE_DEADLINES['projects']), hedge=True)
 
     status = cdd_request['response']['status']
     if(cdd_request['response']['status'] == 200):
@@ -155,50 +274,110 @@ def get_projects():
         output = {'projects': cdd_request['response']['json']}
         return make_response_object(status=status, message=message, request=backend_request, output=output, cdd_request=None)
     else:
-        message = 'CDD Error: please check cdd-request'
-        return make_response_object(status=500, message=message, request=backend_request, output=None, cdd_request=cdd_request)
+        return make_cdd_error_response(backend_request, cdd_request)
 
 
-@ app.route('/batches', methods=['GET'])
-@ token_required
-def get_batches(id=None):
-    """ Returns all batches in Vault
+def fetch_batches(id=None, deadline=None, hedge=False, priority=INTERACTIVE):
+    """ Requests batches from CDD, they are validated when the snapshot is built, see batch_ingest.py
+        NOTE: An asynchronous export of other caller is not reused, the snapshot keeps only updates made since the
+              load started (see BatchSnapshot._install()), so its batches may not be older
 
-    Type: GET-request
+    Arguments:
+        id {int} -- only batches of project with id (default: {None})
+        deadline {Deadline} -- time budget (default: {None})
+        hedge {bool} -- hedge CDD request, for interactive lookups (default: {False})
+        priority {string} -- INTERACTIVE or BACKGROUND, see ApiCDD (default: {INTERACTIVE})
 
     Returns:
-        dic -- response, see make_response_object()
+        int, string, list, dic -- status, message, batches (None if failed) and cdd-request (None if success)
     """
-    backend_request = {'type': 'GET', 'url': request.host_url +
-                       'batches', 'headers': dict(request.headers)}
 
     if(id):
         cdd_request = ApiCdd.request_batches(
-            page_size=999, projects=id)
+            priority=priority, deadline=deadline, hedge=hedge, reuse_export=False, page_size=999, projects=id)
     else:
         cdd_request = ApiCdd.request_batches(
-            page_size=999)
+            priority=priority, deadline=deadline, hedge=hedge, reuse_export=False, page_size=999)
 
-    status = cdd_request['response']['status']
-    if(cdd_request['response']['status'] == 200):
+    if(cdd_request['response']['status'] != 200):
+        if(cdd_request['response']['status'] == 504):
+            return 504, 'Gateway Timeout: time budget of request exceeded, please check cdd-request', None, cdd_request
+        return 500, 'CDD Error: please check cdd-request', None, cdd_request
 
-        # A check if bactches are not assigned to multiple projects.
-        batches = cdd_request['response']['json']['objects']
-        for batch in batches:
-            if(len(batch['projects']) > 1):
-                # batch is assigned to different projects, this cannot occcur by convention
-                message = 'Error: batch {0} found in multiple projects ({1}), this cannot occur. Batch data: {2}'.format(batch['id'], batch['projects'],
-                                                                                                                         batch)
-                status = 500
-                return make_response_object(status=status, message=message,
-                                            request=backend_request, output=None, cdd_request=cdd_request)
+    batches = cdd_request['response']['json']['objects']
+    if(JOURNAL):
+        # Show updates in journal that are not yet in CDD
+        pending_fields = JOURNAL.pending_fields()
+        if(pending_fields):
+            batches = [dict(batch, batch_fields=dict(batch['batch_fields'], **pending_fields[batch['id']]))
+                       if batch['id'] in pending_fields else batch for batch in batches]
 
-        message = 'All requests successfully completed.'
-        output = {'batches': batches}
-        return make_response_object(status=status, message=message, request=backend_request, output=output, cdd_request=None)
-    else:
-        message = 'CDD Error: please check cdd-request'
-        return make_response_object(status=500, message=message, request=backend_request, output=None, cdd_request=cdd_request)
+    return 200, 'All requests successfully completed.', batches, None
+
+
+@ app.route('/batches', methods=['GET'])
+@ token_required
+def get_batches():
+    """ Returns (valid) batches in Vault, from the snapshot of batches, see Snapshot.query()
+
+    Type: GET-request
+
+    Input from query string (all optional, lists are comma-separated):
+        project -- ids of projects
+        status -- statusses, e.g. 'Checked in,Checked out'
+        barcode -- vial barcodes
+        location -- prefix of location, e.g. 'FJM-1-' for box 1 of project FJM
+        fields -- fields of batch_fields that are returned, e.g. 'Vial barcode,Location' (id and projects are always returned)
+        limit -- maximum number of batches, default is all
+        cursor -- [nextCursor] of previous page
+
+    Returns:
+        dic -- response, see make_response_object()
+               output: {'batches': [list of batches in order of id], 'count': {int}, 'nextCursor': {int} or None if last page}
+    """
+    backend_request = {'type': 'GET', 'url': request.url,
+                       'headers': dict(request.headers)}
+
+    def split(key):
+        value = request.args.get(key)
+        return None if value is None else [item for item in value.split(',') if item]
+
+    try:
+        projects = split('project')
+        projects = None if projects is None else set(
+            int(project) for project in projects)
+        after = request.args.get('cursor')
+        after = None if after is None else int(after)
+        limit = request.args.get('limit')
+        limit = None if limit is None else int(limit)
+        if(limit is not None and limit < 1):
+            raise ValueError('limit must be at least 1')
+    except ValueError as e:
+        message = 'Error: Bad request: [project], [cursor] and [limit] must be integers: {0}'.format(
+            str(e))
+        logger.error('%s | %s', filename, message)
+        return make_response_object(status=400, message=message, request=backend_request)
+    statuses = split('status')
+    fields = split('fields')
+
+    with request_context.timed('batchFetch'):
+        status, message, snapshot, cdd_request = BATCH_SNAPSHOT.get(
+            deadline=Deadline(ROUTE_DEADLINES['batches']))
+    if(status != 200):
+        return make_response_object(status=status, message=message, request=backend_request, output=None, cdd_request=cdd_request)
+
+    with request_context.timed('query'):
+        batches, next_cursor = snapshot.query(projects=projects, statuses=None if statuses is None else set(statuses),
+                                              barcodes=split('barcode'), location=request.args.get('location'),
+                                              after=after, limit=limit)
+        if(fields is not None):
+            # Projection, only requested fields are serialized
+            batches = [{'id': batch['id'], 'projects': batch['projects'],
+                        'batch_fields': {field: batch['batch_fields'].get(field) for field in fields}} for batch in batches]
+
+    output = {'batches': batches, 'count': len(batches),
+              'nextCursor': next_cursor}
+    return make_response_object(status=status, message=message, request=backend_request, output=output)
 
 
 @ app.route('/getlocation', methods=['POST'])
@@ -213,6 +392,7 @@ def get_location():
     """
     # Get input from POST-request
     post_data = request.json
+    deadline = Deadline(ROUTE_DEADLINES['getlocation'])
 
     backend_request = {'type': 'POST', 'url': request.host_url +
                        'getlocation', 'headers': dict(request.headers), 'json': post_data}
@@ -229,70 +409,138 @@ def get_location():
             status=400, message=message, request=backend_request)
 
     scan_type = post_data['type']
-    if(scan_type == 'Add'):
-        allowed_statusses = ['Registered']
+    if(scan_type not in SCAN_TYPES):
+        message = 'Error: Bad request: scan type \'{0}\' is not valid'.format(
+            scan_type)
+        logger.error('%s | %s', filename, message)
+        return make_response_object(
+            status=400, message=message, request=backend_request)
 
-    elif(scan_type == 'Check-in'):
-        allowed_statusses = ['Checked out']
+    # Get snapshot of all batches in vault
+    with request_context.timed('batchFetch'):
+        status, message, snapshot, cdd_request = BATCH_SNAPSHOT.get(
+            deadline=deadline, hedge=True)
+    if(status != 200):
+        return make_response_object(status=status, message=message, request=backend_request, output=None, cdd_request=cdd_request)
 
-    elif(scan_type == 'Check-out'):
-        allowed_statusses = ['Added', 'Checked in']
+    with request_context.timed('validation'):
+        output, message = validate_barcode(
+            snapshot, scan_type, request_project_id, request_barcode)
 
-    elif(scan_type == 'Delete'):
-        allowed_statusses = ['Added', 'Checked in',
-                             'Checked out']
-    else:
+    return make_response_object(status=200, message=message, output=output, request=backend_request)
+
+
+@ app.route('/validatebarcodes', methods=['POST'])
+@ token_required
+def validate_barcodes():
+    """ Returns location and status of multiple batches, e.g. a whole rack, see get_location()
+
+    Type: POST-request
+
+    Input from POST-request:
+        dic -- {'type': [scan type], 'project': {'name': [name of project],'id': [id of project]}, 'barcodes': [list of barcodes]}
+
+    Returns:
+        dic -- response, see make_response_object()
+               output: {'allValid': {bool}, 'barcodes': [list of output of get_location() with keys 'barcode', 'message' and 'isDuplicate']}
+    """
+    # Get input from POST-request
+    post_data = request.json
+    deadline = Deadline(ROUTE_DEADLINES['validatebarcodes'])
+
+    backend_request = {'type': 'POST', 'url': request.host_url +
+                       'validatebarcodes', 'headers': dict(request.headers), 'json': post_data}
+
+    try:
+        # Try to get id of project and barcodes
+        request_project_id = post_data['project']['id']
+        request_barcodes = list(post_data['barcodes'])
+        scan_type = post_data['type']
+    except Exception as e:
+        # Else, return
+        message = 'Bad request: [type] or [project][id] or [barcodes] not in request data'
+        logger.error('%s | %s | %s', filename, message, e)
+        return make_response_object(
+            status=400, message=message, request=backend_request)
+
+    if(scan_type not in SCAN_TYPES):
         message = 'Error: Bad request: scan type \'{0}\' is not valid'.format(
             scan_type)
         logger.error('%s | %s', filename, message)
         return make_response_object(
             status=400, message=message, request=backend_request)
 
-    # Get all batches in vault
-    batch_request = get_batches()
-    request_data = batch_request.json
-    if(batch_request.status_code != 200):
-        return make_response_object(status=batch_request.status_code, message=request_data['backendRequest']['response']['message'], request=backend_request, output=None, cdd_request=request_data['cddRequest'])
+    # Get snapshot of all batches in vault
+    with request_context.timed('batchFetch'):
+        status, message, snapshot, cdd_request = BATCH_SNAPSHOT.get(
+            deadline=deadline, hedge=True)
+    if(status != 200):
+        return make_response_object(status=status, message=message, request=backend_request, output=None, cdd_request=cdd_request)
+
+    results = []
+    seen_barcodes = set()
+    all_valid = True
+    for barcode in request_barcodes:
+        with request_context.timed('validation'):
+            barcode_output, barcode_message = validate_barcode(
+                snapshot, scan_type, request_project_id, barcode)
+        barcode_output['barcode'] = barcode
+        barcode_output['message'] = barcode_message
+        # Same barcode scanned twice in one request
+        barcode_output['isDuplicate'] = barcode in seen_barcodes
+        seen_barcodes.add(barcode)
+        all_valid = all_valid and barcode_output['isInCDD'] and barcode_output['isInCorrectProject'] and \
+            barcode_output['isCorrectStatus'] and not barcode_output['isDuplicate']
+        results.append(barcode_output)
+
+    message = 'Success: {0} barcodes validated, {1}'.format(
+        len(results), 'all valid' if all_valid else 'not all valid')
+    logger.debug('%s | %s', filename, message)
+    return make_response_object(status=200, message=message, output={'allValid': all_valid, 'barcodes': results}, request=backend_request)
+
 
-    batches = request_data['backendRequest']['response']['output']['batches']
+def validate_barcode(snapshot, scan_type, project_id, barcode):
+    """ Checks barcode with snapshot of CDD vault: 1 - barcode in CDD, 2 - batch in project, 3 - status allowed for scan type
 
+    Arguments:
+        snapshot {Snapshot} -- snapshot of all batches, see BatchSnapshot
+        scan_type {string} -- key of SCAN_TYPES
+        project_id {int} -- id of scanned project
+        barcode {string} -- scanned vial barcode
+
+    Returns:
+        dic, string -- output {isInCDD, isInCorrectProject, isCorrectStatus, batchData, locationArray} and message
+    """
+
+    allowed_statusses = SCAN_TYPES[scan_type]['allowed_statusses']
     output = {'isInCDD': False, 'isInCorrectProject': False,
               'isCorrectStatus': False, 'batchData': None, 'locationArray': [None, None, None]}
 
-    for batch in batches:
-        # Loop over all batches in project
-        print(batch)
-        cdd_barcode = batch['batch_fields']['Vial barcode']
+    batch = snapshot.by_barcode.get(barcode)
+    if(batch):
         cdd_project_id = batch['projects'][0]['id']
         cdd_status = batch['batch_fields']['Status']
-
-        # Check 1
-        if(request_barcode == cdd_barcode):
-            output['batchData'] = batch
-
-            # Barcode found in CDD
-            output['isInCDD'] = True
-            logger.debug('%s | %s', filename,
-                         'barcode {0} found in CDD'.format(cdd_barcode))
-
-            # Check 2
-            if(request_project_id == cdd_project_id):
-                # Batch project in CDD matches project of scanned barcode
-                logger.debug('%s | %s', filename, 'barcode {0} found in correct project {1}'.format(
-                    cdd_barcode, cdd_project_id))
-                output['isInCorrectProject'] = True
-
-            # Check 3
-            if(cdd_status in allowed_statusses):
-                # Status of batch in CDD is correct
-                logger.debug(
-                    '%s | %s', filename, 'barcode {0} status allowed'.format(cdd_barcode))
-                output['isCorrectStatus'] = True
-                if(scan_type != 'Add'):
-                    output['locationArray'] = location_string_to_array(
-                        batch['batch_fields']['Location'])
-
-            break
+        output['batchData'] = batch
+
+        # Check 1: Barcode found in CDD
+        output['isInCDD'] = True
+        logger.debug('%s | barcode %s found in CDD', filename, barcode)
+
+        # Check 2
+        if(project_id == cdd_project_id):
+            # Batch project in CDD matches project of scanned barcode
+            logger.debug('%s | barcode %s found in correct project %s',
+                         filename, barcode, cdd_project_id)
+            output['isInCorrectProject'] = True
+
+        # Check 3
+        if(cdd_status in allowed_statusses):
+            # Status of batch in CDD is correct
+            logger.debug('%s | barcode %s status allowed', filename, barcode)
+            output['isCorrectStatus'] = True
+            if(scan_type != 'Add'):
+                output['locationArray'] = location_string_to_array(
+                    batch['batch_fields']['Location'])
 
     message = 'Success: Barcode found in CDD, in correct project and with correct status'
     if(not output['isInCDD']):
@@ -302,7 +550,7 @@ def get_location():
     elif(not output['isCorrectStatus']):
         message = 'Barcode found in CDD, in correct project, but with incorrect status'
 
-    return make_response_object(status=200, message=message, output=output, request=backend_request)
+    return output, message
 
 
 @ app.route('/getlastlocation', methods=['POST'])
@@ -322,6 +570,7 @@ def get_last_location():
 
     # Get input from POST-request
     post_data = request.json
+    deadline = Deadline(ROUTE_DEADLINES['getlastlocation'])
 
     backend_request = {'type': 'POST', 'url': request.host_url +
                        'getlastlocation', 'headers': dict(request.headers), 'json': post_data}
@@ -337,12 +586,14 @@ def get_last_location():
         return make_response_object(
             status=400, message=message, request=backend_request)
 
-    batch_request = get_batches(id=request_project_id)
-    request_data = batch_request.json
-    if(batch_request.status_code != 200):
-        return make_response_object(status=batch_request.status_code, message=request_data['backendRequest']['response']['message'], request=backend_request, output=None, cdd_request=request_data['cddRequest'])
+    # Snapshot must be reconciled with CDD, a position of a persisted snapshot may be taken already
+    with request_context.timed('batchFetch'):
+        status, message, snapshot, cdd_request = BATCH_SNAPSHOT.get(
+            deadline=deadline, warm=False)
+    if(status != 200):
+        return make_response_object(status=status, message=message, request=backend_request, output=None, cdd_request=cdd_request)
 
-    batches = request_data['backendRequest']['response']['output']['batches']
+    batches = snapshot.by_project.get(request_project_id, [])
 
     # Calculate last position
     last_box, last_row, last_col, last_batch = get_last_location_from_batches(
@@ -373,14 +624,16 @@ def submit_data_to_CDD():
         2 - Check if barcodes are scanned from the right project
         3 - Check if barcodes status is 'registered'
 
-        And submits results to CDD Vault
+        And submits results to CDD Vault, see submit_items()
 
     Type:
         POST-request
 
     Input from POST-request:
-        list -- list of scanned items with keys:
-            id, barcode, project, box, pos, timestamp, username,
+        dic -- {'type': [scan type], 'data': [list of scanned items], 'mode': ['job', optional], 'idempotencyKey': [optional]}
+            scanned items have keys: id, barcode, project, box, pos, timestamp, username, idempotencyKey (optional)
+            with mode 'job' the items are submitted by a background job, see /jobs/<job_id>
+            a submission (or vial) with an idempotency key that was already done returns the stored result, with 'replayed'
 
     Returns:
         dic -- response, see make_response_object()
@@ -388,6 +641,7 @@ def submit_data_to_CDD():
 
     # Get input from POST-request
     post_data = request.json
+    deadline = Deadline(ROUTE_DEADLINES['submitdata'])
 
     backend_request = {'type': 'POST', 'url': request.host_url +
                        'submitdata', 'headers': dict(request.headers), 'json': post_data}
@@ -410,95 +664,174 @@ def submit_data_to_CDD():
             status=400, message=message, request=backend_request)
 
     scan_type = post_data['type']
-    to_status = None
-    if(scan_type == 'Add'):
-        to_status = 'Added'
-        allowed_statusses = ['Registered']
-
-    elif(scan_type == 'Check-in'):
-        to_status = 'Checked in'
-        allowed_statusses = ['Checked out']
-
-    elif(scan_type == 'Check-out'):
-        to_status = 'Checked out'
-        allowed_statusses = ['Added', 'Checked in']
-
-    elif(scan_type == 'Delete'):
-        to_status = 'Deleted'
-        allowed_statusses = ['Added', 'Checked in',
-                             'Checked out']
-    else:
+    if(scan_type not in SCAN_TYPES):
         message = 'Error: Bad request: scan type \'{0}\' is not valid'.format(
             scan_type)
         logger.error('%s | %s', filename, message)
         return make_response_object(
             status=400, message=message, request=backend_request)
 
-    # Get all batches in vault
-    batch_request = get_batches()
-    request_data = batch_request.json
-    if(batch_request.status_code != 200):
-        return make_response_object(status=batch_request.status_code, message=request_data['backendRequest']['response']['message'], request=backend_request, output=None, cdd_request=request_data['cddRequest'])
+    idempotency_key = post_data.get('idempotencyKey')
+    if(idempotency_key):
+        key_status, stored = IDEMPOTENCY.begin(
+            'submission:' + str(idempotency_key))
+        if(key_status == 'running'):
+            message = 'Error: submission with idempotency key \'{0}\' is still in progress'.format(
+                idempotency_key)
+            logger.warning('%s | %s', filename, message)
+            return make_response_object(status=409, message=message, request=backend_request)
+        if(key_status == 'done'):
+            logger.info('%s | Replayed submission with idempotency key \'%s\'',
+                        filename, idempotency_key)
+            stored['output']['replayed'] = True
+            METRICS.inc('idempotency_replays_total', {'scope': 'submission'})
+            return make_response_object(stored['status'], message=stored['message'], output=stored['output'], request=backend_request)
+
+    try:
+        if(post_data.get('mode') == 'job'):
+            # Submit in background, client polls /jobs/<job_id>
+            job_id = JOB_QUEUE.submit('submitdata', {'type': scan_type, 'data': post_data['data'],
+                                                     'correlationId': request_context.get_correlation_id()},
+                                      total=len(post_data['data']))
+            status = 202
+            message = 'Accepted: items are submitted by job {0}'.format(
+                job_id)
+            output = {'jobId': job_id, 'status': 'queued',
+                      'url': request.host_url + 'jobs/' + job_id}
+            cdd_request = None
+        else:
+            status, message, output, cdd_request = submit_items(
+                scan_type, post_data['data'], deadline)
+    except Exception:
+        if(idempotency_key):
+            # Submission failed, may be done again
+            IDEMPOTENCY.release('submission:' + str(idempotency_key))
+        raise
+
+    if(idempotency_key):
+        if(status in [200, 202]):
+            IDEMPOTENCY.done('submission:' + str(idempotency_key),
+                             {'status': status, 'message': message, 'output': output})
+        else:
+            # Submission failed, may be done again
+            IDEMPOTENCY.release('submission:' + str(idempotency_key))
+
+    return make_response_object(status, message=message, output=output, request=backend_request, cdd_request=cdd_request)
 
-    batches = request_data['backendRequest']['response']['output']['batches']
+
+def submit_items(scan_type, items, deadline, priority=INTERACTIVE, progress=None, batches=None):
+    """ Validates scanned items with CDD vault (see submit_data_to_CDD()) and submits results to CDD Vault
+
+    Arguments:
+        scan_type {string} -- key of SCAN_TYPES
+        items {list} -- scanned items
+        deadline {Deadline} -- time budget
+        priority {string} -- INTERACTIVE or BACKGROUND, see ApiCDD (default: {INTERACTIVE})
+        progress {function} -- called as progress(done, total, output) after every item (default: {None})
+        batches {dic} -- batches by barcode of items that are validated by a scan session, None to look up items in
+                         snapshot of vault (default: {None})
+
+    Returns:
+        int, string, dic, dic -- status, message, output {success, failedVials, successVials, queuedVials, unchangedVials}
+                                 and cdd-request (only if failed)
+                                 queuedVials are stored in the journal, and are submitted to CDD in background
+                                 unchangedVials already have the status (and location) of the scan, they are not submitted
+    """
+
+    to_status = SCAN_TYPES[scan_type]['to_status']
+    allowed_statusses = SCAN_TYPES[scan_type]['allowed_statusses']
+
+    if(batches is None):
+        # Get snapshot of all batches in vault
+        with request_context.timed('batchFetch'):
+            # Only submit with a snapshot that is reconciled with CDD
+            status, message, snapshot, cdd_request = BATCH_SNAPSHOT.get(
+                deadline=deadline, priority=priority, warm=False)
+        if(status != 200):
+            return status, message, None, cdd_request
+        batches = snapshot.by_barcode
 
     # Creat output response
-    output = {'success': None, 'failedVials': None, 'successVials': None}
+    output = {'success': None, 'failedVials': None,
+              'successVials': None, 'queuedVials': None, 'unchangedVials': None}
 
     # Store when failed
     failed_vials = []
     success_vials = []
+    queued_vials = []
+    unchanged_vials = []
+    vials = {'success': success_vials,
+             'queued': queued_vials, 'unchanged': unchanged_vials}
     all_succeeded = True
 
-    for item in post_data['data']:
-        # Loop over all scanned items
-        scanned_barcode = item['barcode']
-        scanned_project_id = item['project']['id']
-        scanned_box = item['box']
-        scanned_pos = item['poslabel']
-        scanned_fullname = item['fullname']
-        scanned_container_barcode = item['containerbarcode']
-        scanned_container_type = item['containertype']
-
-        cdd_barcode = None
-        cdd_project_id = None
-        cdd_status = None
-        cdd_batch_id = None
-
-        is_in_CDD = False
-        is_in_correct_project = True
-        is_correct_status = True
-
-        for batch in batches:
-            # Loop over all batches in project
-            cdd_barcode = batch['batch_fields']['Vial barcode']
-            cdd_project_name = batch['projects'][0]['name']
-            cdd_project_id = batch['projects'][0]['id']
-            cdd_status = batch['batch_fields']['Status']
-            cdd_batch_id = batch['id']
-            cdd_location = batch['batch_fields']['Location']
-
+    # Vial keys claimed by this submission, released when their vial is not submitted
+    claimed_vial_keys = set()
+    try:
+        for index, item in enumerate(items):
+            # Loop over all scanned items
+            if(progress and index):
+                progress(index, len(items), {'success': all_succeeded, 'failedVials': failed_vials, 'successVials': success_vials,
+                                             'queuedVials': queued_vials, 'unchangedVials': unchanged_vials})
+
+            vial_key = item.get('idempotencyKey')
+            if(vial_key):
+                key_status, stored = IDEMPOTENCY.begin('vial:' + str(vial_key))
+                if(key_status == 'done'):
+                    # Vial was already submitted, return stored result
+                    stored['item']['replayed'] = True
+                    METRICS.inc('idempotency_replays_total', {'scope': 'vial'})
+                    vials[stored['outcome']].append(stored['item'])
+                    continue
+                if(key_status == 'running'):
+                    # Vial is being submitted by other request, it is not submitted twice
+                    item_data = {'scanData': item, 'postResponse': {'status': 409, 'message': 'Not submitted: vial with same idempotency key is still in progress',
+                                                                    'response': None}, 'inCDD': None, 'inCorrectProject': None, 'isCorrectStatus': None}
+                    all_succeeded = False
+                    failed_vials.append(item_data)
+                    continue
+                claimed_vial_keys.add(vial_key)
+
+            scanned_barcode = item['barcode']
+            scanned_project_id = item['project']['id']
+            scanned_box = item['box']
+            scanned_pos = item['poslabel']
+            scanned_fullname = item['fullname']
+            scanned_container_barcode = item['containerbarcode']
+            scanned_container_type = item['containertype']
+
+            cdd_barcode = None
+            cdd_project_id = None
+            cdd_status = None
+            cdd_batch_id = None
+
+            is_in_CDD = False
+            is_in_correct_project = True
+            is_correct_status = True
+
+            validation_start = time.perf_counter()
             item_data = {'scanData': item, 'postResponse': {'status': None, 'message': None, 'response': None}, 'inCDD': False,
                          'inCorrectProject': None, 'isCorrectStatus': None}
 
-            # item_data = {'id': None, 'barcode': scanned_barcode, 'project': {
-            #     'id': None, 'name': None}, 'status': None, 'location': None, 'postResponse': {'status': None, 'message': None, 'response': None}}
+            batch = batches.get(scanned_barcode)
+            if(batch):
+                cdd_barcode = batch['batch_fields']['Vial barcode']
+                cdd_project_name = batch['projects'][0]['name']
+                cdd_project_id = batch['projects'][0]['id']
+                cdd_status = batch['batch_fields']['Status']
+                cdd_batch_id = batch['id']
+                cdd_location = batch['batch_fields']['Location']
 
-            if(scanned_barcode == cdd_barcode):
                 # Check 1: Barcode found in CDD
-
-                # print('Barcode found in CDD')
                 item_data['inCDD'] = is_in_CDD = True
-                logger.debug('%s | %s', filename,
-                             'barcode {0} found in CDD'.format(cdd_barcode))
+                logger.debug('%s | barcode %s found in CDD',
+                             filename, cdd_barcode)
 
                 # Check 2
                 if(scanned_project_id != cdd_project_id):
                     # Batch project in CDD matches project of scanned barcode
                     item_data['inCorrectProject'] = is_in_correct_project = False
-                    print(item_data['inCorrectProject'], is_in_correct_project)
-                    logger.debug('%s | %s', filename, 'barcode {0} found in NOT the correct project {1}'.format(
-                        cdd_barcode, cdd_project_name))
+                    logger.debug('%s | barcode %s found in NOT the correct project %s',
+                                 filename, cdd_barcode, cdd_project_name)
                 else:
                     item_data['inCorrectProject'] = is_in_correct_project = True
 
@@ -506,73 +839,625 @@ def submit_data_to_CDD():
                 if(cdd_status not in allowed_statusses):
                     # Status of batch in CDD is 'Registered'
                     item_data['isCorrectStatus'] = is_correct_status = False
-                    logger.debug(
-                        '%s | %s', filename, 'barcode {0} status NOT allowed'.format(cdd_barcode))
+                    logger.debug('%s | barcode %s status NOT allowed',
+                                 filename, cdd_barcode)
                 else:
                     item_data['isCorrectStatus'] = is_correct_status = True
 
-                break
+            # No-op: batch already has the status (and location) of this scan, e.g. a resubmitted scan
+            is_unchanged = False
+            if(is_in_CDD and is_in_correct_project and cdd_status == to_status):
+                is_unchanged = scan_type != 'Add' or (cdd_location == cdd_project_name+'-'+str(scanned_box)+'-'+scanned_pos and
+                                                      batch['batch_fields'].get('Container barcode') == scanned_container_barcode and
+                                                      batch['batch_fields'].get('Container type') == scanned_container_type)
+
+            request_context.add_timing(
+                'validation', time.perf_counter() - validation_start)
+
+            outcome = 'failed'
+            if(is_unchanged):
+                item_data['isCorrectStatus'] = True
+                item_data['postResponse']['status'] = 200
+                item_data['postResponse']['message'] = 'Unchanged: batch already has status \'{0}\', not submitted to CDD'.format(
+                    to_status)
+                logger.info('%s | %s | %s', filename, item_data['postResponse']['message'], 'barcode:{0} cdd_batch_id:{1} type:{2}'.format(
+                    scanned_barcode, cdd_batch_id, scan_type))
+                outcome = 'unchanged'
+                unchanged_vials.append(item_data)
+
+            elif(deadline.expired()):
+                # Time budget exceeded, remaining items are not submitted
+                item_data = {'scanData': item, 'postResponse': {'status': 504, 'message': 'Not submitted: time budget of request exceeded', 'response': None},
+                             'inCDD': is_in_CDD, 'inCorrectProject': None, 'isCorrectStatus': None}
+                all_succeeded = False
+                failed_vials.append(item_data)
 
-        if(is_in_CDD and is_in_correct_project and is_correct_status):
-            post_data_batch = {
-                "batch_fields": {
-                    "Status": to_status,
-                    "Last touched by": scanned_fullname,
-                    "Last touched on": datetime.datetime.strftime(datetime.datetime.now(), "%a %d %b %Y, %H:%M:%S")
+            elif(is_in_CDD and is_in_correct_project and is_correct_status):
+                post_data_batch = {
+                    "batch_fields": {
+                        "Status": to_status,
+                        "Last touched by": scanned_fullname,
+                        "Last touched on": datetime.datetime.strftime(datetime.datetime.now(), "%a %d %b %Y, %H:%M:%S")
+                    }
                 }
-            }
-            if scan_type == 'Add':
-                post_data_batch['batch_fields']['Location'] = cdd_project_name + \
-                    '-'+str(scanned_box)+'-'+scanned_pos
-                post_data_batch['batch_fields']['Container barcode'] = scanned_container_barcode
-                post_data_batch['batch_fields']['Container type'] = scanned_container_type
-
-            cdd_put_request = ApiCdd.update_batch(
-                cdd_batch_id, post_data_batch)
-            item_data['postResponse']['status'] = cdd_put_request['response']['status']
-            item_data['postResponse']['response'] = cdd_put_request['response']['json']
-
-            if(cdd_put_request['response']['status'] == 200):
-                item_data['postResponse']['message'] = 'Successfully submitted to CDD API'
-                logger.info('%s | %s | %s | %s', filename, item_data['postResponse']['message'], 'barcode:{0} cdd_batch_id:{1} type:{2}'.format(
-                    scanned_barcode, cdd_batch_id, scan_type), json.dumps(post_data_batch))
-                success_vials.append(item_data)
+                if scan_type == 'Add':
+                    post_data_batch['batch_fields']['Location'] = cdd_project_name + \
+                        '-'+str(scanned_box)+'-'+scanned_pos
+                    post_data_batch['batch_fields']['Container barcode'] = scanned_container_barcode
+                    post_data_batch['batch_fields']['Container type'] = scanned_container_type
+
+                # Write-ahead: store update in journal before it is sent to CDD
+                journal_seq = None
+                send_inline = True
+                if(JOURNAL):
+                    # Send right away, only if no earlier update of batch is still pending
+                    send_inline = JOURNAL_MODE == 'sync' and not JOURNAL.has_pending(
+                        cdd_batch_id)
+                    try:
+                        journal_seq = JOURNAL.append(
+                            cdd_batch_id, post_data_batch, scanned_barcode, claim=send_inline)
+                    except JournalError as e:
+                        # Update is not stored, so it is not sent either
+                        item_data['postResponse']['status'] = 500
+                        item_data['postResponse']['message'] = 'Not submitted: update could not be stored in journal, {0}'.format(
+                            str(e))
+                        logger.error('%s | %s | %s', filename, item_data['postResponse']['message'], 'barcode:{0} cdd_batch_id:{1} type:{2}'.format(
+                            scanned_barcode, cdd_batch_id, scan_type))
+                        all_succeeded = False
+                        failed_vials.append(item_data)
+                        continue
+
+                is_queued = not send_inline
+                if(send_inline):
+                    try:
+                        cdd_put_request = ApiCdd.update_batch(
+                            cdd_batch_id, post_data_batch, priority, deadline)
+                    except Exception:
+                        if(journal_seq is not None):
+                            # Update is sent by replay thread of journal, not kept claimed
+                            JOURNAL.release(journal_seq)
+                        raise
+                    item_data['postResponse']['status'] = cdd_put_request['response']['status']
+                    item_data['postResponse']['response'] = cdd_put_request['response']['json']
+
+                    if(journal_seq is not None):
+                        if(cdd_put_request['response']['status'] == 200 or cdd_put_request['response']['status'] in PERMANENT_FAILURE_STATUSSES):
+                            JOURNAL.ack(
+                                journal_seq, cdd_put_request['response']['status'])
+                        else:
+                            # CDD unavailable, update is sent by replay thread of journal
+                            JOURNAL.release(journal_seq)
+                            is_queued = True
+
+                if(is_queued):
+                    item_data['postResponse']['status'] = 202
+                    item_data['postResponse']['message'] = 'Queued: stored in journal, is submitted to CDD in background'
+                    logger.warning('%s | %s | %s', filename, item_data['postResponse']['message'], 'barcode:{0} cdd_batch_id:{1} type:{2}'.format(
+                        scanned_barcode, cdd_batch_id, scan_type))
+                    outcome = 'queued'
+                    queued_vials.append(item_data)
+                    BATCH_SNAPSHOT.update(
+                        cdd_batch_id, post_data_batch['batch_fields'])
+                elif(cdd_put_request['response']['status'] == 200):
+                    item_data['postResponse']['message'] = 'Successfully submitted to CDD API'
+                    logger.info('%s | %s | %s | %s', filename, item_data['postResponse']['message'], 'barcode:{0} cdd_batch_id:{1} type:{2}'.format(
+                        scanned_barcode, cdd_batch_id, scan_type), json.dumps(post_data_batch))
+                    outcome = 'success'
+                    success_vials.append(item_data)
+                    BATCH_SNAPSHOT.update(
+                        cdd_batch_id, post_data_batch['batch_fields'])
+                else:
+                    item_data['postResponse']['message'] = 'Failed to submit to CDD API'
+                    item_data['postResponse']['response'] = cdd_put_request
+                    logger.error('%s | %s | %s | %s', filename, item_data['postResponse']['message'], 'barcode: {0} cdd_batch_id:{1} type:{2}'.format(
+                        scanned_barcode, cdd_batch_id, scan_type), json.dumps(post_data_batch))
+                    success_vials.append(item_data)
+                    all_succeeded = False
+                    failed_vials.append(item_data)
             else:
-                item_data['postResponse']['message'] = 'Failed to submit to CDD API'
-                item_data['postResponse']['response'] = cdd_put_request
-                logger.error('%s | %s | %s | %s', filename, item_data['postResponse']['message'], 'barcode: {0} cdd_batch_id:{1} type:{2}'.format(
-                    scanned_barcode, cdd_batch_id, scan_type), json.dumps(post_data_batch))
-                success_vials.append(item_data)
+                item_data['postResponse']['status'] = 500
+                item_data['postResponse']['message'] = "Did not pass all checks. InCDD: {0}, InCorrectProject, {1}, CorrectStatus: {2}".format(
+                    is_in_CDD, is_in_correct_project, is_correct_status)
+                logger.critical('%s | %s', filename,
+                                item_data['postResponse']['message'])
+                item_data['postResponse']['response'] = None
+
                 all_succeeded = False
                 failed_vials.append(item_data)
-        else:
-            item_data['postResponse']['status'] = 500
-            item_data['postResponse']['message'] = "Did not pass all checks. InCDD: {0}, InCorrectProject, {1}, CorrectStatus: {2}".format(
-                is_in_CDD, is_in_correct_project, is_correct_status)
-            logger.critical('%s | %s', filename,
-                            item_data['postResponse']['message'])
-            item_data['postResponse']['response'] = None
 
-            all_succeeded = False
-            failed_vials.append(item_data)
+            if(vial_key and outcome != 'failed'):
+                # Failed vials are not stored, they are released and may be submitted again
+                IDEMPOTENCY.done('vial:' + str(vial_key),
+                                 {'outcome': outcome, 'item': item_data})
+                claimed_vial_keys.discard(vial_key)
+    finally:
+        for vial_key in claimed_vial_keys:
+            IDEMPOTENCY.release('vial:' + str(vial_key))
 
     # Attach all checks to response
     output['success'] = all_succeeded
     output['failedVials'] = failed_vials
     output['successVials'] = success_vials
+    output['queuedVials'] = queued_vials
+    output['unchangedVials'] = unchanged_vials
+    if(progress):
+        progress(len(items), len(items), output)
+
+    if(deadline.expired()):
+        message = 'Gateway Timeout: time budget of request exceeded, items submited, {0} fails'.format(
+            len(failed_vials))
+        logger.error('%s | %s', filename, message)
+        return 504, message, output, None
 
-    message = 'Success: items submited, {0} fails'.format(
-        len(failed_vials))
+    message = 'Success: items submited, {0} fails, {1} queued, {2} unchanged'.format(
+        len(failed_vials), len(queued_vials), len(unchanged_vials))
     logger.debug('%s | %s', filename, message)
-    response = make_response_object(
-        200, message=message, output=output, request=backend_request)
+    return 200, message, output, None
 
-    return response
+
+def submit_job(payload, progress):
+    """ Handler of 'submitdata' jobs, see submit_data_to_CDD()
+
+    Returns:
+        dic -- {'status', 'message', 'output', 'cddRequest'}, as the response of a not-job submission
+    """
+
+    # Job has correlation id of the request that submitted it
+    request_context.start(payload.get('correlationId'))
+    try:
+        status, message, output, cdd_request = submit_items(payload['type'], payload['data'], Deadline(ROUTE_DEADLINES['submitjob']),
+                                                            progress=progress, batches=payload.get('batches'))
+    finally:
+        request_context.end()
+    return {'status': status, 'message': message, 'output': output, 'cddRequest': cdd_request}
+
+
+def replay_update(batch_id, data):
+    """ Sends update of journal to CDD, see Journal.start_replay()
+
+    Returns:
+        int -- status code of CDD response
+    """
+
+    return ApiCdd.update_batch(batch_id, data, BACKGROUND)['response']['status']
+
+
+@ app.route('/jobs/<job_id>', methods=['GET'])
+@ token_required
+def get_job(job_id):
+    """ Returns status, progress and (partial) result of background job
+
+    Type:
+        GET-request
+
+    Input from query string:
+        wait -- optional, seconds (max 30) to wait for the job to finish before returning
+
+    Returns:
+        dic -- response, see make_response_object(), output is the job (see JobQueue)
+    """
+
+    backend_request = {'type': 'GET', 'url': request.url,
+                       'headers': dict(request.headers)}
+
+    try:
+        wait = min(float(request.args.get('wait', 0)), 30)
+    except ValueError:
+        message = 'Error: Bad request: [wait] must be a number of seconds'
+        return make_response_object(status=400, message=message, request=backend_request)
+
+    job = JOB_QUEUE.wait(job_id, wait) if wait > 0 else JOB_QUEUE.get(job_id)
+    if(job is None):
+        message = 'Error: job {0} does not exist'.format(job_id)
+        return make_response_object(status=404, message=message, request=backend_request)
+
+    message = 'Job {0} is {1}, {2}/{3} done'.format(
+        job_id, job['status'], job['progress']['done'], job['progress']['total'])
+    return make_response_object(status=200, message=message, output=job, request=backend_request)
+
+
+@ app.route('/sessions', methods=['POST'])
+@ token_required
+def open_session():
+    """ Opens scan session, scans are added with /sessions/<session_id>/items and submitted with /sessions/<session_id>/commit
+
+    Type:
+        POST-request
+
+    Input from POST-request:
+        dic -- {'type': [scan type], 'project': {'name': [name of project],'id': [id of project]}}
+
+    Returns:
+        dic -- response, see make_response_object(), output is the session (see ScanSessions)
+    """
+
+    post_data = request.json
+    backend_request = {'type': 'POST', 'url': request.host_url +
+                       'sessions', 'headers': dict(request.headers), 'json': post_data}
+
+    try:
+        scan_type = post_data['type']
+        project = {'id': post_data['project']['id'],
+                   'name': post_data['project']['name']}
+    except Exception as e:
+        message = 'Bad request: [type] or [project][id] or [project][name] not in request data'
+        logger.error('%s | %s | %s', filename, message, e)
+        return make_response_object(status=400, message=message, request=backend_request)
+
+    if(scan_type not in SCAN_TYPES):
+        message = 'Error: Bad request: scan type \'{0}\' is not valid'.format(
+            scan_type)
+        logger.error('%s | %s', filename, message)
+        return make_response_object(status=400, message=message, request=backend_request)
+
+    session = SCAN_SESSIONS.open(scan_type, project)
+    message = 'Success: session {0} opened'.format(session['id'])
+    logger.debug('%s | %s', filename, message)
+    return make_response_object(status=200, message=message, output=session_output(session), request=backend_request)
+
+
+@ app.route('/sessions/<session_id>', methods=['GET'])
+@ token_required
+def get_session(session_id):
+    """ Returns scan session
+
+    Type:
+        GET-request
+
+    Returns:
+        dic -- response, see make_response_object(), output is the session (see ScanSessions)
+    """
+
+    backend_request = {'type': 'GET', 'url': request.url,
+                       'headers': dict(request.headers)}
+
+    session = SCAN_SESSIONS.get(session_id)
+    if(session is None):
+        message = 'Error: session {0} does not exist'.format(session_id)
+        return make_response_object(status=404, message=message, request=backend_request)
+
+    message = 'Session {0} is {1}, {2} items'.format(
+        session_id, session['status'], len(session['items']))
+    return make_response_object(status=200, message=message, output=session_output(session), request=backend_request)
+
+
+@ app.route('/sessions/<session_id>/items', methods=['POST'])
+@ token_required
+def add_session_item(session_id):
+    """ Validates scanned item with snapshot of CDD vault (see get_location()) and adds it to scan session when it passes
+        all checks, the barcode is then reserved against scans of other sessions
+
+    Type:
+        POST-request
+
+    Input from POST-request:
+        dic -- scanned item with keys: barcode, box, poslabel, fullname, containerbarcode, containertype,
+               idempotencyKey (optional), project is the project of the session
+
+    Returns:
+        dic -- response, see make_response_object()
+               output: output of get_location() with keys 'barcode', 'isAdded', 'isDuplicate' and 'isReserved'
+    """
+
+    post_data = request.json
+    deadline = Deadline(ROUTE_DEADLINES['sessions'])
+    backend_request = {'type': 'POST', 'url': request.url,
+                       'headers': dict(request.headers), 'json': post_data}
+
+    session = SCAN_SESSIONS.get(session_id)
+    if(session is None):
+        message = 'Error: session {0} does not exist'.format(session_id)
+        return make_response_object(status=404, message=message, request=backend_request)
+
+    try:
+        item = {key: post_data[key] for key in [
+            'barcode', 'box', 'poslabel', 'fullname', 'containerbarcode', 'containertype']}
+    except Exception as e:
+        message = 'Bad request: [barcode], [box], [poslabel], [fullname], [containerbarcode] or [containertype] not in request data'
+        logger.error('%s | %s | %s', filename, message, e)
+        return make_response_object(status=400, message=message, request=backend_request)
+    item['project'] = session['project']
+    if(post_data.get('idempotencyKey')):
+        item['idempotencyKey'] = post_data['idempotencyKey']
+
+    # Get snapshot of all batches in vault, reserved items are committed with their batch, so only a snapshot
+    # that is reconciled with CDD is used
+    with request_context.timed('batchFetch'):
+        status, message, snapshot, cdd_request = BATCH_SNAPSHOT.get(
+            deadline=deadline, hedge=True, warm=False)
+    if(status != 200):
+        return make_response_object(status=status, message=message, request=backend_request, output=None, cdd_request=cdd_request)
+
+    with request_context.timed('validation'):
+        output, message = validate_barcode(
+            snapshot, session['type'], session['project']['id'], item['barcode'])
+    output['barcode'] = item['barcode']
+    output['isAdded'] = output['isDuplicate'] = output['isReserved'] = False
+    if(output['isInCDD'] and output['isInCorrectProject'] and output['isCorrectStatus']):
+        added = SCAN_SESSIONS.add(session_id, item, output['batchData'])
+        if(added == 'closed'):
+            message = 'Error: session {0} is not open'.format(session_id)
+            return make_response_object(status=409, message=message, request=backend_request)
+        output['isAdded'] = added == 'added'
+        output['isDuplicate'] = added == 'duplicate'
+        output['isReserved'] = added == 'reserved'
+        if(output['isDuplicate']):
+            message = 'Barcode already scanned in this session'
+        elif(output['isReserved']):
+            message = 'Barcode already scanned in other open session'
+
+    return make_response_object(status=200, message=message, output=output, request=backend_request)
+
+
+@ app.route('/sessions/<session_id>/items/<barcode>', methods=['DELETE'])
+@ token_required
+def remove_session_item(session_id, barcode):
+    """ Removes scanned item from scan session and releases its barcode
+
+    Type:
+        DELETE-request
+
+    Returns:
+        dic -- response, see make_response_object()
+    """
+
+    backend_request = {'type': 'DELETE', 'url': request.url,
+                       'headers': dict(request.headers)}
+
+    if(not SCAN_SESSIONS.remove(session_id, barcode)):
+        message = 'Error: barcode {0} is not in open session {1}'.format(
+            barcode, session_id)
+        return make_response_object(status=404, message=message, request=backend_request)
+
+    message = 'Success: barcode {0} removed from session {1}'.format(
+        barcode, session_id)
+    return make_response_object(status=200, message=message, request=backend_request)
+
+
+@ app.route('/sessions/<session_id>/commit', methods=['POST'])
+@ token_required
+def commit_session(session_id):
+    """ Submits items of scan session to CDD Vault, see submit_items(), items are not validated again
+        A committed session returns the stored result on a repeated commit, with 'replayed'
+
+    Type:
+        POST-request
+
+    Input from POST-request:
+        dic -- {'mode': ['job', optional]}, with mode 'job' the items are submitted by a background job, see /jobs/<job_id>
+
+    Returns:
+        dic -- response, see make_response_object() and submit_data_to_CDD()
+    """
+
+    post_data = request.get_json(silent=True) or {}
+    deadline = Deadline(ROUTE_DEADLINES['submitdata'])
+    backend_request = {'type': 'POST', 'url': request.url,
+                       'headers': dict(request.headers), 'json': post_data}
+
+    session_status, session = SCAN_SESSIONS.begin_commit(session_id)
+    if(session is None):
+        message = 'Error: session {0} does not exist'.format(session_id)
+        return make_response_object(status=404, message=message, request=backend_request)
+    if(session_status == 'committing'):
+        message = 'Error: session {0} is still being committed'.format(
+            session_id)
+        logger.warning('%s | %s', filename, message)
+        return make_response_object(status=409, message=message, request=backend_request)
+    if(session_status == 'committed'):
+        stored = session['result']
+        return make_response_object(stored['status'], message=stored['message'], output=dict(stored['output'], replayed=True),
+                                    request=backend_request)
+    if(not session['items']):
+        SCAN_SESSIONS.end_commit(session_id)
+        message = 'Error: session {0} does not have any items'.format(
+            session_id)
+        return make_response_object(status=400, message=message, request=backend_request)
+
+    items = [session_item['scanData']
+             for session_item in session['items'].values()]
+    batches = {barcode: session_item['batch']
+               for barcode, session_item in session['items'].items()}
+    try:
+        if(post_data.get('mode') == 'job'):
+            # Submit in background, client polls /jobs/<job_id>
+            job_id = JOB_QUEUE.submit('submitdata', {'type': session['type'], 'data': items, 'batches': batches,
+                                                     'correlationId': request_context.get_correlation_id()},
+                                      total=len(items))
+            status = 202
+            message = 'Accepted: items are submitted by job {0}'.format(job_id)
+            output = {'jobId': job_id, 'status': 'queued',
+                      'url': request.host_url + 'jobs/' + job_id}
+            cdd_request = None
+        else:
+            status, message, output, cdd_request = submit_items(
+                session['type'], items, deadline, batches=batches)
+    except Exception:
+        SCAN_SESSIONS.end_commit(session_id)
+        raise
+
+    if(status in [200, 202]):
+        SCAN_SESSIONS.end_commit(
+            session_id, {'status': status, 'message': message, 'output': output})
+    else:
+        # Commit failed, session is open again and may be committed again
+        SCAN_SESSIONS.end_commit(session_id)
+
+    return make_response_object(status, message=message, output=output, request=backend_request, cdd_request=cdd_request)
+
+
+def session_output(session):
+    """ Returns scan session as output of response, items is a list of scanned items
+    """
+
+    return dict(session, items=[session_item['scanData'] for session_item in session['items'].values()])
+
+
+@ app.route('/feed', methods=['GET'])
+@ query_token_required
+def get_feed():
+    """ Streams changes of batches as Server-Sent Events, see ChangeFeed for the events
+        Changes are made by submissions of this backend, or found when the snapshot is loaded from CDD again
+
+    Type:
+        GET-request
+
+    Input from query string:
+        project -- optional, only changes of batches of project with id
+        token -- optional, token when it can not be given as header (EventSource)
+
+    Input from headers:
+        Last-Event-ID -- optional, seq of last event the client received, given by EventSource when it reconnects
+                         without it only new changes are streamed
+
+    Returns:
+        text/event-stream -- 'batch' events with the event as json data, and a 'reset' event when the client missed
+                             events and must reload its batches (e.g. /batches)
+    """
+
+    project_id = request.args.get('project')
+    try:
+        last_seq = int(request.headers.get('Last-Event-ID')
+                       or CHANGE_FEED.last_seq())
+    except ValueError:
+        message = 'Error: Bad request: [Last-Event-ID] must be a number'
+        backend_request = {'type': 'GET', 'url': request.url,
+                           'headers': dict(request.headers)}
+        return make_response_object(status=400, message=message, request=backend_request)
+
+    def stream(last_seq):
+        CHANGE_FEED.listen()
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                events, missed, seq = CHANGE_FEED.wait(
+                    last_seq, FEED_KEEPALIVE)
+                if(missed):
+                    last_seq = seq
+                    yield 'id: {0}\nevent: reset\ndata: {{}}\n\n'.format(seq)
+                    continue
+
+                sent = False
+                for event in events:
+                    last_seq = event['seq']
+                    if(project_id is None or project_id in [str(event_project_id) for event_project_id in event['projectIds']]):
+                        sent = True
+                        yield 'id: {0}\nevent: batch\ndata: {1}\n\n'.format(event['seq'], json.dumps(event))
+                if(not sent):
+                    # Keep connection alive, id without data only moves Last-Event-ID of client
+                    yield 'id: {0}\n\n'.format(last_seq)
+        finally:
+            CHANGE_FEED.unlisten()
+
+    return Response(stream(last_seq), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache',
+                                                                             'X-Accel-Buffering': 'no'})
+
+
+def refresh_snapshot(interval):
+    """ Loads snapshot every interval seconds while clients listen to /feed, so changes in CDD are published
+    """
+
+    while True:
+        time.sleep(interval)
+        if(not CHANGE_FEED.listeners()):
+            continue
+        try:
+            status, message, snapshot, cdd_request = BATCH_SNAPSHOT.get(deadline=Deadline(ROUTE_DEADLINES['batches']),
+                                                                        priority=BACKGROUND, max_age=interval)
+            if(status != 200):
+                logger.warning('%s | Refresh of snapshot failed: %s', filename, message)
+        except Exception as e:
+            logger.exception('%s | Refresh of snapshot failed: %s', filename, e)
+
+
+@ app.route('/quarantine', methods=['GET'])
+@ token_required
+def get_quarantine():
+    """ Returns batches of CDD that are quarantined, because they are not valid (see batch_ingest.py), so they can be
+        corrected in CDD. Quarantined batches are not used by other routes, e.g. their barcodes are not found
+
+    Type:
+        GET-request
+
+    Returns:
+        dic -- response, see make_response_object(), output is {'createdOn', 'batches': [list of {'id', 'reasons', 'batch'}]}
+    """
+
+    backend_request = {'type': 'GET', 'url': request.url,
+                       'headers': dict(request.headers)}
+
+    status, message, snapshot, cdd_request = BATCH_SNAPSHOT.get(
+        deadline=Deadline(ROUTE_DEADLINES['batches']))
+    if(status != 200):
+        return make_response_object(status=status, message=message, request=backend_request, output=None, cdd_request=cdd_request)
+
+    message = '{0} batch(es) quarantined'.format(len(snapshot.quarantined))
+    return make_response_object(status=200, message=message, output={'createdOn': snapshot.created_on, 'batches': snapshot.quarantined},
+                                request=backend_request)
+
+
+def metrics_access_required(f):
+    """ Decorator that secures /metrics, it can be called by an address of 'allow' of the 'metrics' setting, with header
+        'Authorization: Bearer <key>', or with a token of login, see token_required()
+
+    Args:
+        f (function)
+
+    """
+
+    @ wraps(f)
+    def decorated(*args, **kwargs):
+        try:
+            address = ipaddress.ip_address(request.remote_addr)
+            if(any(address in network for network in METRICS_ACCESS['allow'])):
+                return f(*args, **kwargs)
+        except ValueError:
+            pass
+
+        authorization = request.headers.get('Authorization', '')
+        if(METRICS_ACCESS['key'] and authorization.startswith('Bearer ')):
+            if(hmac.compare_digest(authorization[len('Bearer '):].encode('utf-8'), METRICS_ACCESS['key'].encode('utf-8'))):
+                return f(*args, **kwargs)
+            logger.error('%s | %s', filename, 'Metrics key invalid')
+            return make_response_object(401, 'Metrics key is invalid')
+
+        return token_required(f)(*args, **kwargs)
+
+    return decorated
+
+
+@ app.route('/metrics', methods=['GET'])
+@ metrics_access_required
+def get_metrics():
+    """ Returns metrics of this process in Prometheus text format, e.g. latency per route and per CDD request
+
+    Type:
+        GET-request
+
+    Returns:
+        text/plain -- metrics, see Metrics.render()
+    """
+
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
 
 
 @ app.route('/printlabels', methods=['POST'])
 @ token_required
 def print_labels():
+    """ Queues print job of labels, the print spooler writes it to a print file of the printer, see PrintSpooler
+
+    Type:
+        POST-request
+
+    Input from POST-request:
+        dic -- {'data': [list of scanned items], 'printer': [optional], 'format': [optional]}
+            scanned items have keys: barcode, project, box, poslabel
+            printer is a key of 'printers' of 'print_spooler' setting (default: 'default', or the first printer), format is one of LABEL_FORMATS
+            (default: format of printer)
+
+    Returns:
+        dic -- response, see make_response_object(), output is {'jobId', 'status', 'url'}, see /printjobs/<job_id>
+    """
 
     # Get input from POST-request
     post_data = request.json
@@ -597,36 +1482,71 @@ def print_labels():
         return make_response_object(
             status=400, message=message, request=backend_request)
 
-    try:
-        counter_file = open('counter.json', 'r+')
-        counter_dic = json.load(counter_file)
-        counter = counter_dic['counter'] = counter_dic['counter'] + 1
-        counter_file.seek(0)  # Goes to first line
-        counter_file.truncate(0)  # Erases everything
-        counter_file.write(json.dumps(counter_dic))
-        counter_file.close()
-
-        date_string = datetime.datetime.strftime(
-            datetime.datetime.now(), "%Y-%m-%d_%H_%M_%S")
-        text_file = open(print_dir + date_string +
-                         "_Labels_" + str(counter) + '.txt', 'w')
-        text_file.write('Barcode, Project, Box, Position')
+    printer_name = post_data.get('printer', PRINT_SPOOLER.default_printer)
+    printer = PRINT_SPOOLER.printer(printer_name)
+    if(printer is None):
+        message = 'Error: Bad request: printer \'{0}\' does not exist'.format(
+            printer_name)
+        logger.error('%s | %s', filename, message)
+        return make_response_object(
+            status=400, message=message, request=backend_request)
+    label_format = post_data.get('format', printer.get('format', 'text'))
+    if(label_format not in LABEL_FORMATS):
+        message = 'Error: Bad request: format \'{0}\' is not valid, valid formats: {1}'.format(
+            label_format, ', '.join(LABEL_FORMATS))
+        logger.error('%s | %s', filename, message)
+        return make_response_object(
+            status=400, message=message, request=backend_request)
 
+    try:
+        labels = []
         for item in post_data['data']:
             # Loop over all scanned items
-            barcode = item['barcode']
-            project = item['project']['name']
-            box = item['box']
-            position = item['poslabel']
-            text_file.write('\n{0}, {1}, {2}, {3}'.format(
-                barcode, project, box, position))
-
-        text_file.close()
+            labels.append({'barcode': item['barcode'], 'project': item['project']['name'],
+                           'box': item['box'], 'position': item['poslabel']})
     except Exception as e:
         return make_response_object(400, message='Failed to upload print-file, Error: {0}'.format(str(e)), request=backend_request)
 
+    # Print file is written by spooler, together with other jobs of printer
+    job_id = PRINT_SPOOLER.submit(printer_name, label_format, labels)
+    output = {'jobId': job_id, 'status': 'queued',
+              'url': request.host_url + 'printjobs/' + job_id}
     return make_response_object(
-        200, message='Successfully upload print-file to print directory', request=backend_request)
+        202, message='Accepted: print-file is written by print job {0}'.format(job_id), output=output, request=backend_request)
+
+
+@ app.route('/printjobs/<job_id>', methods=['GET'])
+@ token_required
+def get_print_job(job_id):
+    """ Returns status of print job, with the name of the print file when it is written
+
+    Type:
+        GET-request
+
+    Input from query string:
+        wait -- optional, seconds (max 30) to wait for the job to finish before returning
+
+    Returns:
+        dic -- response, see make_response_object(), output is the job (see PrintSpooler)
+    """
+
+    backend_request = {'type': 'GET', 'url': request.url,
+                       'headers': dict(request.headers)}
+
+    try:
+        wait = min(float(request.args.get('wait', 0)), 30)
+    except ValueError:
+        message = 'Error: Bad request: [wait] must be a number of seconds'
+        return make_response_object(status=400, message=message, request=backend_request)
+
+    job = PRINT_SPOOLER.wait(
+        job_id, wait) if wait > 0 else PRINT_SPOOLER.get(job_id)
+    if(job is None):
+        message = 'Error: print job {0} does not exist'.format(job_id)
+        return make_response_object(status=404, message=message, request=backend_request)
+
+    message = 'Print job {0} is {1}'.format(job_id, job['status'])
+    return make_response_object(status=200, message=message, output=job, request=backend_request)
 
 
 @ app.route('/login', methods=['POST'])
@@ -645,7 +1565,7 @@ def login():
 
     # Load private key as serialization object
     private_key = serialization.load_pem_private_key(
-        PRIVATE_KEY,
+        get_private_key(),
         password=None,
         backend=default_backend()
     )
@@ -687,8 +1607,207 @@ def home():
             <a href="https://192.168.60.12:8080/projects" target="_blank">/projects</a> Get projects of vault | GET | Token required | header = {Token} <br>
             <a href="https://192.168.60.12:8080/batchbarcodes" target="_blank">/batchbarcodes</a> Get batch barcodes of vault | GET | Token required | header = {Token} <br>
             <a href="https://192.168.60.12:8080/getlocation" target="_blank">/getlocation</a> Get location barcode | POST | Token required | header = {Token} | data = {type, project, barcode} <br>
+            <a href="https://192.168.60.12:8080/validatebarcodes" target="_blank">/validatebarcodes</a> Get location of multiple barcodes | POST | Token required | header = {Token} | data = {type, project, barcodes} <br>
             <a href="https://192.168.60.12:8080/getlastlocation" target="_blank">/getlastlocation</a> Get last occupied location of project | POST | Token required | header = {Token} | data = {selectedProject} <br>
-            <a href="https://192.168.60.12:8080/submitdata" target="_blank">/projects</a> Submit data to CDD Vault | POST | Token required | header = {Token} | data = {type,data} <br>
+            <a href="https://192.168.60.12:8080/submitdata" target="_blank">/projects</a> Submit data to CDD Vault | POST | Token required | header = {Token} | data = {type,data,mode} <br>
+            <a href="https://192.168.60.12:8080/sessions" target="_blank">/sessions</a> Open scan session, then add items with /sessions/&lt;session_id&gt;/items and submit them with /sessions/&lt;session_id&gt;/commit | POST | Token required | header = {Token} | data = {type, project} <br>
+            <a href="https://192.168.60.12:8080/feed" target="_blank">/feed</a> Stream of changes of batches (Server-Sent Events) | GET | Token required | header = {Token, Last-Event-ID} | query = {project, token} <br>
+            <a href="https://192.168.60.12:8080/metrics" target="_blank">/metrics</a> Metrics of backend and CDD requests (Prometheus text format) | GET <br>
+            <a href="https://192.168.60.12:8080/jobs" target="_blank">/jobs/&lt;job_id&gt;</a> Get status and results of background job | GET | Token required | header = {Token} | query = {wait} <br>
         </body>
     </html>
 """
+
+
+def create_app(settings_file=None):
+    """ Loads and validates configuration, and creates the clients, stores and background threads of the backend
+        A multi-process WSGI server calls it in every worker, so every worker has its own clients and threads,
+        e.g. gunicorn -w 4 'server:create_app()'
+
+    Keyword Arguments:
+        settings_file {string} -- file of settings, see config.load_config() (default: {None})
+
+    Raises:
+        ConfigError -- configuration is missing or not valid
+
+    Returns:
+        Flask -- app, created once per process
+    """
+
+    global settings, print_dir, ApiCdd, JOURNAL_MODE, JOURNAL, IDEMPOTENCY, PROFILER, SCAN_SESSIONS, CHANGE_FEED, \
+        BATCH_SNAPSHOT, JOB_QUEUE, LABEL_COUNTER, PRINT_SPOOLER
+
+    with _create_lock:
+        if(app.config.get('CREATED')):
+            return app
+
+        configuration = load_config(settings_file)
+        set_config(configuration)
+        settings = configuration['settings']
+        requirements = configuration['requirements']
+
+        # Set up logging of all modules, see setup_logging()
+        setup_logging(settings.get('logging'))
+
+        print_dir = settings['print_directory']
+        if(not os.path.isdir(print_dir)):
+            logger.info('%s | Print directory %s does not exist -> created', filename, print_dir)
+            os.makedirs(print_dir)
+
+        # Numbers of labels, shared by all threads and workers, continues from counter.json of older versions
+        LABEL_COUNTER = LabelCounter(settings.get(
+            'counter_database', 'counter.sqlite3'))
+
+        app.config['SECRET_KEY'] = requirements['secret_key']
+
+        # Create CDD API Connection, 'cdd_base_url' points to other CDD server, e.g. the simulator of fake_cdd.py
+        base_url = settings.get('cdd_base_url') or "https://app.collaborativedrug.com/api/v1/vaults/%s/" % (
+            requirements['cdd_vault_id'])
+        ApiCdd = ApiCDD(base_url, requirements['cdd_token'], export_max_age=settings.get('export_max_age', 60),
+                        rate_limits=settings.get('rate_limits'), retries=settings.get('cdd_retries'),
+                        circuit_breaker=settings.get('cdd_circuit_breaker'), timeout=settings.get('cdd_timeout'),
+                        export_timeout=settings.get('export_timeout', 300), hedging=settings.get('cdd_hedging'))
+
+        # Multi-worker mode: workers share one snapshot of batches, and every worker has a slot with its own journal
+        # and jobs, so a worker that replaces a stopped worker continues them, see multi_worker.py
+        multi_worker = None
+        slot = None
+        if(settings.get('multi_worker') is not None):
+            multi_worker = dict(DEFAULT_MULTI_WORKER, **
+                                settings['multi_worker'])
+            slot = claim_worker_slot(multi_worker['directory'])
+            logger.info('%s | Worker %s has slot %s', filename, os.getpid(), slot)
+
+        # Write-ahead journal of batch updates, mode 'sync': send update right away and queue it when CDD fails,
+        # 'defer': only queue update, 'off': no journal
+        JOURNAL_MODE = settings.get('journal_mode', 'sync')
+        JOURNAL = None
+        if(JOURNAL_MODE != 'off'):
+            journal_file = settings.get('journal_file', 'journal.jsonl')
+            if(slot is not None):
+                journal_file = '%s-%s%s' % (os.path.splitext(journal_file)[0], slot,
+                                            os.path.splitext(journal_file)[1])
+            JOURNAL = Journal(journal_file, flush_interval=settings.get('journal_flush_interval', 0.005),
+                              write_timeout=settings.get('journal_write_timeout', 30))
+
+        # Results of submissions and vials by idempotency key, see /submitdata
+        IDEMPOTENCY = IdempotencyStore(settings.get('idempotency_database', 'idempotency.sqlite3'),
+                                       ttl=settings.get('idempotency_ttl', 24*3600))
+
+        # Profiling of live requests, see Profiler. The sample rate can also be set by environment variable
+        # ZOBIOWEB_PROFILE_SAMPLE_RATE, so a running server can be profiled after a restart without changing settings
+        profiling = dict(DEFAULT_PROFILING, **settings.get('profiling', {}))
+        if(os.environ.get('ZOBIOWEB_PROFILE_SAMPLE_RATE')):
+            profiling['sample_rate'] = float(
+                os.environ['ZOBIOWEB_PROFILE_SAMPLE_RATE'])
+        PROFILER = Profiler(**profiling)
+
+        # Access to /metrics, see metrics_access_required()
+        metrics = dict(DEFAULT_METRICS, **settings.get('metrics', {}))
+        try:
+            METRICS_ACCESS.update({'allow': [ipaddress.ip_network(network, strict=False) for network in metrics['allow']],
+                                   'key': metrics['key']})
+        except ValueError as e:
+            raise ConfigError(
+                'setting metrics has an allow entry that is not an address or network: %s' % str(e))
+
+        ROUTE_DEADLINES.update(settings.get('route_deadlines', {}))
+
+        # Scan sessions (see /sessions) and changes of batches (see /feed), shared by the workers in multi-worker mode
+        # A commit never takes longer than its deadline, a session that is committing twice as long is given up
+        commit_timeout = 2 * ROUTE_DEADLINES['submitdata']
+        if(multi_worker):
+            snapshot_store = SnapshotStore(os.path.join(
+                multi_worker['directory'], 'snapshot.sqlite3'))
+            SCAN_SESSIONS = SharedScanSessions(os.path.join(multi_worker['directory'], 'sessions.sqlite3'),
+                                               ttl=settings.get('session_ttl', 3600), commit_timeout=commit_timeout)
+            CHANGE_FEED = SharedChangeFeed(snapshot_store, history=settings.get('feed_history', 1000),
+                                           poll_interval=multi_worker['poll_interval'])
+        else:
+            SCAN_SESSIONS = ScanSessions(
+                ttl=settings.get('session_ttl', 3600), commit_timeout=commit_timeout)
+            CHANGE_FEED = ChangeFeed(
+                history=settings.get('feed_history', 1000))
+
+        # Indexed snapshot of all batches, used to validate scanned barcodes, see /getlocation and /validatebarcodes
+        if(multi_worker):
+            BATCH_SNAPSHOT = SharedBatchSnapshot(fetch_batches, snapshot_store, max_age=settings.get('snapshot_max_age', 30),
+                                                 on_change=CHANGE_FEED.publish, poll_interval=multi_worker['poll_interval'],
+                                                 load_timeout=multi_worker['load_timeout'],
+                                                 warm_max_age=settings.get('snapshot_warm_max_age', 24*3600))
+        else:
+            BATCH_SNAPSHOT = BatchSnapshot(fetch_batches, max_age=settings.get('snapshot_max_age', 30), on_change=CHANGE_FEED.publish,
+                                           path=settings.get('snapshot_file', 'snapshot.json.gz'),
+                                           persist_interval=settings.get('snapshot_persist_interval', 300),
+                                           warm_max_age=settings.get('snapshot_warm_max_age', 24*3600), source=base_url)
+
+        # Serve from persisted snapshot right away after a restart, it is reconciled with CDD in background
+        BATCH_SNAPSHOT.warm_start(deadline=Deadline(
+            ROUTE_DEADLINES['batches']), priority=BACKGROUND)
+
+        # Load snapshot in background while clients listen to /feed, so changes in CDD are published
+        threading.Thread(target=refresh_snapshot, args=(settings.get('feed_refresh_interval', 30),),
+                         name='snapshot-refresh', daemon=True).start()
+
+        # Create and start queue for background jobs, see /jobs/<job_id>
+        JOB_QUEUE = JobQueue(settings.get('job_database', 'jobs.sqlite3'), {'submitdata': submit_job},
+                             workers=settings.get('job_workers', 4), owner=None if slot is None else str(slot))
+        JOB_QUEUE.start()
+
+        # Create and start spooler of print jobs, see /printlabels and /printjobs/<job_id>
+        print_spooler = dict(DEFAULT_PRINT_SPOOLER, **
+                             settings.get('print_spooler', {}))
+        if(not isinstance(print_spooler['printers'], dict) or not print_spooler['printers']):
+            raise ConfigError('setting print_spooler does not have printers')
+        for name, printer in print_spooler['printers'].items():
+            if(not isinstance(printer, dict) or printer.get('format', 'text') not in LABEL_FORMATS):
+                raise ConfigError('printer %s of setting print_spooler must be {"directory", "format"} with format %s' % (
+                    name, ', '.join(LABEL_FORMATS)))
+        PRINT_SPOOLER = PrintSpooler(settings.get('print_database', 'print_jobs.sqlite3'), print_dir, LABEL_COUNTER,
+                                     print_spooler['printers'], window=print_spooler['window'],
+                                     retention=print_spooler['retention'], owner=None if slot is None else str(slot))
+        PRINT_SPOOLER.start()
+
+        # Sizes of queued and in-flight work, see /metrics
+        METRICS.gauge('jobs', lambda: [[{'status': status}, size]
+                                       for status, size in dict({'queued': 0, 'running': 0}, **JOB_QUEUE.size()).items()])
+        METRICS.gauge('print_jobs', lambda: [[{'status': status}, size]
+                                             for status, size in dict({'queued': 0, 'running': 0}, **PRINT_SPOOLER.size()).items()])
+        METRICS.gauge('scan_sessions', lambda: [[{'status': status}, size]
+                                                for status, size in SCAN_SESSIONS.size().items()])
+        METRICS.gauge('feed_listeners', CHANGE_FEED.listeners)
+        METRICS.gauge('batches_quarantined', lambda: len(
+            BATCH_SNAPSHOT.quarantined()))
+        if(JOURNAL):
+            METRICS.gauge('journal_pending_updates', JOURNAL.size)
+
+        # Start sending pending updates of journal to CDD
+        if(JOURNAL):
+            JOURNAL.start_replay(replay_update, retry_interval=settings.get(
+                'journal_retry_interval', 5))
+
+        app.config['CREATED'] = True
+        logger.info('%s | %s', filename, 'App created')
+    return app
+
+
+@ app.before_first_request
+def create_app_on_first_request():
+    # App is served without calling create_app(), e.g. by 'flask run'
+    create_app()
+
+
+if __name__ == "__main__":
+    try:
+        if(os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+            create_app()
+        else:
+            # Reloader of debug mode runs this module again in a child process that serves the app, only the child
+            # starts the background threads (journal replay, job workers, print spooler), the parent checks the config
+            load_config()
+    except ConfigError as e:
+        print('> %s' % e)
+        exit(1)
+    app.run(debug=True, port=5000)
+    # app.run(debug=True, port=5000, ssl_context=(
+    #     './ssl/server.crt', './ssl/server.key'))
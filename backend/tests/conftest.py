@@ -0,0 +1,38 @@
+import datetime
+import os
+import sys
+
+import jwt
+import pytest
+
+"""
+    Tests of the backend, run with pytest from the backend directory (see README.md), the modules of the backend are
+    imported as server.py imports them
+"""
+
+sys.path.insert(0, os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def server_app():
+    """ Returns server module with app created in a temporary directory (see benchmark.make_workspace()), the app is
+        created once per test session, tests replace server.ApiCdd
+    """
+
+    from benchmark import make_workspace
+
+    with make_workspace():
+        import server
+        server.create_app()
+        yield server
+
+
+@pytest.fixture(scope='session')
+def headers(server_app):
+    """ Returns headers with token of a logged in user
+    """
+
+    token = jwt.encode({'user': 'test', 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)},
+                       server_app.app.config['SECRET_KEY'])
+    return {'Token': token.decode() if isinstance(token, bytes) else token}
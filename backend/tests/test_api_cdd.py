@@ -0,0 +1,235 @@
+import threading
+import time
+
+import pytest
+
+import api_cdd
+from api_cdd import BACKGROUND, INTERACTIVE, ApiCDD, Deadline, TokenBucket
+from fake_cdd import FakeCDDServer, FakeVault
+from metrics import METRICS
+
+
+@pytest.fixture
+def cdd():
+    """ Returns a running fake CDD, rate limiters and circuit breakers of earlier tests are forgotten
+    """
+
+    api_cdd._shared.clear()
+    server = FakeCDDServer(('127.0.0.1', 0), FakeVault(batches=10)).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    api_cdd._shared.clear()
+
+
+def retries():
+    return METRICS.get('cdd_retries_total', {'method': 'GET'}) or 0
+
+
+def open_circuit(api, server):
+    """ Fails requests to server until the circuit breaker of api is open
+    """
+
+    server.faults['error_rate'] = 1.0
+    api.request_projects()
+    server.faults['error_rate'] = 0.0
+    assert api._circuit_breaker.state == 'open'
+
+
+def test_failed_request_is_retried_until_max_retries(cdd):
+    api = ApiCDD(cdd.base_url(), None, retries={'max_retries': 2, 'backoff_base': 0.01})
+    cdd.faults.update({'error_rate': 1.0, 'error_status': 500})
+    before = retries()
+
+    dic = api.request_projects()
+    assert dic['response']['status'] == 500
+    assert retries() - before == 2
+
+
+def test_retry_waits_as_long_as_retry_after_asks(cdd):
+    api = ApiCDD(cdd.base_url(), None, retries={'backoff_base': 0.01})
+    cdd.faults.update({'error_rate': 1.0, 'error_status': 429, 'retry_after': 0.3})
+    # CDD is available again before the retry
+    threading.Timer(0.1, cdd.faults.update, args=({'error_rate': 0.0},)).start()
+    before = retries()
+
+    start = time.monotonic()
+    dic = api.request_projects()
+    assert dic['response']['status'] == 200
+    assert time.monotonic() - start >= 0.3
+    assert retries() - before == 1
+
+
+def test_retry_after_longer_than_allowed_is_not_retried(cdd):
+    api = ApiCDD(cdd.base_url(), None, retries={'retry_after_max': 1})
+    cdd.faults.update({'error_rate': 1.0, 'error_status': 503, 'retry_after': 60})
+    before = retries()
+
+    start = time.monotonic()
+    dic = api.request_projects()
+    assert dic['response']['status'] == 503
+    assert time.monotonic() - start < 1
+    assert retries() == before
+
+
+def test_retry_does_not_exceed_deadline(cdd):
+    api = ApiCDD(cdd.base_url(), None)
+    cdd.faults.update({'error_rate': 1.0, 'error_status': 503, 'retry_after': 0.5})
+
+    start = time.monotonic()
+    dic = api.request_projects(deadline=Deadline(0.2))
+    assert dic['response']['status'] == 503
+    assert time.monotonic() - start < 0.5
+
+
+def test_circuit_breaker_opens_and_closes_after_trial(cdd):
+    api = ApiCDD(cdd.base_url(), None, retries={'max_retries': 0},
+                 circuit_breaker={'failure_threshold': 2, 'reset_timeout': 0.1})
+    cdd.faults['error_rate'] = 1.0
+    api.request_projects()
+    assert api._circuit_breaker.state == 'closed'
+    api.request_projects()
+    assert api._circuit_breaker.state == 'open'
+
+    # Fails fast, CDD is available but not contacted
+    cdd.faults['error_rate'] = 0.0
+    dic = api.request_projects()
+    assert dic['response']['status'] == 503
+    assert 'circuit breaker is open' in dic['response']['message']
+
+    # Failed trial opens the circuit again
+    time.sleep(0.2)
+    cdd.faults['error_rate'] = 1.0
+    api.request_projects()
+    assert api._circuit_breaker.state == 'open'
+    assert api.request_projects()['response']['status'] == 503
+
+    # Successful trial closes it
+    time.sleep(0.2)
+    cdd.faults['error_rate'] = 0.0
+    assert api.request_projects()['response']['status'] == 200
+    assert api._circuit_breaker.state == 'closed'
+
+
+def test_expired_deadline_does_not_use_half_open_trial(cdd):
+    api = ApiCDD(cdd.base_url(), None, retries={'max_retries': 0},
+                 circuit_breaker={'failure_threshold': 1, 'reset_timeout': 0.1})
+    open_circuit(api, cdd)
+    time.sleep(0.2)
+
+    dic = api.request_projects(deadline=Deadline(0))
+    assert dic['response']['status'] == 504
+    assert api._circuit_breaker.state == 'open'
+
+    # The next request is the trial, and closes the circuit
+    dic = api.request_projects()
+    assert dic['response']['status'] == 200
+    assert api._circuit_breaker.state == 'closed'
+
+
+def test_export_is_reused_unless_reuse_export_is_false(cdd):
+    cdd.faults['export_seconds'] = 0
+    api = ApiCDD(cdd.base_url(), None)
+
+    first = api.request_batches(force_async=True)
+    assert first['response']['status'] == 200
+    cdd.vault.update(500000, {'batch_fields': {'Status': 'Discarded'}})
+
+    reused = api.request_batches(force_async=True)
+    assert reused['response']['json']['objects'][0]['batch_fields']['Status'] == \
+        first['response']['json']['objects'][0]['batch_fields']['Status']
+
+    fresh = api.request_batches(force_async=True, reuse_export=False)
+    assert fresh['response']['json']['objects'][0]['batch_fields']['Status'] == 'Discarded'
+
+
+def test_requests_wait_for_rate_limit_after_burst(cdd):
+    api = ApiCDD(cdd.base_url(), None, rate_limits={'GET': [20, 2]})
+    # Rate limiter is shared by all objects of the vault
+    other_api = ApiCDD(cdd.base_url(), None, rate_limits={'GET': [20, 2]})
+
+    start = time.monotonic()
+    for i in range(3):
+        assert api.request_projects()['response']['status'] == 200
+        assert other_api.request_projects()['response']['status'] == 200
+    # 2 requests of burst, 4 requests at 20 per second
+    assert time.monotonic() - start >= 0.19
+
+
+def test_rate_limit_wait_does_not_exceed_deadline(cdd):
+    api = ApiCDD(cdd.base_url(), None, rate_limits={'GET': [1, 1]})
+    assert api.request_projects()['response']['status'] == 200
+
+    start = time.monotonic()
+    dic = api.request_projects(deadline=Deadline(0.1))
+    assert dic['response']['status'] == 504
+    assert time.monotonic() - start < 0.5
+
+
+def test_interactive_callers_are_served_before_background_callers():
+    bucket = TokenBucket(rate=10, capacity=1)
+    assert bucket.acquire() is not None
+    assert bucket.acquire(BACKGROUND, timeout=0) is None
+    served = []
+
+    def acquire(priority):
+        bucket.acquire(priority)
+        served.append(priority)
+
+    background = threading.Thread(target=acquire, args=(BACKGROUND,))
+    background.start()
+    time.sleep(0.02)
+    interactive = threading.Thread(target=acquire, args=(INTERACTIVE,))
+    interactive.start()
+    background.join(2)
+    interactive.join(2)
+
+    assert served == [INTERACTIVE, BACKGROUND]
+
+
+def hedged(cdd, rate_limits=None):
+    """ Returns ApiCDD with hedging, that hedges 'projects/' after 0.05 seconds, and number of hedged requests
+    """
+
+    api = ApiCDD(cdd.base_url(), None, rate_limits=rate_limits,
+                 hedging={'enabled': True, 'min_samples': 5, 'min_delay': 0.05})
+    for i in range(5):
+        api._record_latency('projects/', 0.01)
+    return api, METRICS.get('cdd_hedged_requests_total') or 0, METRICS.get('cdd_hedge_wins_total') or 0
+
+
+def test_slow_request_is_hedged_and_first_answer_is_used(cdd):
+    api, hedges, wins = hedged(cdd)
+    # First request is slow, the hedged request is not
+    cdd.faults['latency'] = 1.0
+    threading.Timer(0.02, cdd.faults.update, args=({'latency': 0.0},)).start()
+
+    start = time.monotonic()
+    dic = api.request_projects(hedge=True)
+    assert dic['response']['status'] == 200
+    assert time.monotonic() - start < 0.5
+    assert METRICS.get('cdd_hedged_requests_total') == hedges + 1
+    assert METRICS.get('cdd_hedge_wins_total') == wins + 1
+
+
+def test_fast_request_is_not_hedged(cdd):
+    api, hedges, wins = hedged(cdd)
+
+    assert api.request_projects(hedge=True)['response']['status'] == 200
+    assert (METRICS.get('cdd_hedged_requests_total') or 0) == hedges
+
+
+def test_request_is_not_hedged_without_token_of_rate_limiter(cdd):
+    api, hedges, wins = hedged(cdd, rate_limits={'GET': [1, 1]})
+    cdd.faults['latency'] = 0.2
+
+    assert api.request_projects(hedge=True)['response']['status'] == 200
+    assert (METRICS.get('cdd_hedged_requests_total') or 0) == hedges
+
+
+def test_request_is_not_hedged_without_hedge(cdd):
+    api, hedges, wins = hedged(cdd)
+    cdd.faults['latency'] = 0.2
+
+    assert api.request_projects()['response']['status'] == 200
+    assert (METRICS.get('cdd_hedged_requests_total') or 0) == hedges
@@ -0,0 +1,16 @@
+def test_token_is_only_accepted_as_header(server_app, headers):
+    client = server_app.app.test_client()
+
+    response = client.get('/quarantine?token=' + headers['Token'])
+    assert response.status_code == 401
+    assert client.get('/quarantine').status_code == 401
+
+
+def test_feed_accepts_token_in_query_string(server_app, headers):
+    client = server_app.app.test_client()
+
+    assert client.get('/feed').status_code == 401
+    response = client.get('/feed?token=' + headers['Token'])
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    response.close()
@@ -0,0 +1,85 @@
+from batch_ingest import ingest_batch, ingest_batches
+from batch_snapshot import Snapshot
+
+
+def batch(id, status='Registered', location=None, barcode=None, projects=None):
+    return {'id': id, 'projects': [{'id': 1, 'name': 'FJM'}] if projects is None else projects,
+            'batch_fields': {'Vial barcode': 'BC%s' % id if barcode is None else barcode, 'Status': status,
+                             'Location': location}}
+
+
+def test_clean_batch_is_normalized():
+    normalized, reasons = ingest_batch(
+        dict(batch(1), batch_fields={'Vial barcode': ' BC1 ', 'Status': 'Registered', 'Location': ''}))
+
+    assert reasons == []
+    assert normalized['batch_fields'] == {'Vial barcode': 'BC1', 'Status': 'Registered', 'Location': None,
+                                          'Container barcode': None, 'Container type': None}
+
+
+def test_numeric_barcode_is_text():
+    normalized, reasons = ingest_batch(batch(1, barcode=12345))
+
+    assert reasons == []
+    assert normalized['batch_fields']['Vial barcode'] == '12345'
+
+
+def test_batch_without_one_project_is_quarantined():
+    for projects in [[], [{'id': 1, 'name': 'FJM'}, {'id': 2, 'name': 'ABC'}]]:
+        normalized, reasons = ingest_batch(batch(1, projects=projects))
+        assert normalized is None
+        assert 'instead of one' in reasons[0]
+
+
+def test_batch_without_integer_ids_is_quarantined():
+    normalized, reasons = ingest_batch(dict(batch(1), id='1'))
+    assert normalized is None and 'is not an integer' in reasons[0]
+
+    normalized, reasons = ingest_batch(
+        batch(1, projects=[{'id': '1', 'name': 'FJM'}]))
+    assert normalized is None and 'does not have an integer id' in reasons[0]
+
+
+def test_placed_batch_needs_valid_location():
+    assert ingest_batch(batch(1, 'Checked in', 'FJM-1-A1'))[1] == []
+    assert ingest_batch(batch(1, 'Checked in', 'FJM-12-AB12'))[1] == []
+    # Registered batches are not placed
+    assert ingest_batch(batch(1, 'Registered'))[1] == []
+
+    for location in [None, 'garbage', 'FJM-A-1', 'FJM-1-a1']:
+        normalized, reasons = ingest_batch(batch(1, 'Checked in', location))
+        assert normalized is None
+        assert 'is not <project>-<box>-<position>' in reasons[0]
+
+
+def test_field_that_is_not_text_is_quarantined():
+    normalized, reasons = ingest_batch(
+        dict(batch(1), batch_fields={'Vial barcode': 'BC1', 'Status': 'Registered', 'Container barcode': ['C1']}))
+
+    assert normalized is None
+    assert reasons == ["Container barcode ['C1'] is not text"]
+
+
+def test_batch_fields_that_are_not_an_object_are_quarantined():
+    assert ingest_batch(dict(batch(1), batch_fields=['x'])) == (
+        None, ['batch_fields is not an object'])
+    assert ingest_batch('batch') == (None, ['batch is not an object'])
+
+
+def test_duplicate_barcodes_are_quarantined():
+    clean, quarantined = ingest_batches(
+        [batch(1, barcode='BC'), batch(2), batch(3, barcode='BC')])
+
+    assert [b['id'] for b in clean] == [2]
+    assert [(q['id'], q['reasons']) for q in quarantined] == [
+        (1, ["vial barcode 'BC' is used by batches [1, 3]"]),
+        (3, ["vial barcode 'BC' is used by batches [1, 3]"])]
+
+
+def test_quarantined_batches_are_not_in_snapshot():
+    snapshot = Snapshot([batch(1), batch(2, 'Checked in', 'garbage'), batch(3, projects=[])])
+
+    assert list(snapshot.by_id) == [1]
+    assert 'BC2' not in snapshot.by_barcode
+    assert sorted(q['id'] for q in snapshot.quarantined) == [2, 3]
+    assert snapshot.quarantined[0]['batch']['batch_fields']['Location'] == 'garbage'
@@ -0,0 +1,41 @@
+import threading
+import time
+
+from batch_snapshot import BatchSnapshot, Snapshot
+from fake_cdd import FakeVault
+
+
+def test_warm_snapshot_is_only_used_until_reconciled_when_allowed(tmp_path):
+    vault = FakeVault(batches=10)
+    path = str(tmp_path / 'snapshot.json.gz')
+    # Persisted an hour ago, before the restart
+    BatchSnapshot(None, path=path)._persist(
+        Snapshot(vault.query(), created_on=time.time() - 3600))
+
+    vault.update(500000, {'batch_fields': {'Status': 'Discarded'}})
+    reconciling = threading.Event()
+
+    def load(deadline=None, hedge=False):
+        reconciling.wait(5)
+        return 200, 'All requests successfully completed.', vault.query(), None
+
+    batch_snapshot = BatchSnapshot(load, path=path)
+    assert batch_snapshot.warm_start()
+
+    # Lookups are served from the persisted snapshot right away
+    status, _, snapshot, _ = batch_snapshot.get()
+    assert status == 200 and snapshot.warm
+    assert snapshot.by_id[500000]['batch_fields']['Status'] != 'Discarded'
+
+    # Reservations and submissions wait until it is reconciled
+    result = []
+    waiting = threading.Thread(target=lambda: result.append(batch_snapshot.get(warm=False)))
+    waiting.start()
+    waiting.join(0.2)
+    assert waiting.is_alive()
+    reconciling.set()
+    waiting.join(5)
+
+    status, _, snapshot, _ = result[0]
+    assert status == 200 and not snapshot.warm
+    assert snapshot.by_id[500000]['batch_fields']['Status'] == 'Discarded'
@@ -0,0 +1,110 @@
+import pytest
+
+from benchmark import StubApiCDD
+
+
+class Vault():
+    """ Batches of a stubbed CDD vault, see benchmark.StubApiCDD
+    """
+
+    def __init__(self, batches):
+        """ Initialized is called when class in created
+        """
+
+        self.batches = batches
+
+    def query(self, project_ids=None):
+        return list(self.batches)
+
+
+def batch(id, project_id, status, location=None):
+    return {'id': id, 'projects': [{'id': project_id, 'name': 'FJM' if project_id == 1 else 'ABC'}],
+            'batch_fields': {'Vial barcode': 'BC%s' % id, 'Status': status, 'Location': location,
+                             'Container barcode': 'C%s' % id, 'Container type': 'Vial'}}
+
+
+@pytest.fixture
+def client(server_app):
+    # Ids are not in order in CDD, /batches returns them in order of id
+    batches = [batch(id, 1 if id % 2 else 2, 'Registered' if id % 3 == 0 else 'Checked in',
+                     None if id % 3 == 0 else '%s-1-A%s' % ('FJM' if id % 2 else 'ABC', id))
+               for id in range(20, 0, -1)]
+    # Not valid, quarantined
+    batches.append(batch(21, 1, 'Checked in', 'garbage'))
+    server_app.ApiCdd = StubApiCDD(Vault(batches))
+    server_app.BATCH_SNAPSHOT.invalidate()
+    return server_app.app.test_client()
+
+
+def get(client, headers, query=''):
+    response = client.get('/batches' + query, headers=headers)
+    return response.status_code, response.get_json()['backendRequest']['response']
+
+
+def ids(response):
+    return [batch['id'] for batch in response['output']['batches']]
+
+
+def test_all_valid_batches_in_order_of_id(client, headers):
+    status, response = get(client, headers)
+
+    assert status == 200
+    assert ids(response) == list(range(1, 21))
+    assert response['output']['count'] == 20
+    assert response['output']['nextCursor'] is None
+
+
+def test_filters(client, headers):
+    assert ids(get(client, headers, '?project=1')[1]) == list(range(1, 21, 2))
+    assert ids(get(client, headers, '?project=1,2&status=Registered')[1]) == [3, 6, 9, 12, 15, 18]
+    assert ids(get(client, headers, '?status=Checked%20in,Registered&project=2')[1]) == list(range(2, 21, 2))
+    assert ids(get(client, headers, '?barcode=BC5,BC7,BC21,nope')[1]) == [5, 7]
+    assert ids(get(client, headers, '?location=FJM-1-A1')[1]) == [1, 11, 13, 17, 19]
+    assert ids(get(client, headers, '?project=2&barcode=BC5,BC8')[1]) == [8]
+    assert ids(get(client, headers, '?project=3')[1]) == []
+
+
+def test_cursor_pages_through_all_batches(client, headers):
+    pages = []
+    cursor = None
+    while True:
+        status, response = get(client, headers, '?project=1&limit=4' +
+                               ('' if cursor is None else '&cursor=%s' % cursor))
+        assert status == 200
+        pages.append(ids(response))
+        cursor = response['output']['nextCursor']
+        if(cursor is None):
+            break
+
+    assert pages == [[1, 3, 5, 7], [9, 11, 13, 15], [17, 19]]
+
+
+def test_last_full_page_has_no_cursor_when_nothing_follows(client, headers):
+    status, response = get(client, headers, '?limit=20')
+    assert response['output']['nextCursor'] is None
+
+    status, response = get(client, headers, '?limit=19')
+    assert response['output']['nextCursor'] == 19
+
+
+def test_projection_returns_only_requested_fields(client, headers):
+    status, response = get(client, headers, '?fields=Vial%20barcode,Unknown&limit=2')
+
+    assert response['output']['batches'] == [
+        {'id': 1, 'projects': [{'id': 1, 'name': 'FJM'}], 'batch_fields': {'Vial barcode': 'BC1', 'Unknown': None}},
+        {'id': 2, 'projects': [{'id': 2, 'name': 'ABC'}], 'batch_fields': {'Vial barcode': 'BC2', 'Unknown': None}}]
+
+
+@pytest.mark.parametrize('query', ['?project=x', '?cursor=abc', '?limit=0', '?limit=-1'])
+def test_bad_parameters(client, headers, query):
+    status, response = get(client, headers, query)
+
+    assert status == 400
+    assert response['message'].startswith('Error: Bad request')
+
+
+def test_quarantined_batches_are_reported(client, headers):
+    get(client, headers)
+    response = client.get('/quarantine', headers=headers).get_json()['backendRequest']['response']
+
+    assert [batch['id'] for batch in response['output']['batches']] == [21]
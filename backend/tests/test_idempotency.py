@@ -0,0 +1,60 @@
+import sqlite3
+import time
+
+from idempotency import IdempotencyStore
+
+
+def test_key_is_new_running_and_done(tmp_path):
+    store = IdempotencyStore(str(tmp_path / 'idempotency.sqlite3'))
+
+    assert store.begin('vial:1') == ('new', None)
+    assert store.begin('vial:1') == ('running', None)
+    assert store.get('vial:1') is None
+
+    store.done('vial:1', {'status': 200})
+    assert store.begin('vial:1') == ('done', {'status': 200})
+    assert store.get('vial:1') == {'status': 200}
+
+
+def test_released_key_can_be_claimed_again(tmp_path):
+    store = IdempotencyStore(str(tmp_path / 'idempotency.sqlite3'))
+    store.begin('submission:1')
+
+    store.release('submission:1')
+    assert store.begin('submission:1') == ('new', None)
+
+
+def test_keys_are_shared_by_stores_of_one_file(tmp_path):
+    # Every worker has its own store of the same file
+    path = str(tmp_path / 'idempotency.sqlite3')
+    store, other_store = IdempotencyStore(path), IdempotencyStore(path)
+
+    assert store.begin('vial:1') == ('new', None)
+    assert other_store.begin('vial:1') == ('running', None)
+    store.done('vial:1', {'status': 200})
+    assert other_store.begin('vial:1') == ('done', {'status': 200})
+
+
+def test_running_key_can_be_claimed_after_running_timeout(tmp_path):
+    path = str(tmp_path / 'idempotency.sqlite3')
+    store = IdempotencyStore(path, running_timeout=60)
+    store.begin('vial:1')
+    store.begin('vial:2')
+    store.done('vial:2', {'status': 200})
+    with sqlite3.connect(path) as conn:
+        # Claimed by a process that stopped before it was done
+        conn.execute(
+            "UPDATE idempotency_keys SET created_on = ?", (time.time() - 120,))
+
+    assert store.begin('vial:1') == ('new', None)
+    assert store.begin('vial:2') == ('done', {'status': 200})
+
+
+def test_done_key_is_forgotten_after_ttl(tmp_path):
+    store = IdempotencyStore(str(tmp_path / 'idempotency.sqlite3'), ttl=0.1)
+    store.begin('vial:1')
+    store.done('vial:1', {'status': 200})
+
+    time.sleep(0.2)
+    assert store.get('vial:1') is None
+    assert store.begin('vial:1') == ('new', None)
@@ -0,0 +1,69 @@
+import sqlite3
+
+from jobs import JobQueue
+
+
+def handlers():
+    def double(payload, progress):
+        progress(1, 1, {'value': payload['value'] * 2})
+        return {'value': payload['value'] * 2}
+
+    def fail(payload, progress):
+        raise RuntimeError('handler failed')
+
+    return {'double': double, 'fail': fail}
+
+
+def interrupt(path, job_id, owner=None):
+    # Job was claimed by a process that stopped before it finished
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE jobs SET status = 'running', owner = ? WHERE id = ?",
+                     (owner, job_id))
+
+
+def test_job_runs_handler(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), handlers(), workers=1)
+    queue.start()
+    job_id = queue.submit('double', {'value': 21}, total=1)
+
+    job = queue.wait(job_id, 5)
+    assert job['status'] == 'finished'
+    assert job['result'] == {'value': 42}
+    assert job['progress'] == {'done': 1, 'total': 1}
+
+
+def test_failed_handler_fails_job(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), handlers(), workers=1)
+    queue.start()
+    job_id = queue.submit('fail', {})
+
+    job = queue.wait(job_id, 5)
+    assert job['status'] == 'failed'
+    assert job['error'] == 'handler failed'
+
+
+def test_running_job_is_queued_again_after_restart(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    job_id = JobQueue(path, handlers()).submit('double', {'value': 1})
+    interrupt(path, job_id)
+
+    queue = JobQueue(path, handlers(), workers=1)
+    queue.start()
+    job = queue.wait(job_id, 5)
+    assert job['status'] == 'finished'
+    assert job['result'] == {'value': 2}
+
+
+def test_running_job_of_other_owner_is_not_queued_again(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    job_id = JobQueue(path, handlers()).submit('double', {'value': 1})
+    interrupt(path, job_id, owner='0')
+
+    queue = JobQueue(path, handlers(), workers=1, owner='1')
+    queue.start()
+    assert queue.wait(job_id, 0.5)['status'] == 'running'
+
+    # Worker that replaces the stopped worker of slot 0 continues its job
+    queue = JobQueue(path, handlers(), workers=1, owner='0')
+    queue.start()
+    assert queue.wait(job_id, 5)['status'] == 'finished'
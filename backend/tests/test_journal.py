@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import journal
+from journal import Journal, JournalError
+
+
+def wait_until(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, 'condition not met within %s seconds' % timeout
+        time.sleep(0.01)
+
+
+def fields(status):
+    return {'batch_fields': {'Status': status}}
+
+
+def records(path):
+    with open(path) as journal_file:
+        return [json.loads(line) for line in journal_file if line.strip()]
+
+
+def test_pending_updates_survive_restart(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    first = Journal(path)
+    done = first.append(1, fields('Added'), barcode='BC1')
+    first.append(2, fields('Checked in'), barcode='BC2')
+    first.ack(done, 200)
+
+    second = Journal(path)
+    assert second.size() == 1
+    assert second.pending_fields() == {2: {'Status': 'Checked in'}}
+    assert second.append(3, fields('Added')) > done
+
+
+def test_restart_compacts_journal_to_pending_updates(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    first = Journal(path)
+    for batch_id in range(5):
+        seq = first.append(batch_id, fields('Added'))
+        if(batch_id != 3):
+            first.ack(seq, 200)
+    assert len(records(path)) == 9
+
+    Journal(path)
+    assert [(record['op'], record['batchId']) for record in records(path)] == [('update', 3)]
+
+
+def test_journal_is_emptied_when_everything_is_acknowledged(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal_ = Journal(path, compact_size=1)
+    seq = journal_.append(1, fields('Added'))
+    assert os.path.getsize(path) > 0
+
+    journal_.ack(seq, 200)
+    assert os.path.getsize(path) == 0
+    assert Journal(path).size() == 0
+
+
+def test_damaged_last_line_is_skipped(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    with open(path, 'w') as journal_file:
+        journal_file.write(json.dumps({'seq': 1, 'op': 'update', 'batchId': 1, 'data': fields('Added'),
+                                       'barcode': 'BC1'}) + '\n')
+        journal_file.write('{"seq": 2, "op": "upd')
+
+    assert Journal(path).pending_fields() == {1: {'Status': 'Added'}}
+
+
+def test_failed_write_raises_and_journal_continues(tmp_path, monkeypatch):
+    path = str(tmp_path / 'journal.jsonl')
+    journal_ = Journal(path)
+    fsync = os.fsync
+
+    def failing_fsync(fd):
+        monkeypatch.setattr(journal.os, 'fsync', fsync)
+        raise OSError('disk full')
+
+    monkeypatch.setattr(journal.os, 'fsync', failing_fsync)
+    with pytest.raises(JournalError):
+        journal_.append(1, fields('Added'))
+    # Update that was not written is not pending, it is never sent
+    assert journal_.size() == 0
+
+    journal_.append(2, fields('Added'))
+    assert Journal(path).pending_fields() == {2: {'Status': 'Added'}}
+
+
+def test_replay_keeps_order_of_updates_per_batch(tmp_path):
+    journal_ = Journal(str(tmp_path / 'journal.jsonl'))
+    journal_.append(1, fields('Added'))
+    journal_.append(1, fields('Checked in'))
+    journal_.append(2, fields('Added'))
+
+    sent = []
+    unavailable = [True]
+
+    def send(batch_id, data):
+        sent.append((batch_id, data['batch_fields']['Status']))
+        if(batch_id == 1 and unavailable[0]):
+            # First round: CDD is unavailable for batch 1
+            unavailable[0] = False
+            return 503
+        return 200
+
+    journal_.start_replay(send, retry_interval=0.05)
+    wait_until(lambda: journal_.size() == 0)
+    assert sent == [(1, 'Added'), (2, 'Added'),
+                    (1, 'Added'), (1, 'Checked in')]
+
+
+def test_replay_acknowledges_permanent_failures(tmp_path):
+    journal_ = Journal(str(tmp_path / 'journal.jsonl'))
+    journal_.append(1, fields('Added'))
+    sent = []
+
+    def send(batch_id, data):
+        sent.append(batch_id)
+        return 404
+
+    journal_.start_replay(send, retry_interval=0.05)
+    wait_until(lambda: journal_.size() == 0)
+    time.sleep(0.2)
+    assert sent == [1]
+
+
+def test_replay_skips_claimed_update_until_released(tmp_path):
+    journal_ = Journal(str(tmp_path / 'journal.jsonl'))
+    seq = journal_.append(1, fields('Added'), claim=True)
+    journal_.append(1, fields('Checked in'))
+    sent = []
+    lock = threading.Lock()
+
+    def send(batch_id, data):
+        with lock:
+            sent.append(data['batch_fields']['Status'])
+        return 200
+
+    journal_.start_replay(send, retry_interval=0.05)
+    time.sleep(0.2)
+    # Later update of the batch waits for the claimed update
+    assert sent == []
+
+    journal_.release(seq)
+    wait_until(lambda: journal_.size() == 0)
+    assert sent == ['Added', 'Checked in']
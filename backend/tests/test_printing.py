@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+import printing
+from printing import LabelCounter, PrintSpooler, temporary_print_path
+
+LABEL = {'barcode': 'VB1', 'project': 'FJM', 'box': '1', 'position': 'A1'}
+PRINTERS = {'default': {'directory': '', 'format': 'text'}}
+
+
+def spooler(tmp_path):
+    """ Returns spooler of print directory tmp_path/print, a new spooler of the same files is a restarted process
+    """
+
+    os.makedirs(str(tmp_path / 'print'), exist_ok=True)
+    return PrintSpooler(str(tmp_path / 'spooler.sqlite3'), str(tmp_path / 'print'),
+                        LabelCounter(str(tmp_path / 'counter.sqlite3'), legacy_path=None), PRINTERS, window=0)
+
+
+def print_files(tmp_path):
+    return sorted(os.listdir(str(tmp_path / 'print')))
+
+
+def test_job_is_printed(tmp_path):
+    print_spooler = spooler(tmp_path)
+    print_spooler.start()
+
+    job = print_spooler.wait(print_spooler.submit('default', 'text', [LABEL]), 5)
+    assert job['status'] == 'finished'
+    assert print_files(tmp_path) == [job['file']]
+
+
+def test_finished_job_that_was_not_renamed_is_renamed_on_start(tmp_path, monkeypatch):
+    print_spooler = spooler(tmp_path)
+    job_id = print_spooler.submit('default', 'text', [LABEL])
+
+    def stop(source, destination):
+        raise SystemExit('process stopped')
+
+    # Process stops after the job is finished, before the print file is renamed
+    monkeypatch.setattr(printing.os, 'replace', stop)
+    with pytest.raises(SystemExit):
+        print_spooler._print(*print_spooler._claim())
+    monkeypatch.undo()
+    job = print_spooler.get(job_id)
+    assert job['status'] == 'finished'
+    assert print_files(tmp_path) == [os.path.basename(
+        temporary_print_path('', job['file']))]
+
+    spooler(tmp_path).start()
+    assert print_files(tmp_path) == [job['file']]
+
+
+def test_running_job_is_printed_again_after_restart(tmp_path):
+    print_spooler = spooler(tmp_path)
+    job_id = print_spooler.submit('default', 'text', [LABEL])
+    print_spooler._claim()
+    # Process stops while the print file is written
+    with print_spooler._connect() as conn:
+        conn.execute("UPDATE print_jobs SET file = 'partial.txt' WHERE id = ?", (job_id,))
+    with open(temporary_print_path(str(tmp_path / 'print'), 'partial.txt'), 'w') as partial_file:
+        partial_file.write('VB1')
+
+    restarted_spooler = spooler(tmp_path)
+    restarted_spooler.start()
+    job = restarted_spooler.wait(job_id, 5)
+    assert job['status'] == 'finished'
+    # Partial print file is removed
+    assert print_files(tmp_path) == [job['file']]
@@ -0,0 +1,41 @@
+import time
+
+import pytest
+
+from multi_worker import SharedScanSessions
+from scan_sessions import ScanSessions
+
+PROJECT = {'id': 1000, 'name': 'PRJ1'}
+
+
+@pytest.fixture(params=['memory', 'shared'])
+def sessions(request, tmp_path):
+    if(request.param == 'memory'):
+        return ScanSessions(commit_timeout=0.1)
+    return SharedScanSessions(str(tmp_path / 'sessions.sqlite3'), commit_timeout=0.1)
+
+
+def test_barcode_is_reserved_by_one_open_session(sessions):
+    session = sessions.open('Add', PROJECT)
+    other_session = sessions.open('Add', PROJECT)
+
+    assert sessions.add(session['id'], {'barcode': 'VB1'}, {'id': 1}) == 'added'
+    assert sessions.add(session['id'], {'barcode': 'VB1'}, {'id': 1}) == 'duplicate'
+    assert sessions.add(other_session['id'], {'barcode': 'VB1'}, {'id': 1}) == 'reserved'
+
+
+def test_session_is_open_again_after_commit_timeout(sessions):
+    session = sessions.open('Add', PROJECT)
+    sessions.add(session['id'], {'barcode': 'VB1'}, {'id': 1})
+
+    assert sessions.begin_commit(session['id'])[0] == 'open'
+    # Commit never ends, e.g. the worker stopped
+    assert sessions.begin_commit(session['id'])[0] == 'committing'
+
+    time.sleep(0.2)
+    status, reopened = sessions.begin_commit(session['id'])
+    assert status == 'open'
+    assert list(reopened['items']) == ['VB1']
+    sessions.end_commit(session['id'], {'status': 200})
+    other_session = sessions.open('Add', PROJECT)
+    assert sessions.add(other_session['id'], {'barcode': 'VB1'}, {'id': 1}) == 'added'
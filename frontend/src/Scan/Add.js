@@ -532,7 +532,8 @@ function Add({ handleChangePage }) {
     fetchPrintLabels(data)
       .then((response) => {
         console.log(response);
-        if (response.status === 200) {
+        // Print-file is written by print job of backend
+        if (response.status === 200 || response.status === 202) {
           setIsPrintFileSend(true);
         }
         setIsLoading(false);